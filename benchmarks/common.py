@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared helpers for the CASFS benchmark suite.
+
+The ``remote`` backend is a MemoryFS behind a
+:class:`casfs.latencyfs.LatencyFS`, adding ``CASFS_BENCH_LATENCY`` seconds
+(default 1ms) to every call, to approximate a bucket store.
+
+Object sizes above 1MB are skipped unless the ``CASFS_BENCH_MAX_SIZE``
+environment variable raises the limit, eg to ``1000000000`` to include the 1GB
+case.
+
+"""
+
+import os
+import random
+from io import BytesIO
+
+from fs.memoryfs import MemoryFS
+from fs.osfs import OSFS
+
+import pytest
+
+from casfs.latencyfs import LatencyFS
+
+BACKENDS = ("mem", "os", "temp", "remote")
+
+SIZES = (100, 10**4, 10**6, 10**8, 10**9)
+
+# (depth, width) pairs.
+LAYOUTS = ((2, 2), (1, 7), (3, 2))
+
+MAX_SIZE = int(os.getenv("CASFS_BENCH_MAX_SIZE", 10**6))
+
+LATENCY = float(os.getenv("CASFS_BENCH_LATENCY", 0.001))
+
+# Seed for all generated content, so that every run stores the same bytes.
+SEED = 2020
+
+
+def make_fs(backend, tmp_path):
+  """Return a fresh pyfilesystem instance of the named `backend`."""
+  if backend == "mem":
+    return MemoryFS()
+  if backend == "os":
+    return OSFS(str(tmp_path))
+  if backend == "remote":
+    return LatencyFS(MemoryFS(), latency=LATENCY, seed=SEED)
+  return "temp://casfs-bench"
+
+
+def sized(sizes=SIZES):
+  """Parametrize a benchmark over every size in `sizes` up to MAX_SIZE."""
+  return pytest.mark.parametrize("size", [s for s in sizes if s <= MAX_SIZE])
+
+
+class Content(object):
+  """Deterministic source of distinct payloads of a fixed size."""
+
+  def __init__(self, size, seed=SEED):
+    self.size = size
+    self._random = random.Random(seed)
+
+  def __call__(self):
+    # a random prefix makes each payload unique without regenerating all of it.
+    prefix = self._random.getrandbits(64).to_bytes(8, "big")
+    return BytesIO(prefix + bytes(max(0, self.size - len(prefix))))
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixtures for the CASFS benchmark suite, which runs under pytest-benchmark;
+see `make bench`. Every benchmark of a store is parametrized over the backends
+in :data:`benchmarks.common.BACKENDS`.
+
+"""
+
+import pytest
+
+from benchmarks.common import BACKENDS, make_fs
+from casfs import CASFS
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+  return request.param
+
+
+@pytest.fixture
+def make_cas(backend, tmp_path):
+  """Factory for stores on the current backend. All stores made during one
+  benchmark share the same backing filesystem.
+
+  """
+  root = make_fs(backend, tmp_path)
+  stores = []
+
+  def make(depth=2, width=2, **kwargs):
+    cas = CASFS(root if not stores else stores[0].fs,
+                depth=depth,
+                width=width,
+                **kwargs)
+    stores.append(cas)
+    return cas
+
+  yield make
+
+  if stores:
+    stores[0].fs.close()
+
+
+@pytest.fixture
+def cas(make_cas):
+  return make_cas()
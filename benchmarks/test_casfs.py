@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the public CASFS operations."""
+
+import random
+
+import pytest
+
+from benchmarks.common import LAYOUTS, SEED, Content, sized
+
+# Number of objects in the pre-populated stores used by the read benchmarks.
+POPULATION = 1000
+
+
+def populate(cas, n=POPULATION, size=100):
+  content = Content(size)
+  return [cas.put(content()) for _ in range(n)]
+
+
+@sized()
+def test_put(benchmark, cas, size):
+  content = Content(size)
+  benchmark.extra_info["bytes"] = size
+  benchmark.pedantic(cas.put,
+                     setup=lambda: ((content(),), {}),
+                     rounds=20 if size <= 10**6 else 3)
+
+
+@pytest.mark.parametrize("dup_ratio", [0.0, 0.5, 0.9])
+def test_put_batch_duplicates(benchmark, cas, dup_ratio):
+  """100 puts of 10KB objects, of which `dup_ratio` are already stored."""
+  content = Content(10**4)
+  stored = [content() for _ in range(int(100 * dup_ratio))]
+  for c in stored:
+    cas.put(c)
+
+  def batch():
+    fresh = [content() for _ in range(100 - len(stored))]
+    return ((stored + fresh,), {})
+
+  def put_all(items):
+    for c in items:
+      cas.put(c)
+
+  benchmark.extra_info["dup_ratio"] = dup_ratio
+  benchmark.pedantic(put_all, setup=batch, rounds=5)
+
+
+@pytest.mark.parametrize("grouped", [False, True], ids=["put", "put_many"])
+@pytest.mark.parametrize("durability", ["none", "data", "full"])
+def test_put_durability(benchmark, make_cas, durability, grouped):
+  """100 puts of 10KB objects, one at a time or as a single group commit."""
+  cas = make_cas(durability=durability)
+  content = Content(10**4)
+
+  def put_all(items):
+    if grouped:
+      cas.put_many(items)
+    else:
+      for c in items:
+        cas.put(c)
+
+  benchmark.pedantic(put_all,
+                     setup=lambda: (([content() for _ in range(100)],), {}),
+                     rounds=5)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS, ids=lambda l: "d{}w{}".format(*l))
+def test_put_layout(benchmark, make_cas, layout):
+  depth, width = layout
+  cas = make_cas(depth=depth, width=width)
+  content = Content(10**4)
+  benchmark.pedantic(cas.put, setup=lambda: ((content(),), {}), rounds=50)
+
+
+@pytest.fixture
+def populated(cas):
+  keys = populate(cas)
+  return cas, random.Random(SEED), keys
+
+
+def test_get(benchmark, populated):
+  cas, rng, keys = populated
+  benchmark(lambda: cas.get(rng.choice(keys).id))
+
+
+def test_exists_hit(benchmark, populated):
+  cas, rng, keys = populated
+  benchmark(lambda: cas.exists(rng.choice(keys).id))
+
+
+def test_exists_miss(benchmark, populated):
+  cas, _, _ = populated
+  benchmark(cas.exists, "0" * 64)
+
+
+@sized()
+def test_open_read(benchmark, cas, size):
+  key = cas.put(Content(size)())
+
+  def read():
+    with cas.open(key) as f:
+      while f.read(2**20):
+        pass
+
+  benchmark.extra_info["bytes"] = size
+  benchmark.pedantic(read, rounds=20 if size <= 10**6 else 3)
+
+
+def test_delete(benchmark, cas):
+  content = Content(100)
+  benchmark.pedantic(cas.delete,
+                     setup=lambda: ((cas.put(content()),), {}),
+                     rounds=100)
+
+
+@pytest.mark.parametrize("workers", [1, 8])
+def test_delete_many(benchmark, cas, workers):
+  content = Content(100)
+  benchmark.extra_info["workers"] = workers
+  benchmark.pedantic(cas.delete_many,
+                     setup=lambda:
+                     (([cas.put(content()) for _ in range(200)],), {
+                         "workers": workers
+                     }),
+                     rounds=5)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS, ids=lambda l: "d{}w{}".format(*l))
+def test_count(benchmark, make_cas, layout):
+  depth, width = layout
+  cas = make_cas(depth=depth, width=width)
+  populate(cas)
+  assert benchmark(cas.count) == POPULATION
+
+
+@pytest.mark.parametrize("layout", LAYOUTS, ids=lambda l: "d{}w{}".format(*l))
+def test_size(benchmark, make_cas, layout):
+  depth, width = layout
+  cas = make_cas(depth=depth, width=width)
+  populate(cas)
+  assert benchmark(cas.size) == POPULATION * 100
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_repair(benchmark, make_cas, workers):
+  """Repair a store written with one layout and opened with another. Each round
+  flips the layout so there's always a full store's worth to move."""
+  a, b = make_cas(depth=2, width=2), make_cas(depth=1, width=7)
+  populate(a, n=200, size=10**4)
+  stores = [b, a]
+
+  def flip():
+    stores.reverse()
+    return ((), {})
+
+  def repair():
+    stores[0].repair(workers=workers)
+
+  benchmark.extra_info["workers"] = workers
+  benchmark.pedantic(repair, setup=flip, rounds=4)
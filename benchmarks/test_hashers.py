@@ -0,0 +1,48 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmarks comparing every hash algorithm available on this machine.
+
+Results are grouped by payload size, so each group ranks the algorithms::
+
+  pytest benchmarks/test_hashers.py --benchmark-group-by=group
+
+"""
+
+import pytest
+
+import casfs.hashers as h
+from benchmarks.common import sized
+
+
+def _threads(algorithm):
+  """Thread counts worth trying for `algorithm`; -1 is as many as it likes."""
+  return (1, -1) if h.get(algorithm).parallel else (1,)
+
+
+@sized((10**3, 10**6, 10**8))
+@pytest.mark.parametrize("algorithm,threads",
+                         [(a, n) for a in h.available() for n in _threads(a)])
+def test_hash(benchmark, algorithm, threads, size):
+  data = bytes(size)
+
+  def digest():
+    hashobj = h.new(algorithm, threads=threads)
+    hashobj.update(data)
+    return hashobj.hexdigest()
+
+  benchmark.group = "hash {} bytes".format(size)
+  benchmark.extra_info["bytes"] = size
+  benchmark(digest)
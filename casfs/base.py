@@ -17,63 +17,290 @@
 
 Potential next steps:
 
-TODO - store the actual FULL hash at the end of each.
-
 TODO - we need a function that will provide a temp path... and when we leave
 the context manager, move the stuff from the temp path into the content
 addressable store.
 
 """
 
-import hashlib
+import functools
 import io
-import os
+import itertools
+import json
+import logging
+import time
+import uuid
 from contextlib import closing
-from typing import Iterable, Optional, Text, Tuple, Union
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Sequence,
+                    Text, Tuple, Union)
 
 import fs as pyfs
+from fs.info import Info
 from fs.permissions import Permissions
 
+import casfs.gc as g
+import casfs.hashers as h
+import casfs.metrics as m
+import casfs.record as r
+import casfs.singleflight as sf
+import casfs.tracing as t
 import casfs.util as u
 
 Key = Union[str, u.HashAddress]
 
+# Directory at the root of the store that holds CASFS's own bookkeeping files
+# (checkpoints and the like). It's never treated as content.
+META_DIR = ".casfs"
+
+# Name of the cursor file that lets an interrupted `repair` resume, and the
+# number of files repaired between writes of that cursor.
+_REPAIR_CHECKPOINT = "repair.checkpoint"
+_CHECKPOINT_EVERY = 1000
+
+# Directory inside META_DIR holding the fingerprints recorded by `verify`, one
+# JSON index per top-level shard directory.
+_FINGERPRINTS = "fingerprints"
+
+# Directory inside META_DIR holding the extra digests of each object, one JSON
+# file per id, in a directory per two-character id prefix. There are few enough
+# of those that each is created only once.
+_DIGESTS = "digests"
+
+# Directory inside META_DIR holding the sidecar contents `verify` has read, one
+# JSON index per two-character id prefix. Each entry is keyed by the id and
+# tagged with the checksums the bucket listed for its sidecar, so a rewritten
+# sidecar is read again.
+_DIGEST_INDEX = "digests.index"
+
+# Directory inside META_DIR holding one reference file per pin.
+_REFS = "refs"
+
+# Directories inside META_DIR where new objects are written before they're
+# moved into place, and where per-stripe lock files live; and the age in seconds
+# after which `repair` considers a temp file abandoned.
+_TMP = "tmp"
+_LOCKS = "locks"
+_STALE_TEMP = 3600
+
+# Durability levels for new objects: ``"none"`` leaves flushing to the OS,
+# ``"data"`` fsyncs each object before it's moved into place, and ``"full"``
+# also fsyncs the directories it's moved into.
+DURABILITY = ("none", "data", "full")
+
+# Ways of remembering which shard directories exist: not at all, in memory, or
+# also in a bookkeeping file inside META_DIR that survives restarts.
+DIR_CACHES = ("none", "memory", "persist")
+_DIRS = "dirs"
+
+# Largest shard tree that may be precreated.
+_MAX_PRECREATE = 2**20
+
+# Bookkeeping file describing the store: its layout, hash algorithm, enabled
+# features and the layout of any reshard in progress. Opening a store reads it
+# once.
+CONFIG = "config.json"
+_CONFIG_VERSION = 1
+
+# Features a store's config may list that this version of casfs understands.
+FEATURES = ("flat", "precreated")
+
+
+def _instrumented(op: str):
+  """Decorator for CASFS methods that wraps each call in a ``casfs.<op>`` span,
+  reports its latency, and any exception it raises, to the instance's metrics
+  registry under `op`, and hands the call to the instance's recorder, if any.
+
+  """
+
+  def decorator(f):
+
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+      metrics, recorder = self.metrics, self.recorder
+      start = metrics.clock()
+      begin = recorder.clock() if recorder is not None else None
+      ret, error = None, None
+      try:
+        with self._span(op):
+          ret = f(self, *args, **kwargs)
+      except Exception as e:
+        error = e
+        metrics.incr("errors", op=op)
+        raise
+      finally:
+        metrics.observe(op, start)
+        if recorder is not None:
+          recorder.record(self, op, args, ret, begin, error)
+
+      return ret
+
+    return wrapper
+
+  return decorator
+
 
 class CASFS(object):
   """Content addressable file manager. This is the Blueshift rewrite of
   https://github.com/dgilland/hashfs, using
   https://github.com/PyFilesystem/pyfilesystem2.
 
+  Every store describes itself in a config file inside :data:`META_DIR`, so it
+  can be opened with just its root. Arguments passed explicitly win over the
+  config. If they give a different layout, it's recorded as the store's new
+  layout at once, and reads also probe the old one until :meth:`repair` or
+  :meth:`reshard` moves everything, as they do during a reshard.
+
     Attributes:
         root: Either an instance of pyfs.base.FS, or a URI string parseable by
             pyfilesystem.
-        depth: Depth of subfolders to create when saving a file. Defaults to 2,
-            which means that actual hashes will be nested two items deep.
+        depth: Depth of subfolders to create when saving a file. Defaults to the
+            store's config, or 2 for a new store, which means that actual hashes
+            will be nested two items deep.
         width: Width of each subfolder to create when saving a file. This means
             that blocks of `width` characters of the hash will be used to
-            bucket content into each successive folder.
-        algorithm: Hash algorithm to use when computing file hash. Algorithm
-            should be available in `hashlib` module, ie, a member of
-            `hashlib.algorithms_available`. Defaults to `'sha256'`.
+            bucket content into each successive folder. Defaults to the store's
+            config, or 2. A layout other than the recorded one is only used by
+            this store, which probes both and refuses writes until
+            :meth:`repair` or :meth:`reshard` records it.
+        algorithm: Hash algorithm to use when computing file hash; the name of
+            a hasher in :mod:`casfs.hashers`, eg any member of
+            `hashlib.algorithms_available`, or `'blake3'` if it's installed.
+            Defaults to the store's config, or `'sha256'`; an existing store
+            can't be opened with another.
         dmode: Directory mode permission to set for subdirectories. Defaults to
             `0o755` which allows owner/group to read/write and everyone else to
             read and everyone to execute.
+        metrics: Registry that operation latencies and counters are reported
+            to; see :mod:`casfs.metrics`. Defaults to a registry that discards
+            everything.
+        tracer: Tracer that spans around each operation and its phases are
+            opened on; see :mod:`casfs.tracing`. Defaults to a tracer that
+            records nothing.
+        recorder: Optional :class:`casfs.record.Recorder` that every public
+            operation is logged to, for later replay.
+        locks: Number of lock stripes guarding writes, keyed by hash. With
+            locks enabled, concurrent puts of the same object write it only
+            once. On filesystems with a system path, the locks also serialize
+            processes on the same host, and :meth:`gc` can't delete an object
+            while a put of it is reporting a duplicate. Defaults to `0`, no
+            locking; writes are atomic either way.
+        durability: One of :data:`DURABILITY`. Only stores with a system path
+            are synced; elsewhere this is ignored. Defaults to `"none"`.
+        flat: If True, treat the store as a flat namespace, as object stores
+            are: never create directories (so `dmode` is ignored), never prune
+            empty ones, and list the store with a single prefix listing where
+            the backend supports it. Defaults to the store's config, or to
+            detecting object stores with :func:`casfs.util.is_object_store`.
+        dir_cache: One of :data:`DIR_CACHES`. Shard directories known to exist
+            aren't created again, which saves a backend call on most puts. If
+            one disappears anyway, it's recreated when a write into it fails.
+            Defaults to `"memory"`.
+        precreate: If True, create every shard directory up front (once per
+            layout), after which puts never create directories and deletes
+            never prune them. Only sensible for shallow layouts; see
+            :meth:`precreate`.
+        digests: Names of extra hash algorithms in :mod:`casfs.hashers`, eg
+            `("md5", "crc32c")`, whose digests are computed while each new
+            object is written and kept alongside it; see :meth:`get_digests`.
+            Defaults to the store's config, or none.
 
   """
 
   def __init__(self,
                root: Union[pyfs.base.FS, str],
-               depth: Optional[int] = 2,
-               width: Optional[int] = 2,
-               algorithm: hashlib.algorithms_available = "sha256",
-               dmode: Optional[int] = 0o755):
+               depth: Optional[int] = None,
+               width: Optional[int] = None,
+               algorithm: Optional[str] = None,
+               dmode: Optional[int] = 0o755,
+               metrics: Optional[m.Metrics] = None,
+               tracer: Optional[t.CallbackTracer] = None,
+               recorder: Optional[r.Recorder] = None,
+               locks: int = 0,
+               durability: str = "none",
+               flat: Optional[bool] = None,
+               dir_cache: str = "memory",
+               precreate: bool = False,
+               digests: Optional[Sequence[str]] = None):
+    if durability not in DURABILITY:
+      raise ValueError("Unknown durability level {!r}".format(durability))
+    if dir_cache not in DIR_CACHES:
+      raise ValueError("Unknown directory cache {!r}".format(dir_cache))
 
     self.fs = u.load_fs(root)
-    self.depth = depth
-    self.width = width
-    self.algorithm = algorithm
+    config = self._load_config()
+    features = set(config.get("features", ()))
+    self.depth = config.get("depth", 2) if depth is None else depth
+    self.width = config.get("width", 2) if width is None else width
+    self.algorithm = (config.get("algorithm", "sha256")
+                      if algorithm is None else algorithm)
     self.dmode = dmode
-
+    self.metrics = metrics or m.NULL
+    self.tracer = tracer or t.NULL
+    self.recorder = recorder
+    self.durability = durability
+    if flat is None:
+      flat = "flat" in features or u.is_object_store(self.fs)
+    self.flat = flat
+    self.dir_cache = dir_cache
+    self._dirs = set()
+    self._persisted = set()
+    if dir_cache == "persist":
+      self._load_dirs()
+    self._flights = sf.SingleFlight()
+    # ids put again while gc() runs, which it mustn't sweep.
+    self._reputs = None
+
+    lock_dir = self._meta_path(_LOCKS)
+    self._locks = u.StripedLock(
+        locks,
+        self.fs.getsyspath(lock_dir)
+        if locks and self.fs.hassyspath(lock_dir) else None)
+
+    # ids in another algorithm would all look corrupt.
+    if config.get("algorithm", self.algorithm) != self.algorithm:
+      raise ValueError("Store uses {}, not {}.".format(config["algorithm"],
+                                                       self.algorithm))
+
+    # objects may still live at their address in another layout: the one an
+    # unfinished reshard is moving them from, or the recorded one if the caller
+    # asked for a different layout. Only repair() or reshard() record a new
+    # layout; until then, this store refuses writes.
+    layout = (config.get("depth"), config.get("width"))
+    relayout = bool(config) and layout != (self.depth, self.width)
+    self._old_layout = None
+    self._relayout = False
+    if config.get("reshard_from"):
+      if relayout:
+        raise ValueError(
+            "Store is being resharded to depth {}, width {}; finish that with "
+            "reshard() before changing its layout again.".format(*layout))
+      self._old_layout = tuple(config["reshard_from"])
+    elif relayout:
+      logging.warning(
+          "Store was written with depth %s, width %s; probing both layouts, "
+          "and refusing writes, until it's repaired or resharded.", *layout)
+      self._old_layout = layout
+      self._relayout = True
+
+    # fail now, rather than on the first put, if an algorithm's missing here.
+    self._hasher = h.get(self.algorithm)
+    self.digests = tuple(
+        config.get("digests", ()) if digests is None else digests)
+    for name in self.digests:
+      h.get(name)
+
+    self._precreated = "precreated" in features and layout == (self.depth,
+                                                               self.width)
+    if precreate:
+      self.precreate()
+
+    if not config or config.get("digests", []) != list(self.digests):
+      try:
+        self._save_config()
+      except (pyfs.errors.FSError, OSError) as e:
+        logging.warning("Couldn't record the store's config: %s", e)
+
+  @_instrumented("put")
   def put(self, content) -> u.HashAddress:
     """Store contents of `content` in the backing filesystem using its content hash
     for the address.
@@ -86,11 +313,61 @@ class CASFS(object):
 
     """
     with closing(u.Stream(content, fs=self.fs)) as stream:
-      hashid = self._computehash(stream)
-      path, is_duplicate = self._copy(stream, hashid)
+      with self._span("hash") as span:
+        hashid = self._computehash(stream)
+        span.set_attribute("id", hashid)
+
+      # concurrent puts of the same content share a single write.
+      (path, is_duplicate), shared = self._flights.do(
+          hashid, lambda: self._copy(stream, hashid))
+
+    if shared:
+      self.metrics.incr("shared_puts")
+      is_duplicate = True
+
+    self.metrics.incr("puts")
+    if is_duplicate:
+      self.metrics.incr("duplicates")
+
+    address = u.HashAddress(hashid, path, is_duplicate)
+    self._stored(address)
+    return address
 
-    return u.HashAddress(hashid, path, is_duplicate)
+  def put_many(self,
+               contents: Iterable[Any],
+               batch_size: int = 256) -> List[u.HashAddress]:
+    """Store every item in `contents`, as :meth:`put` does, committing them in
+    groups of `batch_size`.
 
+    Every new object in a group is written before any of them is synced or moved
+    into place, and each directory is synced once per group, so the cost of
+    :attr:`durability` is paid per group rather than per object. If writing a
+    group fails, none of its new objects are published.
+
+    Args:
+      contents: Readable objects or paths to files. May be an arbitrarily long
+        lazy sequence.
+      batch_size: Maximum number of objects per group.
+
+    Returns:
+      The hash address of each item, in order.
+
+    """
+    ret, batch = [], []
+    for content in contents:
+      batch.append(content)
+      if len(batch) >= batch_size:
+        ret.extend(self._put_batch(batch))
+        batch = []
+
+    if batch:
+      ret.extend(self._put_batch(batch))
+
+    for address in ret:
+      self._stored(address)
+    return ret
+
+  @_instrumented("get")
   def get(self, k: Key) -> Optional[u.HashAddress]:
     """Return :class:`HashAddress` from given id or path. If `k` does not refer to
        a valid file, then `None` is returned.
@@ -109,6 +386,39 @@ class CASFS(object):
 
     return u.HashAddress(self._unshard(path), path)
 
+  def get_digests(self,
+                  k: Key,
+                  compute: bool = True) -> Optional[Dict[Text, Text]]:
+    """Return the extra digests of `k`, by algorithm name, or None if `k` isn't
+    stored.
+
+    Digests recorded when the object was written are returned without reading
+    it. Any of :attr:`digests` that weren't, eg because the object predates
+    them, are computed from one read of the object and recorded, unless
+    `compute` is False.
+
+    Args:
+      k: Address ID or path of file.
+      compute: Whether to fill in missing digests.
+
+    Returns:
+      Dict of algorithm name to hex digest, or None.
+
+    """
+    path = self._fs_path(k)
+    if path is None:
+      return None
+
+    hashid = self._path_to_id(path)
+    ret = self._load_digests(hashid)
+    missing = [name for name in self.digests if name not in ret]
+    if missing and compute:
+      with closing(u.Stream(path, fs=self.fs)) as stream:
+        ret.update(zip(missing, u.computehashes(stream, missing)))
+      self._save_digests(hashid, ret)
+    return ret
+
+  @_instrumented("open")
   def open(self, k: Key) -> io.IOBase:
     """Return open IOBase object from given id or path.
 
@@ -126,8 +436,11 @@ class CASFS(object):
     if path is None:
       raise IOError("Could not locate file: {0}".format(k))
 
-    return self.fs.open(path, mode='rb')
+    self.metrics.incr("backend_calls", call="open")
+    with self._span("fs_open", path=path):
+      return self.fs.open(path, mode='rb')
 
+  @_instrumented("delete")
   def delete(self, k: Key) -> None:
     """Delete file using id or path. Remove any empty directories after
         deleting. No exception is raised if file doesn't exist.
@@ -139,73 +452,415 @@ class CASFS(object):
     if path is None:
       return None
 
-    try:
-      self.fs.remove(path)
-    except OSError:  # pragma: no cover
-      # Attempting to delete a directory.
-      pass
-    else:
-      print("REMOVING", pyfs.path.dirname(path))
+    if self._remove(path):
+      self.metrics.incr("deletes")
+      self._remove_digests(path)
       self._remove_empty(pyfs.path.dirname(path))
 
+  def delete_many(self,
+                  keys: Iterable[Key],
+                  workers: int = 1,
+                  prune: bool = True) -> int:
+    """Delete every file in `keys`, by id or path, on a pool of `workers`
+    threads. Missing files are skipped.
+
+    Rather than pruning after every file, as :meth:`delete` does, each directory
+    that held a deleted file is pruned once at the end.
+
+    Args:
+      keys: Keys of the files to delete. May be an arbitrarily long lazy
+        sequence.
+      workers: Number of threads deleting files concurrently.
+      prune: If False, leave empty directories behind; clean them up later with
+        :meth:`prune_empty`.
+
+    Returns:
+      The number of files deleted.
+
+    """
+
+    def delete(k):
+      path = self._fs_path(k)
+      if path is not None and self._remove(path):
+        self._remove_digests(path)
+        return path
+
+    count, dirs = 0, set()
+    for path in u.bounded_map(delete, keys, workers):
+      if path is not None:
+        count += 1
+        dirs.add(pyfs.path.dirname(path))
+
+    self.metrics.incr("deletes", count)
+    logging.info("Deleted %d files from %d directories.", count, len(dirs))
+
+    if prune:
+      self.prune_empty(dirs)
+
+    return count
+
+  def prune_empty(self, dirs: Optional[Iterable[Text]] = None) -> None:
+    """Remove empty directories, deepest first. If `dirs` is supplied, only
+    those directories and the ancestors they leave empty are considered;
+    otherwise, every directory in the store is.
+
+    """
+    if self.flat or self._precreated:
+      return None
+
+    if dirs is None:
+      dirs = self.fs.walk.dirs(exclude_dirs=[META_DIR])
+
+    for d in sorted(set(dirs), key=lambda d: d.count("/"), reverse=True):
+      self._remove_empty(d)
+
+  def precreate(self, workers: int = 1) -> int:
+    """Create every shard directory for the current layout, so that puts never
+    have to. The tree is only created once per layout; later calls, and stores
+    opened with `precreate=True`, just check the store's config. Returns the
+    number of directories created.
+
+    Raises:
+      ValueError: If the layout has more than ``2**20`` shard directories.
+
+    """
+    if self.flat or not self.depth or not self.width:
+      return 0
+    self._check_layout()
+
+    leaves = 16**(self.depth * self.width)
+    if leaves > _MAX_PRECREATE:
+      raise ValueError("Won't precreate {} shard directories.".format(leaves))
+
+    created = 0
+    if not self._precreated:
+      perms = Permissions.create(self.dmode)
+      digits = self.depth * self.width
+
+      def create(i):
+        path = pyfs.path.join(*self._shard("{:0{}x}".format(i, digits)))
+        self.fs.makedirs(path, permissions=perms, recreate=True)
+
+      for _ in u.bounded_map(create, range(leaves), workers):
+        created += 1
+
+      self._precreated = True
+      self._save_config()
+
+    return created
+
+  def reshard(self,
+              depth: int,
+              width: int,
+              workers: int = 1,
+              progress: Optional[Callable[[u.Progress], Any]] = None,
+              progress_interval: float = 1.0) -> int:
+    """Move every object to its address in a layout of `depth` and `width`,
+    which becomes the store's layout straight away. Ids come from the existing
+    paths, so no content is read.
+
+    Reads keep working while objects move, by probing the old layout too, and
+    new objects go straight to the new layout. If a reshard is interrupted,
+    stores opened on the same root keep probing both layouts until
+    :meth:`reshard` is called again to finish it. Directories left empty are
+    pruned at the end.
+
+    Args:
+      depth: New depth.
+      width: New width.
+      workers: Number of threads moving objects concurrently.
+      progress: Optional callback that receives a :class:`casfs.util.Progress`
+        every `progress_interval` seconds, and once more at the end.
+      progress_interval: Minimum number of seconds between progress reports.
+
+    Returns:
+      The number of objects moved.
+
+    Raises:
+      ValueError: If an unfinished reshard is moving objects to a different
+        layout.
+
+    """
+    if (depth, width) != (self.depth, self.width) or self._relayout:
+      if self._old_layout is None:
+        self._old_layout = (self.depth, self.width)
+      elif not self._relayout:
+        # objects would be spread over three layouts, and reads only probe two.
+        raise ValueError(
+            "Store is being resharded to depth {}, width {}; call reshard() "
+            "with that layout to finish first.".format(self.depth, self.width))
+      self.depth, self.width = depth, width
+      self._relayout = False
+      self._precreated = False
+      self._save_config()
+
+    tracker = u.ProgressTracker(progress, progress_interval)
+
+    def move(path):
+      hashid = self._path_to_id(path)
+      expected_path = self._hashid_to_path(hashid)
+      if expected_path == path:
+        return None
+      self._relocate(path, u.HashAddress(hashid, expected_path))
+      return path
+
+    for path in u.bounded_map(move, self._sorted_files(), workers):
+      if path is not None:
+        tracker.update(1)
+
+    # earlier, interrupted passes may have emptied directories too.
+    self.prune_empty()
+    self._old_layout = None
+    self._save_config()
+
+    done = tracker.finish()
+    logging.info("Resharded %d objects to depth %d, width %d.", done.objects,
+                 depth, width)
+    return done.objects
+
   def files(self) -> Iterable[Text]:
     """Return generator that yields all files in the :attr:`fs`.
 
     """
-    return (pyfs.path.relpath(p) for p in self.fs.walk.files())
+    listing = self._list_objects()
+    if listing is not None:
+      return (path for path, _ in listing)
+
+    return (pyfs.path.relpath(p)
+            for p in self.fs.walk.files(exclude_dirs=[META_DIR]))
 
   def folders(self) -> Iterable[Text]:
     """Return generator that yields all directories in the :attr:`fs` that contain
         files.
 
     """
-    for step in self.fs.walk():
+    for step in self.fs.walk(exclude_dirs=[META_DIR]):
       if step.files:
         yield step.path
 
   def count(self) -> int:
     """Return count of the number of files in the backing :attr:`fs`.
         """
-    return sum(1 for _, info in self.fs.walk.info() if info.is_file)
+    listing = self._list_objects()
+    if listing is not None:
+      return sum(1 for _ in listing)
+
+    return sum(1 for _, info in self.fs.walk.info(exclude_dirs=[META_DIR])
+               if info.is_file)
 
   def size(self) -> int:
     """Return the total size in bytes of all files in the :attr:`root`
         directory.
         """
+    listing = self._list_objects()
+    if listing is not None:
+      return sum(size for _, size in listing)
+
     return sum(info.size
-               for _, info in self.fs.walk.info(namespaces=['details'])
+               for _, info in self.fs.walk.info(namespaces=['details'],
+                                                exclude_dirs=[META_DIR])
                if info.is_file)
 
+  @_instrumented("exists")
   def exists(self, k: Key) -> bool:
     """Check whether a given file id or path exists on disk."""
     return bool(self._fs_path(k))
 
-  def repair(self) -> Iterable[Text]:
+  def repair(self,
+             workers: int = 1,
+             checkpoint: bool = False,
+             progress: Optional[Callable[[u.Progress], Any]] = None,
+             bytes_per_second: Optional[float] = None,
+             progress_interval: float = 1.0) -> Iterable[Text]:
     """Repair any file locations whose content address doesn't match its file path.
     Returns a sequence of repaired files.
 
+    Files are visited in hash order and each fix is applied as soon as the file
+    has been hashed, so an interrupted repair leaves the store consistent.
+
+    Args:
+      workers: Number of threads hashing files concurrently.
+      checkpoint: If True, persist a cursor inside the store every so often so
+        that an interrupted repair resumes where it left off. The cursor is
+        removed once the repair completes.
+      progress: Optional callback that receives a :class:`casfs.util.Progress`
+        every `progress_interval` seconds, and once more at the end.
+      bytes_per_second: Optional cap on the rate at which file contents are
+        read, to bound the I/O impact of the repair.
+      progress_interval: Minimum number of seconds between progress reports.
+
+    Returns:
+      Sequence of ``(path, address)`` pairs for the files that were moved or
+      removed by this run.
+
     """
+    self._clean_temp()
+    cursor = self._read_meta(_REPAIR_CHECKPOINT) if checkpoint else None
+    tracker = u.ProgressTracker(progress, progress_interval)
+    paths = self._sorted_files(after=cursor)
     repaired = []
-    corrupted = self._corrupted()
 
-    for path, address in corrupted:
-      if self.fs.isfile(address.relpath):
-        # File already exists so just delete corrupted path.
-        self.fs.remove(path)
+    for path, hashid, nbytes in self._scan(paths, workers, bytes_per_second):
+      expected_path = self._hashid_to_path(hashid)
 
-      else:
-        # File doesn't exist, so move it.
-        self._makedirs(pyfs.path.dirname(address.relpath))
-        self.fs.move(path, address.relpath)
+      if pyfs.path.abspath(expected_path) != pyfs.path.abspath(path):
+        address = u.HashAddress(hashid, expected_path)
+        self._relocate(path, address)
+        repaired.append((path, address))
 
-      repaired.append((path, address))
+      tracker.update(1, nbytes)
+      if checkpoint and tracker.objects % _CHECKPOINT_EVERY == 0:
+        self._write_meta(_REPAIR_CHECKPOINT, path)
 
     # check for empty directories created by the repair.
-    for d in {pyfs.path.dirname(p) for p, _ in repaired}:
-      self._remove_empty(d)
+    self.prune_empty(pyfs.path.dirname(p) for p, _ in repaired)
+
+    if checkpoint:
+      self._remove_meta(_REPAIR_CHECKPOINT)
 
+    # everything now lives in this store's layout.
+    self._old_layout = None
+    self._relayout = False
+    self._save_config()
+
+    tracker.finish()
     return repaired
 
+  def verify(
+      self,
+      mode: str = "quick",
+      max_age: Optional[float] = None,
+      workers: int = 1,
+      progress: Optional[Callable[[u.Progress], Any]] = None,
+      bytes_per_second: Optional[float] = None,
+      progress_interval: float = 1.0) -> Iterable[Tuple[Text, u.HashAddress]]:
+    """Check that every file's content matches its address, without moving
+    anything.
+
+    Every file that verifies cleanly gets a fingerprint (size, modification
+    time, full hash and time of verification) recorded in an index inside the
+    store. In ``"quick"`` mode, files whose size and modification time still
+    match their fingerprint are trusted without being read, so a pass over an
+    unchanged store costs a metadata scan.
+
+    In ``"checksums"`` mode, for stores in a bucket, the checksums the bucket
+    reports in its listing are compared with the ones recorded for each object
+    (see :attr:`digests`), and only files that disagree, or have nothing to
+    compare, are read and rehashed. The store's digests have to include one the
+    bucket reports, ``md5`` or ``crc32c``; a pass then costs a listing plus a
+    few small reads per id prefix.
+
+    Args:
+      mode: ``"quick"`` to skip files with a matching fingerprint,
+        ``"checksums"`` to skip files whose checksums match the bucket's, or
+        ``"full"`` to rehash everything.
+      max_age: In quick mode, rehash files whose last verification is older
+        than this many seconds even if their fingerprint matches.
+      workers: Number of threads hashing files concurrently.
+      progress: Optional callback that receives a :class:`casfs.util.Progress`
+        every `progress_interval` seconds, and once more at the end.
+      bytes_per_second: Optional cap on the rate at which file contents are
+        read.
+      progress_interval: Minimum number of seconds between progress reports.
+
+    Returns:
+      Sequence of ``(path, address)`` pairs, as in :meth:`_corrupted`, for every
+      file whose content doesn't match its path.
+
+    Raises:
+      ValueError: In ``"checksums"`` mode, if the backing filesystem doesn't
+        report checksums or none of them is among the store's digests.
+
+    """
+    if mode not in ("quick", "checksums", "full"):
+      raise ValueError("Unknown verify mode {!r}".format(mode))
+
+    tracker = u.ProgressTracker(progress, progress_interval)
+    if mode == "checksums":
+      return self._verify_checksums(tracker, workers, bytes_per_second)
+
+    corrupted = []
+
+    for bucket, infos in self._stat_buckets():
+      index = self._load_fingerprints(bucket)
+      stats = {path: _stat(info) for path, info in infos}
+      now = time.time()
+
+      def trusted(path):
+        fp = index.get(path)
+        return (mode == "quick" and fp is not None and
+                (fp["size"], fp["mtime"]) == stats[path] and
+                (max_age is None or now - fp["verified"] <= max_age))
+
+      stale = []
+      for path in sorted(stats):
+        if trusted(path):
+          tracker.update(1, 0)
+        else:
+          stale.append(path)
+
+      for path, hashid, nbytes in self._scan(stale, workers, bytes_per_second):
+        expected_path = self._hashid_to_path(hashid)
+
+        if pyfs.path.abspath(expected_path) != pyfs.path.abspath(path):
+          corrupted.append((path, u.HashAddress(hashid, expected_path)))
+          index.pop(path, None)
+        else:
+          size, mtime = stats[path]
+          index[path] = {
+              "id": hashid,
+              "size": size,
+              "mtime": mtime,
+              "verified": now
+          }
+
+        tracker.update(1, nbytes)
+
+      # forget about files that have since disappeared.
+      index = {p: fp for p, fp in index.items() if p in stats}
+      self._save_fingerprints(bucket, index)
+
+    tracker.finish()
+    return corrupted
+
+  def pin(
+      self, name: str, ids: Iterable[Key] = (),
+      manifests: Iterable[Key] = ()) -> None:
+    """Create or replace the pin `name`, which keeps the objects in `ids` alive
+    through :meth:`gc`.
+
+    Args:
+      name: Name of the pin. May contain slashes to group pins.
+      ids: Keys of objects to keep.
+      manifests: Keys of manifest objects to keep. A manifest's content is
+        itself a list of references, one per line, in the format described in
+        :mod:`casfs.gc`; everything it refers to is kept too.
+
+    """
+    self._write_meta(self._ref_name(name),
+                     g.format_refs(map(_to_id, ids), map(_to_id, manifests)))
+
+  def unpin(self, name: str) -> None:
+    """Remove the pin `name`. No exception is raised if it doesn't exist."""
+    self._remove_meta(self._ref_name(name))
+
+  def pins(self) -> Iterable[Text]:
+    """Return generator that yields the names of every pin."""
+    refs = self._meta_path(_REFS)
+    if self.fs.isdir(refs):
+      for p in self.fs.walk.files(refs):
+        yield pyfs.path.relativefrom(refs, p)
+
+  def gc(self,
+         grace_period: float = 86400.0,
+         workers: int = 1,
+         dry_run: bool = False) -> g.GCStats:
+    """Delete every object that isn't reachable from a pin and is older than
+    `grace_period` seconds. See :func:`casfs.gc.collect`.
+
+    """
+    return g.collect(self, grace_period, workers, dry_run)
+
   def __contains__(self, k: Key) -> bool:
     """Return whether a given file id or path is contained in the
         :attr:`root` directory.
@@ -224,8 +879,21 @@ class CASFS(object):
 
   def _computehash(self, stream: u.Stream) -> str:
     """Compute hash of file using :attr:`algorithm`."""
+    if self.metrics.enabled:
+      stream = self._counted(stream, "bytes_hashed")
     return u.computehash(stream, self.algorithm)
 
+  def _counted(self, stream: Iterable[bytes], name: str) -> Iterable[bytes]:
+    """Pass `stream` through, adding its length to the counter `name` once it's
+    exhausted.
+
+    """
+    n = 0
+    for data in stream:
+      n += len(data)
+      yield data
+    self.metrics.incr(name, n)
+
   def _copy(self, stream: u.Stream, hashid: str) -> Tuple[Text, bool]:
     """Copy the contents of `stream` onto disk.
 
@@ -235,44 +903,366 @@ class CASFS(object):
         - boolean noting whether or not we have a duplicate.
 
         """
+    self._check_layout()
     path = self._hashid_to_path(hashid)
 
-    if self.fs.isfile(path):
-      is_duplicate = True
+    with self._locks.hold(hashid):
+      self.metrics.incr("backend_calls", call="isfile")
+      with self._span("probe", id=hashid) as span:
+        is_duplicate = self.fs.isfile(path)
+        span.set_attribute("duplicate", is_duplicate)
 
-    else:
-      # Only move file if it doesn't already exist.
-      is_duplicate = False
-      self._makedirs(pyfs.path.dirname(path))
-      with closing(self.fs.open(path, mode='wb')) as p:
-        for data in stream:
-          p.write(u.to_bytes(data))
+      if is_duplicate:
+        self._reput(hashid)
+      else:
+        # Only move file if it doesn't already exist.
+        dir_path = pyfs.path.dirname(path)
+        created = self._makedirs(dir_path)
+        self._publish(stream, hashid, path)
+        self._sync(*self._dirs_to_sync(dir_path, created))
 
     return (path, is_duplicate)
 
+  def _check_layout(self) -> None:
+    """Refuse writes into a layout the store's config doesn't record, since
+    stores opened without one would never find them.
+
+    Raises:
+      ValueError: If this store was opened with a layout other than the
+        recorded one, and hasn't been repaired or resharded into it.
+
+    """
+    if self._relayout:
+      raise ValueError(
+          "Store's layout is depth {}, width {}; repair() or reshard() it "
+          "before writing in another.".format(*self._old_layout))
+
+  def _stored(self, address: u.HashAddress) -> None:
+    """Called with the address of every object put into the store, whether new
+    or a duplicate, by every write path. Subclasses that keep track of the
+    store's contents override it."""
+    pass
+
+  def _reput(self, hashid: str) -> None:
+    """Note a put of `hashid`, which is already stored, so that a collection
+    running now spares it. Called with the stripe lock for `hashid` held, which
+    the collector takes too before deleting an object."""
+    reputs = self._reputs
+    if reputs is not None:
+      reputs.add(hashid)
+
+  def _publish(self, stream: u.Stream, hashid: str, path: str) -> None:
+    """Write the contents of `stream` to a temp file, then move it to `path` in
+    one step, so that readers never see a partially written object.
+
+    Flat stores without system paths are object stores, where an upload only
+    becomes visible once it's complete and a move is a copy plus a delete, so
+    objects are written straight to `path` instead.
+
+    """
+    if self.flat and not self.fs.hassyspath(path):
+      self._write(stream, hashid, path)
+      return None
+
+    tmp = self._write_temp(stream, hashid)
+    try:
+      if self.durability != "none":
+        self._sync(tmp)
+      self._move_temp(tmp, hashid, path)
+    except BaseException:
+      self._remove(tmp)
+      raise
+
+  def _write_temp(self, stream: u.Stream, hashid: str) -> str:
+    """Write the contents of `stream` to a new temp file and return its path.
+    The temp file is removed if the write fails."""
+    tmp = pyfs.path.join(self._meta_path(_TMP), uuid.uuid4().hex)
+    self._write(stream, hashid, tmp)
+    return tmp
+
+  def _write(self, stream: u.Stream, hashid: str, path: str) -> None:
+    """Write the contents of `stream`, which hash to `hashid`, to the new file
+    `path`, recording the object's extra digests on the way. The file is
+    removed if the write fails."""
+    self.metrics.incr("backend_calls", call="open")
+    hashers = [h.new(name) for name in self.digests]
+    written = 0
+    try:
+      with self._span("write", id=hashid) as span:
+        with closing(self._open_new(path)) as p:
+          for data in stream:
+            data = u.to_bytes(data)
+            written += len(data)
+            for hashobj in hashers:
+              hashobj.update(data)
+            p.write(data)
+        span.set_attribute("size", written)
+
+      # recorded before the object is published, so every object has them.
+      if hashers:
+        self._save_digests(
+            hashid,
+            {name: x.hexdigest() for name, x in zip(self.digests, hashers)})
+
+    except BaseException:
+      self._remove(path)
+      raise
+
+    self.metrics.incr("bytes_written", written)
+
+  def _move_temp(self, tmp: str, hashid: str, path: str) -> None:
+    """Move the temp file `tmp` into place at `path`."""
+    with self._span("publish", id=hashid):
+      self._move(tmp, path, overwrite=True)
+
+  def _move(self, src: str, dst: str, overwrite: bool = False) -> None:
+    """Move the file at `src` to `dst`. If the parent directory of `dst` wasn't
+    created just now, because the store is flat or the directory was assumed to
+    exist, it's created if the move fails for want of it."""
+    self.metrics.incr("backend_calls", call="move")
+    try:
+      self.fs.move(src, dst, overwrite=overwrite)
+    except pyfs.errors.ResourceNotFound:
+      dir_path = pyfs.path.dirname(dst)
+      if not (self.flat or self._precreated or dir_path in self._dirs):
+        raise
+      # strict backends want the "directory" to exist even in a bucket, and
+      # somebody may have pruned a known directory.
+      self._dirs.discard(dir_path)
+      self.metrics.incr("backend_calls", call="makedirs")
+      self.fs.makedirs(dir_path, recreate=True)
+      self.fs.move(src, dst, overwrite=overwrite)
+
+  def _put_batch(self, contents: List[Any]) -> List[u.HashAddress]:
+    """Store one group of :meth:`put_many`: write every new object to a temp
+    file, sync the temp files, move them into place and finally sync the
+    directories they landed in."""
+    self._check_layout()
+    addresses, staged = [], {}
+    try:
+      for content in contents:
+        with closing(u.Stream(content, fs=self.fs)) as stream:
+          with self._span("hash") as span:
+            hashid = self._computehash(stream)
+            span.set_attribute("id", hashid)
+
+          path = self._hashid_to_path(hashid)
+          if hashid not in staged:
+            self.metrics.incr("backend_calls", call="isfile")
+            with self._locks.hold(hashid):
+              is_duplicate = self.fs.isfile(path)
+              if is_duplicate:
+                self._reput(hashid)
+            if not is_duplicate:
+              staged[hashid] = self._write_temp(stream, hashid)
+          addresses.append(u.HashAddress(hashid, path, True))
+
+      if self.durability != "none":
+        self._sync(*staged.values())
+
+    except BaseException:
+      for tmp in staged.values():
+        self._remove(tmp)
+      raise
+
+    published, dirs = set(), set()
+    pending = dict(staged)
+    try:
+      for hashid, tmp in staged.items():
+        path = self._hashid_to_path(hashid)
+        with self._locks.hold(hashid):
+          if self.fs.isfile(path):
+            # somebody else published it while we were writing.
+            self._reput(hashid)
+            continue
+
+          dir_path = pyfs.path.dirname(path)
+          created = self._makedirs(dir_path)
+          self._move_temp(tmp, hashid, path)
+          del pending[hashid]
+
+        published.add(hashid)
+        dirs.update(self._dirs_to_sync(dir_path, created))
+
+    finally:
+      for tmp in pending.values():
+        self._remove(tmp)
+
+    self._sync(*sorted(dirs))
+
+    ret = []
+    for address in addresses:
+      if address.id in published:
+        published.discard(address.id)
+        address = address._replace(is_duplicate=False)
+      ret.append(address)
+
+    duplicates = sum(1 for a in ret if a.is_duplicate)
+    self.metrics.incr("puts", len(ret))
+    self.metrics.incr("duplicates", duplicates)
+    return ret
+
+  def _dirs_to_sync(self, dir_path: str, created: bool) -> List[str]:
+    """Return the directories to sync after moving an object into `dir_path`,
+    which is all of its ancestors too if it was just created."""
+    if self.durability != "full":
+      return []
+
+    ret = [dir_path]
+    while created and dir_path not in ("", "/"):
+      dir_path = pyfs.path.dirname(dir_path)
+      ret.append(dir_path or "/")
+    return ret
+
+  def _sync(self, *paths: str) -> None:
+    """Flush the files or directories at `paths` to stable storage, if the
+    backing filesystem has system paths at all."""
+    for path in paths:
+      if self.fs.hassyspath(path):
+        with self._span("sync", path=path):
+          u.fsync_path(self.fs.getsyspath(path))
+
+  def _open_new(self, path: str) -> io.IOBase:
+    """Open the new file `path` for writing, creating its directory if it's
+    missing, eg the temp directory the first time around."""
+    try:
+      return self.fs.open(path, mode='wb')
+    except pyfs.errors.ResourceNotFound:
+      dir_path = pyfs.path.dirname(path)
+      # as in _makedirs, only shard directories are counted.
+      if dir_path != self._meta_path(_TMP):
+        self.metrics.incr("backend_calls", call="makedirs")
+      self.fs.makedirs(dir_path, recreate=True)
+      return self.fs.open(path, mode='wb')
+
+  def _clean_temp(self, max_age: float = _STALE_TEMP) -> None:
+    """Remove temp files left behind by writers that died more than `max_age`
+    seconds ago."""
+    tmp = self._meta_path(_TMP)
+    if not self.fs.isdir(tmp):
+      return None
+
+    cutoff = time.time() - max_age
+    for info in self.fs.scandir(tmp, namespaces=["details"]):
+      modified = info.modified
+      if modified is not None and modified.timestamp() < cutoff:
+        self._remove(pyfs.path.join(tmp, info.name))
+
+  def _relocate(self, path: str, address: u.HashAddress) -> None:
+    """Move the file at `path` to its proper location, `address`, or simply
+    remove it if the content already lives there.
+
+    """
+    if self.fs.isfile(address.relpath):
+      # File already exists so just delete corrupted path.
+      self.fs.remove(path)
+
+    else:
+      # File doesn't exist, so move it.
+      self._makedirs(pyfs.path.dirname(address.relpath))
+      self._move(path, address.relpath)
+
+  def _remove(self, path: str) -> bool:
+    """Remove the file at `path`, leaving its directory in place. Returns
+    whether a file was removed.
+
+    """
+    try:
+      with self._span("remove", path=path):
+        self.fs.remove(path)
+    except pyfs.errors.ResourceNotFound:
+      # Somebody else got there first.
+      return False
+    except OSError:  # pragma: no cover
+      # Attempting to delete a directory.
+      return False
+    return True
+
   def _remove_empty(self, path: str) -> None:
     """Successively remove all empty folders starting with `subpath` and
         proceeding "up" through directory tree until reaching the :attr:`root`
         folder.
         """
+    if self.flat or self._precreated:
+      return None
+
     try:
-      pyfs.tools.remove_empty(self.fs, path)
+      with self._span("prune", path=path):
+        pyfs.tools.remove_empty(self.fs, path)
+        self._forget_dirs(path)
     except pyfs.errors.ResourceNotFound:
       # Guard against paths that don't exist in the FS.
       return None
 
-  def _makedirs(self, dir_path):
-    """Physically create the folder path on disk."""
+  def _makedirs(self, dir_path) -> bool:
+    """Physically create the folder path on disk. Returns whether the folder was
+    newly created, which is only tracked when :attr:`durability` is ``"full"``.
+    Flat stores have no directories to create, and directories already known to
+    exist aren't created again.
+
+    """
+    if self.flat or self._precreated or dir_path in self._dirs:
+      return False
+
+    # this is creating a directory, so we use dmode here.
+    perms = Permissions.create(self.dmode)
+    track = self.durability == "full"
+
+    created = False
 
     try:
-      # this is creating a directory, so we use dmode here.
-      perms = Permissions.create(self.dmode)
-      self.fs.makedirs(dir_path, permissions=perms, recreate=True)
+      self.metrics.incr("backend_calls", call="makedirs")
+      with self._span("makedirs", path=dir_path):
+        try:
+          self.fs.makedirs(dir_path, permissions=perms, recreate=not track)
+          created = track
+        except pyfs.errors.DirectoryExists:
+          # an ancestor may have appeared under us, so make sure of the rest.
+          self.fs.makedirs(dir_path, permissions=perms, recreate=True)
 
     except pyfs.errors.DirectoryExpected:
       assert self.fs.isdir(dir_path), "expected {} to be a directory".format(
           dir_path)
 
+    self._remember_dir(dir_path)
+    return created
+
+  def _remember_dir(self, dir_path: str) -> None:
+    """Record that the shard directory `dir_path` exists."""
+    if self.dir_cache == "none":
+      return None
+
+    self._dirs.add(dir_path)
+    # a directory pruned and recreated is already in the file.
+    if self.dir_cache == "persist" and dir_path not in self._persisted:
+      self._persisted.add(dir_path)
+      name = self._meta_path(_DIRS)
+      try:
+        self.fs.appendtext(name, dir_path + "\n")
+      except pyfs.errors.ResourceNotFound:
+        self.fs.makedirs(META_DIR, recreate=True)
+        self.fs.appendtext(name, dir_path + "\n")
+
+  def _load_dirs(self) -> None:
+    """Fill the directory cache from the persisted list, rewriting the list
+    without its duplicate lines if it has any."""
+    lines = (self._read_meta(_DIRS) or "").split()
+    self._persisted.update(lines)
+    self._dirs.update(lines)
+    if len(lines) > len(self._persisted):
+      self._write_meta(_DIRS,
+                       "".join(d + "\n" for d in sorted(self._persisted)))
+
+  def _forget_dirs(self, dir_path: str) -> None:
+    """Drop `dir_path` and its ancestors, which pruning may have removed, from
+    the directory cache. Persisted entries stay, so recreating the directory
+    doesn't append it again; a stale entry is corrected when a write into the
+    directory fails."""
+    dir_path = pyfs.path.relpath(dir_path)
+    while dir_path:
+      self._dirs.discard(dir_path)
+      dir_path = pyfs.path.dirname(dir_path)
+
   def _fs_path(self, k: Union[str, u.HashAddress]) -> Optional[str]:
     """Attempt to determine the real path of a file id or path through successive
     checking of candidate paths.
@@ -282,18 +1272,44 @@ class CASFS(object):
     if isinstance(k, u.HashAddress):
       k = k.relpath
 
+    with self._span("resolve", key=k) as span:
+      path = self._probe(k)
+      span.set_attribute("path", path)
+
+    return path
+
+  def _probe(self, k: str) -> Optional[str]:
+    """Return the path that the path or id `k` refers to, or None."""
     # Check if input was a fs path already.
+    self.metrics.incr("backend_calls", call="isfile")
     if self.fs.isfile(k):
       return k
 
     # Check if input was an ID.
     filepath = self._hashid_to_path(k)
+    self.metrics.incr("backend_calls", call="isfile")
     if self.fs.isfile(filepath):
       return filepath
 
+    # Check where an unfinished reshard may have left it.
+    if self._old_layout is not None:
+      filepath = pyfs.path.join(*u.shard(k, *self._old_layout))
+      self.metrics.incr("backend_calls", call="isfile")
+      if self.fs.isfile(filepath):
+        return filepath
+
     # Could not determine a match.
     return None
 
+  def _span(self, phase: str, **attributes):
+    """Open a ``casfs.<phase>`` span on :attr:`tracer`, tagged with the type of
+    the backing filesystem.
+
+    """
+    return self.tracer.span("casfs." + phase,
+                            backend=type(self.fs).__name__,
+                            **attributes)
+
   def _hashid_to_path(self, hashid: str) -> str:
     """Build the relative file path for a given hash id.
 
@@ -311,7 +1327,333 @@ class CASFS(object):
       raise ValueError("Cannot unshard path. The path {0!r} doesn't exist"
                        "in the filesystem. {1!r}")
 
-    return pyfs.path.splitext(path)[0].replace(os.sep, "")
+    return self._path_to_id(path)
+
+  def _path_to_id(self, path: str) -> str:
+    """Return the id of the object stored at `path`, without checking that it
+    exists."""
+    return pyfs.path.splitext(path)[0].replace("/", "")
+
+  def _sorted_files(self, after: Optional[str] = None) -> Iterable[Text]:
+    """Return generator that yields all files in the :attr:`fs` in lexicographic
+    order of their path components, which for a sharded store is hash order.
+
+    If `after` is supplied, only paths that sort strictly after it are
+    returned; subtrees that sort entirely before it are never listed.
+
+    """
+    cursor = tuple(after.split("/")) if after else ()
+
+    listing = self._list_objects()
+    if listing is not None:
+      # buckets list in lexicographic order already.
+      return (p for p, _ in listing if tuple(p.split("/")) > cursor)
+
+    def walk(dir_path, parts):
+      for info in sorted(self.fs.scandir(dir_path), key=lambda i: i.name):
+        child = parts + (info.name,)
+        if info.is_dir:
+          if parts or info.name != META_DIR:
+            if child >= cursor[:len(child)]:
+              yield from walk(pyfs.path.join(dir_path, info.name), child)
+
+        elif child > cursor:
+          yield "/".join(child)
+
+    return walk("/", ())
+
+  def _list_objects(self) -> Optional[Iterable[Tuple[str, int]]]:
+    """Return generator of ``(path, size)`` for every object in a flat store
+    from a single prefix listing, or None if that's not available."""
+    if not self.flat:
+      return None
+    return u.list_objects(self.fs, exclude=META_DIR)
+
+  def _hash_file(self,
+                 path: str,
+                 limiter: Optional[u.RateLimiter] = None) -> Tuple[str, int]:
+    """Compute the hash of the file at `path`, reading no faster than `limiter`
+    allows. Returns a pair of the hash and the number of bytes read.
+
+    """
+    (hashid,), nbytes = self._digest_file(path, [self.algorithm], limiter)
+    return hashid, nbytes
+
+  def _digest_file(
+      self,
+      path: str,
+      algorithms: Sequence[str],
+      limiter: Optional[u.RateLimiter] = None) -> Tuple[List[str], int]:
+    """Compute the digest of the file at `path` with each of `algorithms` in a
+    single read, no faster than `limiter` allows. Returns a pair of the digests
+    and the number of bytes read.
+
+    """
+    nbytes = [0]
+
+    def metered(stream):
+      for data in stream:
+        if limiter is not None:
+          limiter.consume(len(data))
+        nbytes[0] += len(data)
+        yield data
+
+    with closing(u.Stream(path, fs=self.fs)) as stream:
+      stream = metered(stream)
+      if self.metrics.enabled:
+        stream = self._counted(stream, "bytes_hashed")
+      digests = u.computehashes(stream, algorithms)
+
+    return digests, nbytes[0]
+
+  def _verify_checksums(
+      self, tracker: u.ProgressTracker, workers: int,
+      bytes_per_second: Optional[float]) -> List[Tuple[Text, u.HashAddress]]:
+    """The ``"checksums"`` mode of :meth:`verify`."""
+    listing = u.list_checksums(self.fs, exclude=META_DIR)
+    if listing is None:
+      raise ValueError("The backing filesystem doesn't report checksums.")
+    # otherwise every object would be read, and its digests rewritten, on
+    # every pass.
+    reported = [name for name, _ in u.BLOB_CHECKSUMS]
+    if not set(reported) & set(self.digests):
+      raise ValueError("Checksum verification needs one of the digests "
+                       "{}.".format(", ".join(reported)))
+    limiter = u.RateLimiter(bytes_per_second)
+
+    def annotated():
+      # one listing and one index per id prefix stand in for a sidecar read
+      # per object.
+      groups = itertools.groupby(listing,
+                                 key=lambda item: self._path_to_id(item[0])[:2])
+      for prefix, items in groups:
+        group = self._load_digest_index(prefix)
+        for path, reported in items:
+          yield group, path, reported
+
+    def check(item):
+      (_, index, sidecars, _), path, reported = item
+      hashid = self._path_to_id(path)
+      tag = sidecars.get(hashid)
+      entry = index.get(hashid)
+      if tag is None:
+        stored = {}
+      elif entry is not None and entry[0] == tag:
+        stored = entry[1]
+      else:
+        stored = self._load_digests(hashid)
+        index[hashid] = [tag, stored]
+
+      shared = [name for name in stored if name in reported]
+      if shared and all(stored[name] == reported[name] for name in shared):
+        return item[0], path, hashid, 0
+
+      # they disagree, or there's nothing to compare: read it.
+      names = [self.algorithm] + list(self.digests)
+      digests, nbytes = self._digest_file(path, names, limiter)
+      if digests[0] == hashid and self.digests:
+        # the content's fine, so the recorded digests were wrong or missing.
+        self._save_digests(hashid, dict(zip(self.digests, digests[1:])))
+        index.pop(hashid, None)
+      return item[0], path, digests[0], nbytes
+
+    corrupted = []
+    current = None
+    for group, path, hashid, nbytes in u.bounded_map(check, annotated(),
+                                                     workers):
+      # results arrive in order, so the last group is done with.
+      if group is not current:
+        if current is not None:
+          self._save_digest_index(current)
+        current = group
+
+      expected_path = self._hashid_to_path(hashid)
+      if pyfs.path.abspath(expected_path) != pyfs.path.abspath(path):
+        corrupted.append((path, u.HashAddress(hashid, expected_path)))
+      tracker.update(1, nbytes)
+
+    if current is not None:
+      self._save_digest_index(current)
+    tracker.finish()
+    return corrupted
+
+  def _scan(
+      self,
+      paths: Iterable[Text],
+      workers: int = 1,
+      bytes_per_second: Optional[float] = None
+  ) -> Iterable[Tuple[Text, str, int]]:
+    """Return generator that hashes every file in `paths` on a pool of `workers`
+    threads, yielding ``(path, hashid, nbytes)`` triples in input order.
+
+    Only a bounded number of files are in flight at once, so `paths` may be an
+    arbitrarily long lazy sequence.
+
+    """
+    limiter = u.RateLimiter(bytes_per_second)
+
+    def scan(path):
+      return (path,) + self._hash_file(path, limiter)
+
+    return u.bounded_map(scan, paths, workers)
+
+  def _stat_buckets(self) -> Iterable[Tuple[str, list]]:
+    """Return generator that yields ``(bucket, [(path, info), ...])`` for every
+    top-level directory of the store, in sorted order, with `info` carrying the
+    ``details`` namespace. Files at the root of the store share the bucket
+    ``"_"``.
+
+    """
+    top = []
+    for info in sorted(self.fs.scandir("/", namespaces=["details"]),
+                       key=lambda i: i.name):
+      if info.is_dir:
+        if info.name != META_DIR:
+          infos = self.fs.walk.info(pyfs.path.join("/", info.name),
+                                    namespaces=["details"])
+          yield info.name, [
+              (pyfs.path.relpath(p), i) for p, i in infos if i.is_file
+          ]
+      else:
+        top.append((info.name, info))
+
+    if top:
+      yield "_", top
+
+  def _load_fingerprints(self, bucket: str) -> dict:
+    """Return the fingerprint index for `bucket`, keyed by relative path."""
+    text = self._read_meta(pyfs.path.join(_FINGERPRINTS, bucket + ".json"))
+    return json.loads(text) if text else {}
+
+  def _save_fingerprints(self, bucket: str, index: dict) -> None:
+    """Persist the fingerprint index for `bucket`."""
+    name = pyfs.path.join(_FINGERPRINTS, bucket + ".json")
+    if index:
+      self._write_meta(name, json.dumps(index, sort_keys=True))
+    else:
+      self._remove_meta(name)
+
+  def _digests_name(self, hashid: str) -> str:
+    """Name of the bookkeeping file that holds the extra digests of `hashid`."""
+    return pyfs.path.join(_DIGESTS, hashid[:2], hashid + ".json")
+
+  def _load_digests(self, hashid: str) -> Dict[Text, Text]:
+    text = self._read_meta(self._digests_name(hashid))
+    return json.loads(text) if text else {}
+
+  def _save_digests(self, hashid: str, digests: Dict[Text, Text]) -> None:
+    self._write_meta(self._digests_name(hashid),
+                     json.dumps(digests, sort_keys=True))
+
+  def _load_digest_index(self, prefix: str) -> tuple:
+    """Return ``(prefix, index, sidecars, text)`` for the ids starting with
+    `prefix`: the cached sidecar contents, keyed by id, with the entries of
+    removed sidecars dropped; the checksums listed for each sidecar, keyed by
+    id; and the index as it was saved."""
+    listing = u.list_checksums(
+        self.fs, prefix=self._meta_path(pyfs.path.join(_DIGESTS, prefix))) or ()
+    sidecars = {
+        pyfs.path.basename(path)[:-len(".json")]: checksums
+        for path, checksums in listing
+    }
+    text = self._read_meta(pyfs.path.join(_DIGEST_INDEX, prefix + ".json"))
+    index = json.loads(text) if text else {}
+    index = {k: v for k, v in index.items() if k in sidecars}
+    return prefix, index, sidecars, text
+
+  def _save_digest_index(self, group: tuple) -> None:
+    """Persist the index from :meth:`_load_digest_index`, if it changed."""
+    prefix, index, _, text = group
+    name = pyfs.path.join(_DIGEST_INDEX, prefix + ".json")
+    if not index:
+      if text:
+        self._remove_meta(name)
+    elif json.dumps(index, sort_keys=True) != text:
+      self._write_meta(name, json.dumps(index, sort_keys=True))
+
+  def _remove_digests(self, path: str) -> None:
+    """Forget the extra digests of the object that was at `path`."""
+    if self.digests:
+      self._remove_meta(self._digests_name(self._path_to_id(path)))
+
+  def _load_config(self) -> dict:
+    """Return the store's config, or an empty dict if it has none.
+
+    Raises:
+      ValueError: If the config needs a newer version of casfs.
+
+    """
+    text = self._read_meta(CONFIG)
+    if not text:
+      return {}
+
+    config = json.loads(text)
+    unknown = set(config.get("features", ())) - set(FEATURES)
+    if config.get("version", 1) > _CONFIG_VERSION or unknown:
+      raise ValueError(
+          "Store needs a newer version of casfs (config version {}, features "
+          "{}).".format(config.get("version"), sorted(unknown)))
+    return config
+
+  def _save_config(self) -> None:
+    """Record the store's current layout, algorithm and features. A layout
+    passed to the constructor isn't recorded until the store's repaired or
+    resharded into it."""
+    depth, width = self._old_layout if self._relayout else (self.depth,
+                                                            self.width)
+    features = [
+        f for f, on in (("flat", self.flat), ("precreated", self._precreated))
+        if on
+    ]
+    config = {
+        "version": _CONFIG_VERSION,
+        "depth": depth,
+        "width": width,
+        "algorithm": self.algorithm,
+        "digest_size": self._hasher.digest_size,
+        "digests": list(self.digests),
+        "features": features
+    }
+    if self._old_layout is not None and not self._relayout:
+      config["reshard_from"] = list(self._old_layout)
+    self._write_meta(CONFIG, json.dumps(config, sort_keys=True))
+
+  def _ref_name(self, name: str) -> str:
+    """Name of the bookkeeping file that holds the pin `name`."""
+    if ".." in name.split("/"):
+      raise ValueError("Invalid pin name {!r}".format(name))
+    return pyfs.path.join(_REFS, name)
+
+  def _meta_path(self, name: str) -> str:
+    """Path of the bookkeeping file `name` inside :data:`META_DIR`."""
+    return pyfs.path.join(META_DIR, name)
+
+  def _read_meta(self, name: str) -> Optional[str]:
+    """Return the contents of the bookkeeping file `name`, or None if it doesn't
+    exist.
+
+    """
+    try:
+      return self.fs.readtext(self._meta_path(name))
+    except pyfs.errors.ResourceNotFound:
+      return None
+
+  def _write_meta(self, name: str, text: str) -> None:
+    """Replace the contents of the bookkeeping file `name` with `text`, creating
+    its directory the first time around."""
+    path = self._meta_path(name)
+    try:
+      self.fs.writetext(path, text)
+    except pyfs.errors.ResourceNotFound:
+      self.fs.makedirs(pyfs.path.dirname(path), recreate=True)
+      self.fs.writetext(path, text)
+
+  def _remove_meta(self, name: str) -> None:
+    """Remove the bookkeeping file `name`, if it exists."""
+    try:
+      self.fs.remove(self._meta_path(name))
+    except pyfs.errors.ResourceNotFound:
+      pass
 
   def _corrupted(self) -> Iterable[Tuple[Text, u.HashAddress]]:
     """Return generator that yields corrupted files as ``(path, address)``, where
@@ -319,10 +1661,7 @@ class CASFS(object):
     :class:`HashAddress` of the expected location.
 
     """
-    for path in self.files():
-      with closing(u.Stream(path, fs=self.fs)) as stream:
-        hashid = self._computehash(stream)
-
+    for path, hashid, _ in self._scan(self.files()):
       expected_path = self._hashid_to_path(hashid)
 
       if pyfs.path.abspath(expected_path) != pyfs.path.abspath(path):
@@ -330,3 +1669,14 @@ class CASFS(object):
             path,
             u.HashAddress(hashid, expected_path),
         )
+
+
+def _to_id(k: Key) -> str:
+  """Return the id of a key that's either an id or a :class:`HashAddress`."""
+  return k.id if isinstance(k, u.HashAddress) else k
+
+
+def _stat(info: Info) -> Tuple[int, Optional[float]]:
+  """Return the ``(size, mtime)`` pair that identifies an unchanged file."""
+  modified = info.modified
+  return (info.size, modified.timestamp() if modified else None)
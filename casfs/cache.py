@@ -0,0 +1,287 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Size-capped CASFS for use as a cache.
+
+:class:`CacheCASFS` tracks the size of its store and, once it grows past
+`max_size`, evicts objects on a background thread until it's back under a low
+watermark. Accesses through :meth:`open` and :meth:`get` are tracked in memory;
+objects are evicted in batches according to one of the :data:`POLICIES`. Pinned
+objects are never evicted.
+
+:meth:`CacheCASFS.load` makes the cache read-through: concurrent misses on the
+same id share a single fetch from the slower store behind the cache.
+
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional, Text
+
+import casfs.gc as g
+import casfs.singleflight as sf
+import casfs.util as u
+from casfs.base import CASFS, META_DIR, Key
+
+
+def _lru(entry, now):
+  return entry[1]
+
+
+def _lfu(entry, now):
+  return (entry[2], entry[1])
+
+
+def _size(entry, now):
+  # evict big, stale objects first.
+  return -entry[0] * (now - entry[1])
+
+
+# Eviction policies, as functions from an entry ``[size, last_access, hits]``
+# and the current time to a key; objects with the smallest keys go first.
+POLICIES = {"lru": _lru, "lfu": _lfu, "size": _size}
+
+
+class CacheCASFS(CASFS):
+  """CASFS that evicts objects to stay within `max_size` bytes.
+
+    Attributes:
+        max_size: Size in bytes above which eviction starts.
+        policy: Name of the eviction policy. ``"lru"`` evicts the least
+            recently accessed objects, ``"lfu"`` the least frequently accessed
+            and ``"size"`` the largest, weighted by time since last access.
+        low_water: Fraction of `max_size` that eviction brings the store down
+            to, so that eviction happens in batches rather than on every put.
+        background: If True (the default), evict on a background thread so that
+            puts never wait on eviction. Otherwise, call :meth:`evict`.
+
+  Remaining arguments are passed to :class:`casfs.CASFS`.
+
+  """
+
+  # Seconds between wakeups of the background evictor when nothing wakes it
+  # sooner; None waits for puts to push the store over capacity.
+  _evict_interval = None
+
+  def __init__(self,
+               root,
+               max_size: int,
+               policy: Text = "lru",
+               low_water: float = 0.9,
+               background: bool = True,
+               **kwargs):
+    if policy not in POLICIES:
+      raise ValueError("Unknown eviction policy {!r}".format(policy))
+
+    super(CacheCASFS, self).__init__(root, **kwargs)
+    self.max_size = max_size
+    self.policy = policy
+    self.low_water = low_water
+
+    self._lock = threading.Lock()
+    self._fills = sf.SingleFlight()
+    self._entries = {}
+    self._total = 0
+    self._load()
+
+    self._wake = threading.Event()
+    self._closed = False
+    self._thread = None
+    if background:
+      self._thread = threading.Thread(target=self._evict_loop,
+                                      name="casfs-evictor",
+                                      daemon=True)
+      self._thread.start()
+
+  @property
+  def current_size(self) -> int:
+    """Total size in bytes of the objects currently tracked."""
+    return self._total
+
+  def get(self, k: Key) -> Optional[u.HashAddress]:
+    address = super(CacheCASFS, self).get(k)
+    if address is None:
+      self.metrics.incr("cache_misses")
+    else:
+      self._touch(address.id)
+    return address
+
+  def open(self, k: Key):
+    try:
+      f = super(CacheCASFS, self).open(k)
+    except IOError:
+      self.metrics.incr("cache_misses")
+      raise
+
+    if isinstance(k, u.HashAddress):
+      k = k.relpath
+    self._touch(self._path_to_id(k))
+    return f
+
+  def load(self, hashid: Text, loader: Callable[[], Any]) -> u.HashAddress:
+    """Return the address of `hashid`, calling `loader` to fetch its content if
+    it isn't cached. Concurrent misses on the same id share one call to
+    `loader`.
+
+    Args:
+      hashid: Id of the object.
+      loader: Function of no arguments returning the object's content, as a
+        readable object (which is closed after use) or a path in :attr:`fs`.
+
+    Raises:
+      ValueError: If the loaded content doesn't hash to `hashid`.
+
+    """
+    # only a copy in this store counts, whatever subclasses consider a hit.
+    address = CacheCASFS.get(self, hashid)
+    if address is not None:
+      return address
+
+    def fill():
+      content = loader()
+      try:
+        # subclasses may do more on put than a fill should repeat.
+        ret = CASFS.put(self, content)
+      finally:
+        if hasattr(content, "close"):
+          content.close()
+
+      if ret.id != hashid:
+        raise ValueError("Loaded content for {} hashes to {}".format(
+            hashid, ret.id))
+      return ret
+
+    address, shared = self._fills.do(hashid, fill)
+    if shared:
+      self.metrics.incr("shared_fills")
+    return address
+
+  def evict(self) -> int:
+    """Evict objects until the store is under its low watermark. Returns the
+    number of objects evicted.
+
+    """
+    target = self.max_size * self.low_water
+    evicted = 0
+
+    while self._total > target:
+      pinned = set()
+      g.mark(self, pinned)
+      batch = self._victims(self._total - target, pinned)
+      if not batch:
+        logging.warning("Cache is over capacity, but everything is pinned.")
+        break
+
+      evicted += self._evict_batch(batch)
+
+    self.metrics.incr("evictions", evicted)
+    return evicted
+
+  def close(self) -> None:
+    """Stop the background evictor."""
+    self._closed = True
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _victims(self, excess: float, pinned) -> List[Text]:
+    """Return the ids to evict, in order, to free at least `excess` bytes."""
+    key = POLICIES[self.policy]
+    now = time.time()
+    with self._lock:
+      candidates = [(key(e, now), i, e[0])
+                    for i, e in self._entries.items()
+                    if i not in pinned]
+
+    ret, freed = [], 0
+    for _, hashid, size in sorted(candidates):
+      if freed >= excess:
+        break
+      ret.append(hashid)
+      freed += size
+    return ret
+
+  def _evict_batch(self, batch: List[Text]) -> int:
+    """Remove the objects with ids in `batch`. Returns the number removed."""
+    # subclasses may delete more than the local copies in delete_many.
+    evicted = CASFS.delete_many(self, [self._hashid_to_path(i) for i in batch])
+
+    # anything still tracked had already gone missing from the store.
+    with self._lock:
+      for hashid in batch:
+        entry = self._entries.pop(hashid, None)
+        if entry is not None:
+          self._total -= entry[0]
+
+    return evicted
+
+  def _evict_loop(self) -> None:
+    while True:
+      self._wake.wait(self._evict_interval)
+      self._wake.clear()
+      if self._closed:
+        return
+      try:
+        self.evict()
+      except Exception:  # pragma: no cover
+        logging.exception("Eviction failed.")
+
+  def _stored(self, address: u.HashAddress) -> None:
+    if address.is_duplicate:
+      self._touch(address.id)
+      return None
+
+    size = self.fs.getsize(address.relpath)
+    with self._lock:
+      if address.id not in self._entries:
+        self._total += size
+      self._entries[address.id] = [size, time.time(), 1]
+
+    if self._total > self.max_size:
+      self._wake.set()
+
+  def _touch(self, hashid: Text) -> None:
+    """Record an access of `hashid`."""
+    with self._lock:
+      entry = self._entries.get(hashid)
+      if entry is not None:
+        entry[1] = time.time()
+        entry[2] += 1
+
+    self.metrics.incr("cache_hits")
+
+  def _remove(self, path: str) -> bool:
+    removed = super(CacheCASFS, self)._remove(path)
+    if removed:
+      with self._lock:
+        entry = self._entries.pop(self._path_to_id(path), None)
+        if entry is not None:
+          self._total -= entry[0]
+    return removed
+
+  def _load(self) -> None:
+    """Build the in-memory index from the contents of the store. Objects
+    start out with their modification time as their last access."""
+    now = time.time()
+    for path, info in self.fs.walk.info(namespaces=["details"],
+                                        exclude_dirs=[META_DIR]):
+      if info.is_file:
+        modified = info.modified
+        atime = modified.timestamp() if modified else now
+        self._entries[self._path_to_id(
+            path.lstrip("/"))] = [info.size, atime, 0]
+        self._total += info.size
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Mark-and-sweep garbage collection for CASFS.
+
+Objects are kept alive by named pins (see :meth:`casfs.CASFS.pin`). A pin lists
+object ids; an id marked as a manifest refers to an object whose own content is
+a list of further references in the same format, so a whole tree of objects can
+be kept alive by pinning its root. A reference file holds one reference per
+line: a bare id, or an id prefixed with ``@`` for a manifest.
+
+:func:`collect` marks every object reachable from the pins, then sweeps the
+store in hash order, deleting unmarked objects that were last modified more than
+a grace period before the collection started. Just before each batch of
+deletions the collector rereads the pins, and it deletes each object under the
+store's lock for its id (see the `locks` argument of :class:`casfs.CASFS`)
+after checking that it wasn't modified, or put again through the same store,
+since the collection started. So objects written or put again while a
+collection runs, and objects pinned after marking, are never swept. Puts
+through other stores, like those in other processes, are only protected by the
+grace period. Marks are spilled to disk in buckets keyed by id
+prefix, so memory use is bounded by the size of one bucket rather than the size
+of the store.
+
+"""
+
+import logging
+import os
+import tempfile
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Set, Text, Tuple
+
+import fs as pyfs
+
+import casfs.util as u
+
+# Prefix marking a reference as a manifest.
+MANIFEST = "@"
+
+# Number of unreachable objects deleted per batch during the sweep.
+_SWEEP_BATCH = 10000
+
+
+class GCStats(
+    namedtuple("GCStats", ["marked", "deleted", "deleted_bytes", "recent"])):
+  """Outcome of a collection.
+
+    Attributes:
+        marked (int): Number of references followed during marking.
+        deleted (int): Number of objects deleted, or that would have been in a
+            dry run.
+        deleted_bytes (int): Total size of the deleted objects.
+        recent (int): Number of unreachable objects kept because they're younger
+            than the grace period.
+  """
+
+
+def parse_refs(text: Text) -> Iterable[Tuple[Text, bool]]:
+  """Return generator of ``(id, is_manifest)`` pairs for each reference in
+  `text`, in the reference file format.
+
+  """
+  for line in text.splitlines():
+    line = line.strip()
+    if line:
+      if line.startswith(MANIFEST):
+        yield line[len(MANIFEST):], True
+      else:
+        yield line, False
+
+
+def format_refs(ids: Iterable[Text], manifests: Iterable[Text] = ()) -> Text:
+  """Render references in the reference file format."""
+  lines = list(ids) + [MANIFEST + m for m in manifests]
+  return "".join(line + "\n" for line in lines)
+
+
+class MarkSet(object):
+  """Set of object ids that lives on local disk, partitioned into buckets by the
+  first `prefix_len` characters of each id.
+
+  Ids are buffered in memory and appended to their bucket's file once more than
+  `buffer_size` are pending. :meth:`bucket` loads a single bucket into memory.
+
+  """
+
+  def __init__(self, prefix_len: int = 2, buffer_size: int = 100000):
+    self.prefix_len = prefix_len
+    self.buffer_size = buffer_size
+    self._dir = tempfile.TemporaryDirectory(prefix="casfs-gc-")
+    self._buffers = {}
+    self._buffered = 0
+
+  def add(self, hashid: Text) -> None:
+    self._buffers.setdefault(hashid[:self.prefix_len], []).append(hashid)
+    self._buffered += 1
+    if self._buffered >= self.buffer_size:
+      self.flush()
+
+  def flush(self) -> None:
+    for prefix, ids in self._buffers.items():
+      with open(self._path(prefix), "a") as f:
+        f.write("".join(i + "\n" for i in ids))
+    self._buffers = {}
+    self._buffered = 0
+
+  def bucket(self, prefix: Text) -> Set[Text]:
+    """Return every id in the set that starts with `prefix`, which must be
+    `prefix_len` characters long."""
+    self.flush()
+    try:
+      with open(self._path(prefix)) as f:
+        return {line.rstrip("\n") for line in f}
+    except FileNotFoundError:
+      return set()
+
+  def close(self) -> None:
+    self._dir.cleanup()
+
+  def _path(self, prefix: Text) -> Text:
+    # prefixes are hex, but guard against anything that isn't a safe filename.
+    return os.path.join(self._dir.name, prefix.encode("utf8").hex() or "_")
+
+
+def read_pins(cas) -> Dict[Text, Text]:
+  """Return the contents of every pin of `cas`, by name."""
+  return {
+      name: cas._read_meta(cas._ref_name(name)) or "" for name in cas.pins()
+  }
+
+
+def mark(cas, marks: MarkSet, pins: Optional[Dict[Text, Text]] = None) -> int:
+  """Add every id reachable from the pins of `cas`, or from the pin contents in
+  `pins`, to `marks`, which may also be a plain set. Returns the number of
+  references followed.
+
+  Raises:
+    IOError: If a pinned manifest is missing. Nothing it refers to could be
+      marked, so it's not safe to sweep.
+
+  """
+  followed = 0
+  seen_manifests = set()
+  pending = []
+
+  if pins is None:
+    pins = read_pins(cas)
+  for text in pins.values():
+    pending.extend(parse_refs(text))
+
+  while pending:
+    hashid, is_manifest = pending.pop()
+    followed += 1
+    marks.add(hashid)
+
+    if is_manifest and hashid not in seen_manifests:
+      seen_manifests.add(hashid)
+      with cas.open(hashid) as f:
+        pending.extend(parse_refs(f.read().decode("utf8")))
+
+  return followed
+
+
+def collect(cas,
+            grace_period: float = 86400.0,
+            workers: int = 1,
+            dry_run: bool = False) -> GCStats:
+  """Delete every object in `cas` that isn't reachable from a pin and was last
+  modified more than `grace_period` seconds ago.
+
+  Args:
+    cas: The store to collect.
+    grace_period: Minimum age, in seconds, of an object before it's eligible for
+      deletion.
+    workers: Number of threads deleting objects concurrently.
+    dry_run: If True, only count what would be deleted.
+
+  Returns:
+    A :class:`GCStats`.
+
+  """
+  start = time.time()
+  cutoff = start - grace_period
+  marks = MarkSet()
+  cas._reputs = set()
+  try:
+    pins = read_pins(cas)
+    marked = mark(cas, marks, pins)
+    logging.info("GC marked %d references.", marked)
+
+    deleted, deleted_bytes, recent = 0, 0, 0
+    doomed = []
+
+    def sweep():
+      n, nbytes = _sweep(cas, doomed, workers, dry_run, start, pins)
+      return deleted + n, deleted_bytes + nbytes
+
+    for path in _unreachable(cas, marks):
+      info = cas.fs.getinfo(path, namespaces=["details"])
+      modified = info.modified
+      if modified is not None and modified.timestamp() > cutoff:
+        recent += 1
+        continue
+
+      doomed.append((path, info.size))
+      if len(doomed) >= _SWEEP_BATCH:
+        deleted, deleted_bytes = sweep()
+        doomed = []
+
+    deleted, deleted_bytes = sweep()
+    logging.info("GC deleted %d objects (%d bytes); kept %d recent.", deleted,
+                 deleted_bytes, recent)
+    return GCStats(marked, deleted, deleted_bytes, recent)
+
+  finally:
+    cas._reputs = None
+    marks.close()
+
+
+def _unreachable(cas, marks: MarkSet) -> Iterable[Text]:
+  """Return generator of the paths of objects in `cas` whose ids aren't in
+  `marks`, loading one bucket of marks at a time."""
+  prefix, bucket = None, set()
+  for path in cas._sorted_files():
+    hashid = cas._path_to_id(path)
+    if hashid[:marks.prefix_len] != prefix:
+      prefix = hashid[:marks.prefix_len]
+      bucket = marks.bucket(prefix)
+
+    if hashid not in bucket:
+      yield path
+
+
+def _sweep(cas, doomed: List[Tuple[Text, int]], workers: int, dry_run: bool,
+           start: float, pins: Dict[Text, Text]) -> Tuple[int, int]:
+  """Remove the objects in `doomed`, pairs of path and size, from `cas`, then
+  prune any directories left empty. Returns the number and total size of the
+  objects removed.
+
+  Objects reachable from pins that changed since marking, and objects modified
+  or put again since the collection started at `start`, are spared.
+
+  """
+  if dry_run or not doomed:
+    return len(doomed), sum(size for _, size in doomed)
+
+  # only pins that changed since marking can reach anything new.
+  late = set()
+  current = read_pins(cas)
+  mark(cas, late,
+       {n: text for n, text in current.items() if pins.get(n) != text})
+
+  def remove(item):
+    path, size = item
+    hashid = cas._path_to_id(path)
+    if hashid in late:
+      return None
+
+    # a put holds the same lock between finding the object and returning.
+    with cas._locks.hold(hashid):
+      if hashid in cas._reputs:
+        return None
+      try:
+        modified = cas.fs.getinfo(path, namespaces=["details"]).modified
+      except pyfs.errors.ResourceNotFound:
+        return None
+      if modified is not None and modified.timestamp() > start:
+        return None
+      if not cas._remove(path):
+        return None
+    cas._remove_digests(path)
+    return size
+
+  removed = [
+      size for size in u.bounded_map(remove, doomed, workers)
+      if size is not None
+  ]
+  cas.prune_empty({pyfs.path.dirname(p) for p, _ in doomed})
+  return len(removed), sum(removed)
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Registry of the hash algorithms a CASFS can address content by.
+
+Every algorithm :mod:`hashlib` guarantees is registered, along with a few much
+faster ones when their packages are installed: ``blake3`` (from `blake3`),
+``xxh3_128``, ``xxh3_64``, ``xxh64`` and ``xxh32`` (from `xxhash`) and
+``crc32c``, the checksum object stores report (from `google-crc32c`). Any other
+algorithm the local OpenSSL provides is registered on first use. More can be
+added with :func:`register`::
+
+  register("crc32", Crc32, digest_size=4)
+  cas = CASFS(root, algorithm="crc32")
+
+A hasher is any object with ``update(data)`` and ``hexdigest()`` methods, like
+a :mod:`hashlib` hash object. Ids are hex digests, so changing a store's
+algorithm changes every id in it; the algorithm is recorded in the store's
+config for that reason.
+
+"""
+
+import hashlib
+import threading
+from collections import namedtuple
+from typing import Any, Callable, List, Text
+
+try:
+  import blake3
+except ImportError:  # pragma: no cover
+  blake3 = None
+
+try:
+  import google_crc32c
+except ImportError:  # pragma: no cover
+  google_crc32c = None
+
+try:
+  import xxhash
+except ImportError:  # pragma: no cover
+  xxhash = None
+
+# Packages that provide the optional algorithms, for error messages.
+PACKAGES = {
+    "blake3": "blake3",
+    "crc32c": "google-crc32c",
+    "xxh3_128": "xxhash",
+    "xxh3_64": "xxhash",
+    "xxh64": "xxhash",
+    "xxh32": "xxhash",
+}
+
+
+class Hasher(
+    namedtuple("Hasher", ["name", "factory", "digest_size", "parallel"])):
+  """A registered hash algorithm.
+
+    Attributes:
+        name (str): Name stores refer to the algorithm by.
+        factory (callable): Returns a fresh hash object. Parallel hashers'
+            factories also accept a ``max_threads`` keyword argument.
+        digest_size (int): Size of a digest in bytes; ids are twice as long.
+        parallel (bool): Whether one hash object can use several threads.
+  """
+
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def register(name: Text,
+             factory: Callable[..., Any],
+             digest_size: int,
+             parallel: bool = False) -> Hasher:
+  """Register the algorithm `name`, replacing any hasher registered under that
+  name before. Returns the new :class:`Hasher`."""
+  ret = Hasher(name, factory, digest_size, parallel)
+  with _lock:
+    _registry[name] = ret
+  return ret
+
+
+def get(name: Text) -> Hasher:
+  """Return the hasher registered as `name`.
+
+  Raises:
+    ValueError: If no such algorithm is available here.
+
+  """
+  with _lock:
+    ret = _registry.get(name)
+  if ret is not None:
+    return ret
+
+  if name in hashlib.algorithms_available:
+    return _register_hashlib(name)
+
+  if name in PACKAGES:
+    raise ValueError("Hash algorithm {!r} needs the {!r} package.".format(
+        name, PACKAGES[name]))
+  raise ValueError("Unknown hash algorithm {!r}; available: {}.".format(
+      name, ", ".join(available())))
+
+
+def new(name: Text, threads: int = 1):
+  """Return a fresh hash object for the algorithm `name`, which may use up to
+  `threads` threads if the algorithm is parallel.
+
+  Raises:
+    ValueError: If no such algorithm is available here.
+
+  """
+  hasher = get(name)
+  if hasher.parallel and threads != 1:
+    return hasher.factory(max_threads=threads)
+  return hasher.factory()
+
+
+def available() -> List[Text]:
+  """Names of the registered algorithms, in sorted order."""
+  with _lock:
+    return sorted(_registry)
+
+
+class _Crc32c(object):
+  """CRC32C in the hashlib interface; the hex digest is big-endian, as in the
+  base64 checksums GCS reports."""
+
+  def __init__(self):
+    self._crc = 0
+
+  def update(self, data: bytes) -> None:
+    self._crc = google_crc32c.extend(self._crc, data)
+
+  def hexdigest(self) -> Text:
+    return "{:08x}".format(self._crc)
+
+
+def _register_hashlib(name: Text) -> Hasher:
+  return register(name, lambda: hashlib.new(name),
+                  hashlib.new(name).digest_size)
+
+
+# shake digests take a length, so they don't fit the hexdigest() interface.
+for _name in hashlib.algorithms_guaranteed:
+  if not _name.startswith("shake_"):
+    _register_hashlib(_name)
+
+if blake3 is not None:  # pragma: no cover
+  register("blake3", blake3.blake3, 32, parallel=True)
+
+if google_crc32c is not None:  # pragma: no cover
+  register("crc32c", _Crc32c, 4)
+
+if xxhash is not None:  # pragma: no cover
+  for _name, _size in (("xxh3_128", 16), ("xxh3_64", 8), ("xxh64", 8), ("xxh32",
+                                                                        4)):
+    if hasattr(xxhash, _name):
+      register(_name, getattr(xxhash, _name), _size)
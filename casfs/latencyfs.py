@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Filesystem wrapper that simulates a remote backend.
+
+:class:`LatencyFS` wraps any pyfilesystem FS, eg a `MemoryFS`, and delays every
+call into it as a remote store would: a fixed latency per round trip, optional
+random jitter and an optional cap on bandwidth for data read from or written to
+open files. It also counts calls, so tests can pin down how many round trips a
+CASFS operation costs::
+
+  remote = LatencyFS(MemoryFS(), latency=0.02, bandwidth=50 * 2**20)
+  cas = CASFS(remote)
+  cas.put(content)
+  remote.calls  # Counter({'isfile': 1, 'makedirs': 1, 'open': 1, 'move': 1})
+
+"""
+
+import functools
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Text
+
+from fs.base import FS
+from fs.wrapfs import WrapFS
+
+import casfs.util as u
+
+# Methods of the wrapped filesystem that count as one round trip each.
+CALLS = ("appendbytes", "appendtext", "copy", "create", "download", "exists",
+         "getinfo", "getsize", "isdir", "isfile", "listdir", "makedir",
+         "makedirs", "move", "open", "openbin", "readbytes", "readtext",
+         "remove", "removedir", "removetree", "scandir", "setinfo", "settimes",
+         "touch", "upload", "writebytes")
+
+
+class LatencyFS(WrapFS):
+  """Wrapper that delays and counts every call into `wrap_fs`.
+
+    Attributes:
+        latency: Seconds added to every call.
+        latencies: Optional dict of per-method latencies, eg
+            ``{"open": 0.05}``, overriding `latency` for those methods.
+        jitter: Extra delay, drawn uniformly from ``[0, jitter)`` seconds, added
+            to every call.
+        bandwidth: If supplied, bytes per second shared by every file opened
+            through this filesystem.
+        seed: Seed for the jitter, for reproducible runs.
+  """
+
+  def __init__(self,
+               wrap_fs: FS,
+               latency: float = 0.0,
+               latencies: Optional[Dict[Text, float]] = None,
+               jitter: float = 0.0,
+               bandwidth: Optional[float] = None,
+               seed: Optional[int] = None):
+    super(LatencyFS, self).__init__(wrap_fs)
+    self.latency = latency
+    self.latencies = latencies or {}
+    self.jitter = jitter
+    self.bandwidth = bandwidth
+
+    self._random = random.Random(seed)
+    self._limiter = u.RateLimiter(bandwidth, burst=1)
+    self._calls = Counter()
+    self._calls_lock = threading.Lock()
+
+  @property
+  def calls(self) -> Counter:
+    """Return a copy of the number of calls made to each method."""
+    with self._calls_lock:
+      return Counter(self._calls)
+
+  def reset(self) -> None:
+    """Zero the call counts."""
+    with self._calls_lock:
+      self._calls.clear()
+
+  def _call(self, name: Text) -> None:
+    """Record a call to `name` and sleep for its simulated latency."""
+    with self._calls_lock:
+      self._calls[name] += 1
+      delay = self.latencies.get(name, self.latency)
+      if self.jitter:
+        delay += self._random.uniform(0, self.jitter)
+
+    if delay > 0:
+      time.sleep(delay)
+
+  def _throttle(self, f):
+    return _ThrottledFile(f, self._limiter) if self.bandwidth else f
+
+
+def _delayed(name: Text):
+  method = getattr(WrapFS, name)
+
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    self._call(name)
+    ret = method(self, *args, **kwargs)
+    if name in ("open", "openbin"):
+      ret = self._throttle(ret)
+    return ret
+
+  return wrapper
+
+
+for _name in CALLS:
+  setattr(LatencyFS, _name, _delayed(_name))
+
+
+class _ThrottledFile(object):
+  """Proxy for an open file that charges every byte read or written against a
+  :class:`casfs.util.RateLimiter`.
+
+  """
+
+  def __init__(self, f, limiter: u.RateLimiter):
+    self._f = f
+    self._limiter = limiter
+
+  def read(self, *args):
+    data = self._f.read(*args)
+    self._limiter.consume(len(data))
+    return data
+
+  def readinto(self, b):
+    n = self._f.readinto(b)
+    self._limiter.consume(n or 0)
+    return n
+
+  def readline(self, *args):
+    data = self._f.readline(*args)
+    self._limiter.consume(len(data))
+    return data
+
+  def write(self, data):
+    self._limiter.consume(len(data))
+    return self._f.write(data)
+
+  def __iter__(self):
+    return iter(self.readline, self._f.read(0))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self._f.close()
+    return False
+
+  def __getattr__(self, name):
+    return getattr(self._f, name)
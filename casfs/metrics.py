@@ -0,0 +1,184 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Operation metrics for CASFS.
+
+A :class:`casfs.CASFS` reports to a metrics registry: per-operation latency,
+bytes hashed and written, duplicate puts, calls into the backing filesystem
+and errors. By default it reports to :data:`NULL`, whose methods do nothing,
+so instrumentation costs a few no-op calls per operation. To collect metrics,
+pass a :class:`Metrics`::
+
+  metrics = Metrics()
+  cas = CASFS(root, metrics=metrics)
+  ...
+  metrics.snapshot()       # plain dict
+  metrics.to_prometheus()  # Prometheus text exposition format
+
+Any object with the same `enabled`, `clock`, `incr` and `observe` members can be
+plugged in instead, to forward to another metrics system.
+
+"""
+
+import bisect
+import threading
+import time
+from typing import Any, Dict, Sequence, Text
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NullMetrics(object):
+  """Metrics registry that discards everything."""
+
+  enabled = False
+
+  def clock(self) -> float:
+    return 0.0
+
+  def incr(self, name: Text, n: float = 1, **labels: Text) -> None:
+    pass
+
+  def observe(self, op: Text, start: float) -> None:
+    pass
+
+
+NULL = NullMetrics()
+
+
+class Histogram(object):
+  """Cumulative latency histogram with fixed bucket bounds."""
+
+  def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def add(self, value: float) -> None:
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative(self) -> Dict[Text, int]:
+    """Return the number of observations at or below each bound, keyed by the
+    bound as Prometheus formats it, with ``"+Inf"`` last."""
+    ret, total = {}, 0
+    for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+      total += n
+      ret["+Inf" if bound == float("inf") else repr(bound)] = total
+    return ret
+
+
+class Metrics(object):
+  """Thread-safe in-memory metrics registry.
+
+    Attributes:
+        buckets: Upper bounds, in seconds, of the latency histogram buckets.
+  """
+
+  enabled = True
+
+  def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._latency = {}
+
+  def clock(self) -> float:
+    """Return a start time to pass to :meth:`observe`."""
+    return time.perf_counter()
+
+  def incr(self, name: Text, n: float = 1, **labels: Text) -> None:
+    """Add `n` to the counter `name` with the supplied labels."""
+    key = _series(name, labels)
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + n
+
+  def observe(self, op: Text, start: float) -> None:
+    """Record the latency of operation `op`, which began at `start`."""
+    elapsed = time.perf_counter() - start
+    with self._lock:
+      hist = self._latency.get(op)
+      if hist is None:
+        hist = self._latency[op] = Histogram(self.buckets)
+      hist.add(elapsed)
+
+  def counter(self, name: Text, **labels: Text) -> float:
+    """Return the current value of a counter."""
+    with self._lock:
+      return self._counters.get(_series(name, labels), 0)
+
+  def snapshot(self) -> Dict[Text, Any]:
+    """Return a dict of every counter and latency histogram, plus the fraction
+    of puts that found their content already stored.
+
+    """
+    with self._lock:
+      counters = dict(self._counters)
+      latency = {
+          op: {
+              "count": h.count,
+              "sum": h.sum,
+              "buckets": h.cumulative()
+          } for op, h in self._latency.items()
+      }
+
+    puts = counters.get("puts", 0)
+    return {
+        "counters":
+            counters,
+        "latency":
+            latency,
+        "duplicate_hit_rate":
+            counters.get("duplicates", 0) / puts if puts else 0.0
+    }
+
+  def to_prometheus(self, prefix: Text = "casfs") -> Text:
+    """Render every metric in the Prometheus text exposition format."""
+    snap = self.snapshot()
+    lines = []
+
+    typed = set()
+    for key in sorted(snap["counters"]):
+      name, _, labels = key.partition("{")
+      metric = "{}_{}_total".format(prefix, name)
+      if metric not in typed:
+        typed.add(metric)
+        lines.append("# TYPE {} counter".format(metric))
+      lines.append("{}{} {}".format(metric, "{" + labels if labels else "",
+                                    snap["counters"][key]))
+
+    if snap["latency"]:
+      metric = "{}_op_latency_seconds".format(prefix)
+      lines.append("# TYPE {} histogram".format(metric))
+      for op, h in sorted(snap["latency"].items()):
+        for le, n in h["buckets"].items():
+          lines.append('{}_bucket{{op="{}",le="{}"}} {}'.format(
+              metric, op, le, n))
+        lines.append('{}_sum{{op="{}"}} {}'.format(metric, op, h["sum"]))
+        lines.append('{}_count{{op="{}"}} {}'.format(metric, op, h["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def _series(name: Text, labels: Dict[Text, Text]) -> Text:
+  """Return the Prometheus-style series key for `name` and `labels`."""
+  if not labels:
+    return name
+  inner = ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+  return "{}{{{}}}".format(name, inner)
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""CASFS spread across many backing filesystems by consistent hashing.
+
+:class:`PartitionedCASFS` assigns each object to one of its named partitions
+with a consistent hash ring over the object's id, so capacity and IOPS scale
+with the number of partitions::
+
+  cas = PartitionedCASFS({"disk0": "/mnt/0/cas", "disk1": "/mnt/1/cas"})
+  cas.add_partition("disk2", "/mnt/2/cas")
+  cas.rebalance(workers=8)
+
+Adding or removing a partition only reassigns the ids on the arcs of the ring
+it gains or loses, about ``1/N`` of the objects. Until :meth:`rebalance` has
+moved them, reads that miss an id's new owner fall back to its previous one,
+and the partitions can't change again.
+Every partition records the ring's partition names, so the fallback survives a
+restart, and so does a change made by reopening with a different set of
+partitions. A removed partition has to be passed back in as `draining` for its
+objects to stay readable::
+
+  cas = PartitionedCASFS({"disk1": "/mnt/1/cas", "disk2": "/mnt/2/cas"},
+                         draining={"disk0": "/mnt/0/cas"})
+
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+from contextlib import closing
+from typing import Dict, Iterable, List, Mapping, Optional, Text, Tuple, Union
+
+import fs as pyfs
+
+import casfs.util as u
+from casfs.base import CASFS, Key
+
+# Number of points each partition gets on the ring. More points spread objects
+# more evenly.
+VNODES = 128
+
+# Name of the file inside each partition's META_DIR that records the names of
+# the ring's partitions and, while a rebalance is pending, those of the ring
+# before it.
+RING = "partitions.json"
+
+
+def _point(s: Text) -> int:
+  """Position of `s` on the ring."""
+  return int(hashlib.md5(u.to_bytes(s)).hexdigest()[:16], 16)
+
+
+class Ring(object):
+  """Consistent hash ring over partition names."""
+
+  def __init__(self, names: Iterable[Text], vnodes: int = VNODES):
+    self.names = sorted(set(names))
+    points = sorted((_point("{}#{}".format(name, i)), name)
+                    for name in self.names
+                    for i in range(vnodes))
+    self._points = [p for p, _ in points]
+    self._names = [name for _, name in points]
+
+  def owner(self, hashid: Text) -> Optional[Text]:
+    """Name of the partition that owns `hashid`, or None for an empty ring."""
+    if not self._points:
+      return None
+    i = bisect.bisect(self._points, _point(hashid)) % len(self._points)
+    return self._names[i]
+
+
+class PartitionedCASFS(object):
+  """Content addressable store partitioned across several stores.
+
+    Attributes:
+        partitions: Dict of partition name to :class:`casfs.CASFS`, or to a root
+            to build one from with the remaining keyword arguments. Names place
+            partitions on the ring, so keep them stable across restarts.
+        vnodes: Number of ring points per partition.
+        workers: Number of threads aggregating listings and sizes across
+            partitions. Defaults to one per partition.
+        draining: Partitions removed before a rebalance finished, in the same
+            form as `partitions`. Their objects stay readable until
+            :meth:`rebalance` moves them.
+
+  Keys are ids or :class:`casfs.HashAddress` instances; paths are only
+  meaningful within a single partition.
+
+  """
+
+  def __init__(self,
+               partitions: Mapping[Text, Union[CASFS, pyfs.base.FS, str]],
+               vnodes: int = VNODES,
+               workers: Optional[int] = None,
+               draining: Optional[Mapping[Text, Union[CASFS, pyfs.base.FS,
+                                                      str]]] = None,
+               **kwargs):
+    self._kwargs = kwargs
+    self.vnodes = vnodes
+    self.workers = workers
+    self.partitions = {}
+    for name, root in partitions.items():
+      self.partitions[name] = self._build(root)
+
+    self._ring = Ring(self.partitions, vnodes)
+    self._previous = None
+    self._draining = {}
+    self._load_ring(draining or {})
+
+  def put(self, content) -> u.HashAddress:
+    """Store the readable object `content` on the partition that owns its
+    id."""
+    algorithm = self._any().algorithm
+    with closing(u.Stream(content)) as stream:
+      hashid = u.computehash(stream, algorithm)
+      cas = self.partitions[self._ring.owner(hashid)]
+      # the content's already hashed, so skip straight to writing it.
+      path, is_duplicate = cas._copy(stream, hashid)
+
+    address = u.HashAddress(hashid, path, is_duplicate)
+    cas._stored(address)
+    return address
+
+  def get(self, k: Key) -> Optional[u.HashAddress]:
+    """Return the address of `k` within its partition, or None."""
+    for cas in self._candidates(k):
+      address = cas.get(self._id(k))
+      if address is not None:
+        return address
+    return None
+
+  def open(self, k: Key):
+    """Open `k` from its partition.
+
+    Raises:
+      IOError: If `k` isn't stored.
+
+    """
+    for cas in self._candidates(k):
+      try:
+        return cas.open(self._id(k))
+      except IOError:
+        pass
+    raise IOError("Could not locate file: {0}".format(k))
+
+  def exists(self, k: Key) -> bool:
+    return any(cas.exists(self._id(k)) for cas in self._candidates(k))
+
+  def delete(self, k: Key) -> None:
+    """Delete `k`, wherever a pending rebalance may have left it."""
+    for cas in self._candidates(k):
+      cas.delete(self._id(k))
+
+  def partition(self, k: Key) -> Text:
+    """Name of the partition that owns `k`."""
+    return self._ring.owner(self._id(k))
+
+  def add_partition(self, name: Text, root: Union[CASFS, pyfs.base.FS,
+                                                  str]) -> None:
+    """Add a partition. Call :meth:`rebalance` to move its share of the
+    objects onto it, before changing the partitions again."""
+    if name in self.partitions:
+      raise ValueError("Partition {!r} already exists".format(name))
+
+    self._remember_ring()
+    self.partitions[name] = self._build(root)
+    self._ring = Ring(self.partitions, self.vnodes)
+    self._save_ring()
+
+  def remove_partition(self, name: Text) -> CASFS:
+    """Stop placing objects on a partition. Its objects stay readable until
+    :meth:`rebalance` moves them to the remaining partitions, which has to
+    happen before the partitions change again. Returns the removed
+    partition."""
+    if len(self.partitions) == 1:
+      raise ValueError("Can't remove the last partition.")
+
+    self._remember_ring()
+    cas = self.partitions.pop(name)
+    self._draining[name] = cas
+    self._ring = Ring(self.partitions, self.vnodes)
+    self._save_ring()
+    return cas
+
+  def rebalance(self, workers: int = 1) -> int:
+    """Move every object that isn't on the partition that owns it there, and
+    empty any removed partitions. Returns the number of objects moved.
+
+    """
+    moved = 0
+    sources = list(self.partitions.items()) + list(self._draining.items())
+
+    for name, cas in sources:
+
+      def move(path, cas=cas):
+        owner = self.partitions[self._ring.owner(cas._path_to_id(path))]
+        with closing(cas.fs.open(path, "rb")) as f:
+          owner.put(f)
+        if cas._remove(path):
+          cas._remove_digests(path)
+        return path
+
+      misplaced = (p for p in cas._sorted_files()
+                   if self._ring.owner(cas._path_to_id(p)) != name)
+      dirs = set()
+      for path in u.bounded_map(move, misplaced, workers):
+        moved += 1
+        dirs.add(pyfs.path.dirname(path))
+      cas.prune_empty(dirs)
+
+    for cas in self._draining.values():
+      cas._remove_meta(RING)
+    self._previous = None
+    self._draining = {}
+    self._save_ring()
+    logging.info("Rebalance moved %d objects.", moved)
+    return moved
+
+  def files(self) -> Iterable[Tuple[Text, Text]]:
+    """Return generator of ``(partition, path)`` for every object, listing the
+    partitions concurrently."""
+    for name, paths in self._map(lambda cas: list(cas.files())):
+      for path in paths:
+        yield name, path
+
+  def count(self) -> int:
+    """Total number of objects across the partitions."""
+    return sum(n for _, n in self._map(lambda cas: cas.count()))
+
+  def size(self) -> int:
+    """Total size in bytes of the objects across the partitions."""
+    return sum(n for _, n in self._map(lambda cas: cas.size()))
+
+  def counts(self) -> Dict[Text, int]:
+    """Number of objects on each partition."""
+    return dict(self._map(lambda cas: cas.count()))
+
+  def __contains__(self, k: Key) -> bool:
+    return self.exists(k)
+
+  def __len__(self) -> int:
+    return self.count()
+
+  def _build(self, root) -> CASFS:
+    return root if isinstance(root, CASFS) else CASFS(root, **self._kwargs)
+
+  def _any(self) -> CASFS:
+    return next(iter(self.partitions.values()))
+
+  def _id(self, k: Key) -> Text:
+    if isinstance(k, u.HashAddress):
+      return k.id
+    return self._any()._path_to_id(k)
+
+  def _candidates(self, k: Key) -> List[CASFS]:
+    """Partitions that may hold `k`: its owner, then, while a rebalance is
+    pending, its previous owner."""
+    hashid = self._id(k)
+    ret = [self.partitions[self._ring.owner(hashid)]]
+    if self._previous is not None:
+      name = self._previous.owner(hashid)
+      previous = self.partitions.get(name) or self._draining.get(name)
+      if previous is not None and previous is not ret[0]:
+        ret.append(previous)
+    return ret
+
+  def _remember_ring(self) -> None:
+    """Keep the current ring for reads to fall back to.
+
+    Raises:
+      ValueError: If an earlier change is still waiting for
+        :meth:`rebalance`; objects put since then live on owners neither ring
+        would name.
+
+    """
+    if self._previous is not None:
+      raise ValueError("Call rebalance() before changing the partitions again.")
+    self._previous = self._ring
+
+  def _load_ring(self, draining) -> None:
+    """Restore the ring from before a pending rebalance from the partitions'
+    records. Partitions added or removed since the last open leave one
+    pending too."""
+    saved = dict(self._map(lambda cas: cas._read_meta(RING)))
+    records = [json.loads(text) for text in saved.values() if text]
+    current = sorted(self.partitions)
+
+    pending = next((r for r in records if r["previous"]), None)
+    if pending is not None:
+      if pending["partitions"] != current:
+        raise ValueError(
+            "Partitions {} are waiting for a rebalance; open the store with "
+            "those and rebalance() before changing them.".format(
+                pending["partitions"]))
+      previous = pending["previous"]
+    else:
+      previous = next(
+          (r["partitions"] for r in records if r["partitions"] != current),
+          None)
+
+    if previous is not None and previous != current:
+      self._previous = Ring(previous, self.vnodes)
+      for name in previous:
+        if name in draining:
+          self._draining[name] = self._build(draining[name])
+        elif name not in self.partitions:
+          logging.warning(
+              "Partition %r was removed before a rebalance; pass it as "
+              "draining= to keep its objects readable.", name)
+    self._save_ring(saved)
+
+  def _save_ring(self, saved: Optional[Dict[Text, Text]] = None) -> None:
+    """Record the ring on every partition, skipping the ones whose record in
+    `saved` is already up to date."""
+    previous = None if self._previous is None else self._previous.names
+    record = {"partitions": sorted(self.partitions), "previous": previous}
+    text = json.dumps(record, sort_keys=True)
+
+    saved = saved or {}
+    stale = [
+        cas for name, cas in self.partitions.items() if saved.get(name) != text
+    ]
+    workers = self.workers or len(self.partitions)
+    list(u.bounded_map(lambda cas: cas._write_meta(RING, text), stale, workers))
+
+  def _map(self, f) -> Iterable[Tuple[Text, object]]:
+    """Return generator of ``(name, f(partition))`` for every partition,
+    computed concurrently."""
+    items = list(self.partitions.items())
+    workers = self.workers or len(items)
+    return u.bounded_map(lambda item: (item[0], f(item[1])), items, workers)
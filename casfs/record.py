@@ -0,0 +1,263 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Recording and replay of CASFS operation traces.
+
+Attach a :class:`Recorder` to a store to log every public operation with its
+key, size, timing and calling thread::
+
+  recorder = Recorder()
+  cas = CASFS(root, recorder=recorder)
+  ...
+  recorder.save(open("trace.jsonl", "w"))
+
+then replay the trace against another store or configuration and compare the
+results::
+
+  ops = load(open("trace.jsonl"))
+  print(replay(ops, CASFS(other_root, depth=1, width=4), mode="open"))
+
+Content isn't recorded. Replayed puts store deterministic synthetic content of
+the recorded size, and later operations on a recorded id are redirected to the
+id of its replacement.
+
+"""
+
+import json
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Dict, IO, Iterable, List, Optional, Text
+
+import casfs.util as u
+
+# Size of the synthetic objects created for ids that a trace reads without
+# having put them first.
+DEFAULT_SIZE = 1024
+
+
+class Op(
+    namedtuple("Op",
+               ["op", "key", "size", "start", "duration", "thread", "error"])):
+  """One recorded CASFS operation.
+
+    Attributes:
+        op (str): Name of the operation: put, get, open, exists or delete.
+        key (str): Id (or path) the operation referred to. For puts, the id of
+            the stored object.
+        size (int, optional): Size in bytes of the object stored by a put.
+        start (float): Seconds between the start of the recording and the start
+            of the operation.
+        duration (float): Seconds the operation took.
+        thread (int): Small integer identifying the calling thread.
+        error (bool): Whether the operation raised.
+  """
+
+
+class Recorder(object):
+  """Thread-safe log of the operations performed on the stores it's attached
+  to. Recording a put costs an extra `getsize` call on the backing filesystem.
+
+  """
+
+  def __init__(self):
+    self.ops = []
+    self._lock = threading.Lock()
+    self._threads = {}
+    self._t0 = time.perf_counter()
+
+  def clock(self) -> float:
+    return time.perf_counter()
+
+  def record(self, cas, op: Text, args, ret, begin: float,
+             error: Optional[Exception]) -> None:
+    """Log one call to `op` on `cas`, which took `args`, returned `ret` and
+    started at `begin`, as returned by :meth:`clock`."""
+    end = self.clock()
+    size = None
+
+    if op == "put":
+      key = ret.id if ret is not None else None
+      if ret is not None:
+        size = cas.fs.getsize(ret.relpath)
+    else:
+      key = args[0] if args else None
+      if isinstance(key, u.HashAddress):
+        key = key.id
+
+    with self._lock:
+      thread = self._threads.setdefault(threading.get_ident(),
+                                        len(self._threads))
+      self.ops.append(
+          Op(op, key, size, begin - self._t0, end - begin, thread,
+             error is not None))
+
+  def save(self, f: IO[Text]) -> None:
+    """Write the trace to `f` as JSON lines."""
+    with self._lock:
+      ops = list(self.ops)
+    for o in ops:
+      f.write(json.dumps(o._asdict()) + "\n")
+
+
+def load(f: IO[Text]) -> List[Op]:
+  """Read a trace written by :meth:`Recorder.save`."""
+  return [Op(**json.loads(line)) for line in f if line.strip()]
+
+
+class ReplayResult(namedtuple("ReplayResult", ["ops", "elapsed", "latency"])):
+  """Outcome of a replay.
+
+    Attributes:
+        ops (int): Number of operations replayed.
+        elapsed (float): Wall-clock seconds the replay took.
+        latency (dict): For each operation name, a dict of ``count`` and the
+            ``p50``, ``p90``, ``p99`` and ``max`` latency in seconds.
+  """
+
+  @property
+  def throughput(self) -> float:
+    """Operations per second."""
+    return self.ops / self.elapsed if self.elapsed else 0.0
+
+
+def _content(key: Text, size: int) -> BytesIO:
+  """Deterministic content of `size` bytes, distinct for each `key`."""
+  prefix = u.to_bytes(key or "")[:size]
+  return BytesIO(prefix + bytes(size - len(prefix)))
+
+
+class _Replayer(object):
+  """Issues recorded ops against `cas`, keeping track of the ids of replayed
+  puts and the latency of every op.
+
+  """
+
+  def __init__(self, cas, ops: List[Op]):
+    self.cas = cas
+    self.ids = {}
+    self.latencies = {}
+    self._lock = threading.Lock()
+
+    # objects read before they're put must exist before the replay starts.
+    put = set()
+    for o in ops:
+      if o.op == "put":
+        put.add(o.key)
+      elif o.key is not None and o.key not in put and o.key not in self.ids:
+        if not o.error:
+          self.ids[o.key] = cas.put(_content(o.key, DEFAULT_SIZE)).id
+
+  def run(self, o: Op, scheduled: Optional[float] = None) -> None:
+    """Issue `o`, timing it from `scheduled` if supplied, else from now."""
+    start = time.perf_counter() if scheduled is None else scheduled
+    try:
+      if o.op == "put":
+        ret = self.cas.put(_content(o.key, o.size or 0))
+        with self._lock:
+          self.ids[o.key] = ret.id
+      else:
+        key = self.ids.get(o.key, o.key)
+        ret = getattr(self.cas, o.op)(key)
+        if o.op == "open":
+          with ret as f:
+            while f.read(2**20):
+              pass
+    except IOError:
+      # recorded misses miss again.
+      pass
+
+    elapsed = time.perf_counter() - start
+    with self._lock:
+      self.latencies.setdefault(o.op, []).append(elapsed)
+
+  def summary(self) -> Dict[Text, Dict[Text, Any]]:
+    ret = {}
+    for op, xs in self.latencies.items():
+      xs = sorted(xs)
+      ret[op] = {
+          "count": len(xs),
+          "p50": _percentile(xs, 0.5),
+          "p90": _percentile(xs, 0.9),
+          "p99": _percentile(xs, 0.99),
+          "max": xs[-1]
+      }
+    return ret
+
+
+def _percentile(xs: List[float], q: float) -> float:
+  return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+def replay(ops: Iterable[Op],
+           cas,
+           mode: Text = "closed",
+           workers: int = 32,
+           speed: float = 1.0) -> ReplayResult:
+  """Replay a recorded trace against `cas`.
+
+  Args:
+    ops: Recorded operations, as produced by a :class:`Recorder` or
+      :func:`load`.
+    cas: Store to replay against.
+    mode: ``"closed"`` replays each recorded thread's operations back to back
+      on its own thread, preserving the recorded concurrency; throughput is
+      whatever the store sustains. ``"open"`` issues every operation at its
+      recorded start time, divided by `speed`, whether or not earlier ones have
+      finished, and measures latency from that scheduled time.
+    workers: In open mode, the maximum number of operations in flight.
+    speed: In open mode, factor by which to speed up the recorded arrival rate.
+
+  Returns:
+    A :class:`ReplayResult`.
+
+  """
+  if mode not in ("open", "closed"):
+    raise ValueError("Unknown replay mode {!r}".format(mode))
+
+  ops = sorted(ops, key=lambda o: o.start)
+  replayer = _Replayer(cas, ops)
+  t0 = time.perf_counter()
+
+  if mode == "closed":
+    by_thread = {}
+    for o in ops:
+      by_thread.setdefault(o.thread, []).append(o)
+
+    def run_all(thread_ops):
+      for o in thread_ops:
+        replayer.run(o)
+
+    threads = [
+        threading.Thread(target=run_all, args=(xs,))
+        for xs in by_thread.values()
+    ]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+
+  else:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      for o in ops:
+        scheduled = t0 + o.start / speed
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+        pool.submit(replayer.run, o, scheduled)
+
+  return ReplayResult(len(ops), time.perf_counter() - t0, replayer.summary())
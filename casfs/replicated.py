@@ -0,0 +1,407 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""CASFS replicated across several independent filesystems.
+
+:class:`ReplicatedCASFS` writes every object to all of its replicas in parallel
+and returns once a quorum of them has it. Reads go to every replica at once, or
+with `hedge_after`, to the replica that's been fastest lately and then to the
+next one only if the first is slow to answer::
+
+  cas = ReplicatedCASFS(["/mnt/a/cas", "/mnt/b/cas", "gs://bucket/cas"],
+                        hedge_after=0.05)
+  cas.start(period=3600)
+
+Replicas that missed a write, eg because they were down, are brought back in
+line by :meth:`ReplicatedCASFS.anti_entropy`, which merges the replicas'
+listings in hash order and copies every object to the replicas lacking it.
+
+"""
+
+import heapq
+import io
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                as_completed, wait)
+from contextlib import closing
+from typing import Any, Callable, List, Optional, Sequence, Union
+
+import fs as pyfs
+
+import casfs.metrics as m
+import casfs.util as u
+from casfs.base import CASFS, Key
+
+# Size in bytes up to which content being put is buffered in memory rather than
+# in a local temp file, while the replicas read it.
+_SPOOL_MEMORY = 2**24
+
+# Weight of the latest call in each replica's moving average latency.
+_LATENCY_WEIGHT = 0.2
+
+# Threads per replica, and the number of calls that may be queued or running on
+# a replica before further calls to it fail straight away. Each replica has its
+# own threads, so a slow or hung replica can't hold up the others.
+_REPLICA_WORKERS = 4
+_MAX_OUTSTANDING = 64
+
+
+class _Spool(object):
+  """Content read once, from which each replica can read its own copy."""
+
+  def __init__(self, content, max_memory: int = _SPOOL_MEMORY):
+    self._data, self._path = None, None
+    buf, f = io.BytesIO(), None
+
+    with closing(u.Stream(content)) as stream:
+      for data in stream:
+        data = u.to_bytes(data)
+        if f is None and buf.tell() + len(data) > max_memory:
+          fd, self._path = tempfile.mkstemp(prefix="casfs-spool-")
+          f = os.fdopen(fd, "wb")
+          f.write(buf.getvalue())
+        (buf if f is None else f).write(data)
+
+    if f is None:
+      self._data = buf.getvalue()
+    else:
+      f.close()
+
+  def open(self) -> io.IOBase:
+    if self._path is None:
+      return io.BytesIO(self._data)
+    return open(self._path, "rb")
+
+  def close(self) -> None:
+    if self._path is not None:
+      os.remove(self._path)
+
+
+class ReplicatedCASFS(object):
+  """Content addressable store kept on several replicas.
+
+    Attributes:
+        replicas: The replicas, as :class:`casfs.CASFS` instances or roots to
+            build them from with the remaining keyword arguments.
+        write_quorum: Number of replicas that must have stored an object before
+            :meth:`put` returns. The remaining writes finish in the background.
+            Defaults to a majority.
+        hedge_after: If supplied, reads go to the replica with the lowest recent
+            latency first, and to the next one each time `hedge_after` seconds
+            pass without an answer. Otherwise, reads go to every replica at
+            once and the first to answer wins.
+        metrics: Registry that replica errors, hedged reads and repairs are
+            counted in; see :mod:`casfs.metrics`.
+
+  Every replica has its own small thread pool. A replica with too many calls
+  outstanding, because it's slow or hung, fails further calls at once: reads
+  count them as misses and writes as errors against the quorum.
+
+  Deletes wait for every replica, since a replica that still had the object
+  would hand it back to the others on the next anti-entropy pass.
+
+  """
+
+  def __init__(self,
+               replicas: Sequence[Union[CASFS, pyfs.base.FS, str]],
+               write_quorum: Optional[int] = None,
+               hedge_after: Optional[float] = None,
+               metrics: Optional[m.Metrics] = None,
+               **kwargs):
+    if not replicas:
+      raise ValueError("A replicated store needs at least one replica.")
+
+    self.replicas = [
+        r if isinstance(r, CASFS) else CASFS(r, **kwargs) for r in replicas
+    ]
+    n = len(self.replicas)
+    self.write_quorum = n // 2 + 1 if write_quorum is None else write_quorum
+    if not 1 <= self.write_quorum <= n:
+      raise ValueError("Write quorum must be between 1 and {}.".format(n))
+
+    self.hedge_after = hedge_after
+    self.metrics = metrics or m.NULL
+
+    self._pools = [
+        ThreadPoolExecutor(max_workers=_REPLICA_WORKERS,
+                           thread_name_prefix="casfs-replica-{}".format(i))
+        for i in range(n)
+    ]
+    self._outstanding = [0] * n
+    self._latency = [0.0] * n
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def put(self, content) -> u.HashAddress:
+    """Store the contents of the readable object `content` on every replica.
+
+    Returns:
+      The object's hash address, once :attr:`write_quorum` replicas have it. It
+      only counts as a duplicate if every acknowledging replica had it already.
+
+    Raises:
+      IOError: If too many replicas fail for the quorum to be reached.
+
+    """
+    spool = _Spool(content)
+
+    def put(cas):
+      with closing(spool.open()) as f:
+        return cas.put(f)
+
+    futures = self._submit_all(put)
+    self._when_done(futures, spool.close)
+
+    acks, errors = [], []
+    for f in as_completed(futures):
+      if f.exception() is None:
+        acks.append(f.result())
+        if len(acks) >= self.write_quorum:
+          break
+      else:
+        errors.append(f.exception())
+        if len(errors) > len(futures) - self.write_quorum:
+          raise IOError("Put reached {} of {} replicas needed.".format(
+              len(acks), self.write_quorum)) from errors[0]
+
+    return acks[0]._replace(is_duplicate=all(a.is_duplicate for a in acks))
+
+  def get(self, k: Key) -> Optional[u.HashAddress]:
+    """Return the address of `k` from the first replica that has it, or None."""
+    return self._read(lambda cas: cas.get(k))
+
+  def open(self, k: Key) -> io.IOBase:
+    """Open `k` on the first replica that has it.
+
+    Raises:
+      IOError: If no replica has `k`.
+
+    """
+
+    def open_(cas):
+      try:
+        return cas.open(k)
+      except IOError:
+        return None
+
+    f = self._read(open_, discard=lambda f: f.close())
+    if f is None:
+      raise IOError("Could not locate file: {0}".format(k))
+    return f
+
+  def exists(self, k: Key) -> bool:
+    """Check whether any replica has `k`."""
+    return bool(self._read(lambda cas: cas.exists(k)))
+
+  def delete(self, k: Key) -> None:
+    """Delete `k` from every replica.
+
+    Raises:
+      IOError: If any replica fails to delete it.
+
+    """
+    futures = self._submit_all(lambda cas: cas.delete(k))
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+      raise IOError("Delete failed on {} replicas.".format(
+          len(errors))) from errors[0]
+
+  def anti_entropy(self, workers: int = 1) -> int:
+    """Copy every object missing from a replica to it from one that has it.
+
+    The replicas are listed in hash order and their listings merged, so memory
+    use doesn't grow with the size of the store.
+
+    Returns:
+      The number of copies made.
+
+    """
+    n = len(self.replicas)
+
+    def ids(i):
+      cas = self.replicas[i]
+      return ((cas._path_to_id(p), i) for p in cas._sorted_files())
+
+    def missing():
+      merged = heapq.merge(*[ids(i) for i in range(n)])
+      for hashid, group in itertools.groupby(merged, key=lambda x: x[0]):
+        holders = {i for _, i in group}
+        if len(holders) < n:
+          yield hashid, holders
+
+    def repair(item):
+      hashid, holders = item
+      source = self.replicas[min(holders)]
+      for i in range(n):
+        if i not in holders:
+          with closing(source.open(hashid)) as f:
+            self.replicas[i].put(f)
+      return n - len(holders)
+
+    copies = sum(u.bounded_map(repair, missing(), workers))
+    self.metrics.incr("replicas_repaired", copies)
+    logging.info("Anti-entropy made %d copies.", copies)
+    return copies
+
+  def start(self, period: float = 3600.0) -> "ReplicatedCASFS":
+    """Run :meth:`anti_entropy` every `period` seconds on a daemon thread."""
+
+    def run():
+      while not self._stop.wait(period):
+        try:
+          self.anti_entropy()
+        except Exception:  # pragma: no cover
+          logging.exception("Anti-entropy pass failed.")
+
+    self._stop.clear()
+    self._thread = threading.Thread(target=run,
+                                    name="casfs-anti-entropy",
+                                    daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self, timeout: Optional[float] = None) -> None:
+    """Stop the anti-entropy thread."""
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join(timeout)
+      self._thread = None
+
+  def close(self) -> None:
+    """Stop background work and wait for outstanding writes."""
+    self.stop()
+    for pool in self._pools:
+      pool.shutdown(wait=True)
+
+  def __contains__(self, k: Key) -> bool:
+    return self.exists(k)
+
+  def _submit_all(self, f: Callable[[CASFS], Any]) -> List:
+    return [self._submit(i, f) for i in range(len(self.replicas))]
+
+  def _submit(self, i: int, f: Callable[[CASFS], Any]) -> Future:
+    """Call `f` on replica `i` on that replica's threads, unless it has too many
+    calls outstanding, in which case the returned future has already failed."""
+    with self._lock:
+      saturated = self._outstanding[i] >= _MAX_OUTSTANDING
+      if not saturated:
+        self._outstanding[i] += 1
+
+    if saturated:
+      self.metrics.incr("replicas_saturated")
+      ret = Future()
+      ret.set_exception(IOError("Replica {} is saturated.".format(i)))
+      return ret
+
+    def done(_):
+      with self._lock:
+        self._outstanding[i] -= 1
+
+    ret = self._pools[i].submit(self._timed, i, f)
+    ret.add_done_callback(done)
+    return ret
+
+  def _timed(self, i: int, f: Callable[[CASFS], Any]) -> Any:
+    """Call `f` on replica `i`, folding its latency into the replica's moving
+    average."""
+    start = time.monotonic()
+    try:
+      return f(self.replicas[i])
+    except Exception:
+      self.metrics.incr("replica_errors")
+      raise
+    finally:
+      elapsed = time.monotonic() - start
+      with self._lock:
+        self._latency[i] += _LATENCY_WEIGHT * (elapsed - self._latency[i])
+
+  def _when_done(self, futures: List, f: Callable[[], Any]) -> None:
+    """Call `f` once every one of `futures` has finished."""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+      if future.exception() is not None:
+        logging.warning("Replica write failed: %s", future.exception())
+      with lock:
+        remaining[0] -= 1
+        last = remaining[0] == 0
+      if last:
+        f()
+
+    for future in futures:
+      future.add_done_callback(done)
+
+  def _read(self,
+            f: Callable[[CASFS], Any],
+            discard: Optional[Callable[[Any], Any]] = None) -> Any:
+    """Return the first truthy result of calling `f` on the replicas, or the
+    last falsey one if none has a truthy result. Replicas that raise count as
+    misses. Results that lose the race are passed to `discard`.
+
+    """
+    with self._lock:
+      order = sorted(range(len(self.replicas)), key=self._latency.__getitem__)
+    order = iter(order)
+    pending = set()
+    exhausted = [False]
+
+    def launch():
+      i = next(order, None)
+      if i is None:
+        exhausted[0] = True
+      else:
+        pending.add(self._submit(i, f))
+      return i is not None
+
+    if self.hedge_after is None:
+      while launch():
+        pass
+    else:
+      launch()
+
+    def loser(future):
+      if future.exception() is None and future.result() and discard:
+        discard(future.result())
+
+    ret = None
+    while pending:
+      timeout = None if exhausted[0] else self.hedge_after
+      done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+      if not done:
+        if launch():
+          self.metrics.incr("hedged_reads")
+        continue
+
+      for future in done:
+        pending.discard(future)
+        if future.exception() is None:
+          ret = future.result()
+          if ret:
+            for other in pending:
+              other.add_done_callback(loser)
+            return ret
+
+      # everyone asked so far missed; try the next replica right away.
+      if not pending:
+        launch()
+
+    return ret
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Background scrubber that continuously checks a CASFS for bit rot.
+
+The scrubber walks the store in hash order, rehashing each object at no more
+than a fixed number of bytes per second, and remembers its position inside the
+store so that a restarted scrubber picks up where the last one stopped. It can
+run as a thread inside a long-lived process::
+
+  scrubber = Scrubber(cas, bytes_per_second=50 * 2**20, period=86400)
+  scrubber.start()
+
+or as a daemon from the command line::
+
+  python -m casfs.scrub /path/to/store --bytes-per-second 52428800
+
+"""
+
+import argparse
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence, Text, Tuple
+
+import fs as pyfs
+
+import casfs.util as u
+from casfs.base import CASFS, META_DIR
+
+# Name of the cursor file inside the store's META_DIR, the number of objects
+# scrubbed between writes of the cursor, and the directory inside META_DIR that
+# quarantined objects are moved into.
+CURSOR = "scrub.cursor"
+CURSOR_EVERY = 100
+QUARANTINE = "quarantine"
+
+# Minimum number of seconds :meth:`Scrubber.run` waits between passes, so that
+# a small or empty store isn't listed in a tight loop.
+MIN_PAUSE = 60.0
+
+Corruption = Tuple[Text, u.HashAddress]
+
+
+class Scrubber(object):
+  """Rate-limited verifier for every object in a :class:`CASFS`.
+
+    Attributes:
+        cas: The store to scrub.
+        bytes_per_second: Cap on the rate at which object contents are read.
+            `None` means unthrottled.
+        period: If supplied, :meth:`run` starts a new pass at most once every
+            `period` seconds, so that the whole store is verified on a fixed
+            cadence. Passes are always at least :data:`MIN_PAUSE` seconds
+            apart.
+        quarantine: If True, corrupt objects are moved out of the store into
+            ``.casfs/quarantine``, keeping their relative path.
+        on_corrupt: Callback invoked with ``(path, address)`` for every corrupt
+            object, where `address` is where the content actually belongs.
+            Defaults to logging a warning.
+        progress: Optional callback that receives a :class:`casfs.util.Progress`
+            for the current pass every few seconds.
+
+  """
+
+  def __init__(self,
+               cas: CASFS,
+               bytes_per_second: Optional[float] = None,
+               period: Optional[float] = None,
+               quarantine: bool = False,
+               on_corrupt: Optional[Callable[[Text, u.HashAddress],
+                                             Any]] = None,
+               progress: Optional[Callable[[u.Progress], Any]] = None):
+    self.cas = cas
+    self.bytes_per_second = bytes_per_second
+    self.period = period
+    self.quarantine = quarantine
+    self.on_corrupt = on_corrupt or _log_corrupt
+    self.progress = progress
+
+    self._stop = threading.Event()
+    self._thread = None
+
+  def run_once(self) -> List[Corruption]:
+    """Finish the current pass over the store, starting from the persisted
+    cursor if there is one. Returns the corrupt objects found.
+
+    A pass interrupted by :meth:`stop` returns early and leaves the cursor in
+    place for the next one.
+
+    """
+    cas = self.cas
+    cursor = cas._read_meta(CURSOR)
+    tracker = u.ProgressTracker(self.progress, interval=5.0)
+    corrupted = []
+
+    paths = cas._sorted_files(after=cursor)
+    for path, hashid, nbytes in cas._scan(
+        paths, bytes_per_second=self.bytes_per_second):
+      expected_path = cas._hashid_to_path(hashid)
+
+      if pyfs.path.abspath(expected_path) != pyfs.path.abspath(path):
+        address = u.HashAddress(hashid, expected_path)
+        corrupted.append((path, address))
+        self.on_corrupt(path, address)
+        if self.quarantine:
+          self._quarantine(path)
+
+      tracker.update(1, nbytes)
+      if tracker.objects % CURSOR_EVERY == 0:
+        cas._write_meta(CURSOR, path)
+
+      if self._stop.is_set():
+        cas._write_meta(CURSOR, path)
+        return corrupted
+
+    cas._remove_meta(CURSOR)
+    tracker.finish()
+    return corrupted
+
+  def run(self) -> None:
+    """Scrub pass after pass until :meth:`stop` is called."""
+    while not self._stop.is_set():
+      start = time.monotonic()
+      self.run_once()
+
+      pause = MIN_PAUSE
+      if self.period is not None:
+        pause = max(pause, self.period - (time.monotonic() - start))
+      self._stop.wait(pause)
+
+  def start(self) -> "Scrubber":
+    """Run the scrubber on a daemon thread. Returns the scrubber."""
+    self._stop.clear()
+    self._thread = threading.Thread(target=self.run,
+                                    name="casfs-scrubber",
+                                    daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self, timeout: Optional[float] = None) -> None:
+    """Ask the scrubber to stop after the object it's reading, and wait up to
+    `timeout` seconds for its thread to exit.
+
+    """
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join(timeout)
+      self._thread = None
+
+  def _quarantine(self, path: Text) -> None:
+    """Move the object at `path` out of the store proper."""
+    dest = pyfs.path.join(META_DIR, QUARANTINE, path)
+    self.cas.fs.makedirs(pyfs.path.dirname(dest), recreate=True)
+    self.cas.fs.move(path, dest, overwrite=True)
+    self.cas._remove_digests(path)
+    self.cas._remove_empty(pyfs.path.dirname(path))
+
+
+def _log_corrupt(path: Text, address: u.HashAddress) -> None:
+  logging.warning("Corrupt object at %s; content hashes to %s.", path,
+                  address.id)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+  """Command-line entry point; scrubs the store at the supplied root forever,
+  or for a single pass with ``--once``.
+
+  """
+  parser = argparse.ArgumentParser(prog="python -m casfs.scrub",
+                                   description=__doc__.splitlines()[0])
+  parser.add_argument("root", help="Path or pyfilesystem URI of the store.")
+  # layout and algorithm default to the ones recorded in the store's config.
+  parser.add_argument("--depth", type=int, default=None)
+  parser.add_argument("--width", type=int, default=None)
+  parser.add_argument("--algorithm", default=None)
+  parser.add_argument("--bytes-per-second", type=float, default=None)
+  parser.add_argument(
+      "--period",
+      type=float,
+      default=None,
+      help="Minimum number of seconds between the starts of "
+      "passes; passes are at least {:g}s apart.".format(MIN_PAUSE))
+  parser.add_argument("--quarantine", action="store_true")
+  parser.add_argument("--once", action="store_true")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO)
+  cas = CASFS(args.root,
+              depth=args.depth,
+              width=args.width,
+              algorithm=args.algorithm)
+
+  def log_progress(p):
+    logging.info("Scrubbed %d objects, %d bytes (%.1f objects/s, %.0f B/s).",
+                 p.objects, p.bytes, p.objects_per_sec, p.bytes_per_sec)
+
+  scrubber = Scrubber(cas,
+                      bytes_per_second=args.bytes_per_second,
+                      period=args.period,
+                      quarantine=args.quarantine,
+                      progress=log_progress)
+  if args.once:
+    scrubber.run_once()
+  else:
+    try:
+      scrubber.run()
+    except KeyboardInterrupt:
+      scrubber.stop()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Single-flight coalescing of concurrent work on the same key.
+
+When many threads ask for the same object at once, only the first does the work;
+the rest wait for it and share its result (or its exception)::
+
+  flights = SingleFlight()
+  result, shared = flights.do(hashid, lambda: expensive_fetch(hashid))
+
+"""
+
+import threading
+from typing import Any, Callable, Hashable, Tuple
+
+
+class _Call(object):
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class SingleFlight(object):
+  """Registry of in-flight calls, keyed by whatever identifies their work."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def do(self, key: Hashable, f: Callable[[], Any]) -> Tuple[Any, bool]:
+    """Call `f`, unless a call for `key` is already in flight, in which case
+    wait for that call instead.
+
+    Returns:
+      A pair of the result and whether it was shared from another caller's
+      call. If the call raised, every caller waiting on it raises the same
+      exception.
+
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result, True
+
+    try:
+      call.result = f()
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+    return call.result, False
+
+  def __len__(self) -> int:
+    """Number of calls in flight."""
+    with self._lock:
+      return len(self._calls)
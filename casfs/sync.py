@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Copy the objects one CASFS has and another lacks.
+
+:func:`sync` lists both stores in hash order and merges the listings, so finding
+the missing objects costs a listing of each store rather than a read of every
+object. Missing objects are copied concurrently, straight to their address in
+the destination's layout: the id comes from the source path, so nothing is
+rehashed, even when the two stores are sharded differently::
+
+  sync(CASFS("/mnt/old"), CASFS("gs://bucket/cas", depth=1, width=4),
+       workers=16)
+
+or from the command line::
+
+  python -m casfs.sync /mnt/old gs://bucket/cas --workers 16 --checkpoint
+
+"""
+
+import argparse
+import logging
+from collections import namedtuple
+from contextlib import closing
+from typing import Any, Callable, Iterable, Optional, Sequence, Text, Tuple
+
+import casfs.util as u
+from casfs.base import CASFS
+
+# Name of the cursor file, in the destination's META_DIR, that lets an
+# interrupted sync resume; and the number of source objects visited between
+# writes of that cursor.
+CURSOR = "sync.checkpoint"
+CURSOR_EVERY = 1000
+
+
+class SyncStats(
+    namedtuple("SyncStats", ["copied", "present", "bytes", "elapsed"])):
+  """Outcome of a sync.
+
+    Attributes:
+        copied (int): Number of objects copied.
+        present (int): Number of objects the destination already had.
+        bytes (int): Number of bytes copied.
+        elapsed (float): Seconds the sync took.
+  """
+
+  @property
+  def bytes_per_sec(self) -> float:
+    return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+def _missing(src: CASFS, dst: CASFS,
+             after: Optional[Text]) -> Iterable[Tuple[Text, Optional[Text]]]:
+  """Return generator of ``(path, hashid)`` for every object in `src` after the
+  source path `after`, with `hashid` None if `dst` already has the object."""
+  theirs = (dst._path_to_id(p) for p in dst._sorted_files(
+      after=dst._hashid_to_path(src._path_to_id(after)) if after else None))
+  other = next(theirs, None)
+
+  for path in src._sorted_files(after=after):
+    hashid = src._path_to_id(path)
+    while other is not None and other < hashid:
+      other = next(theirs, None)
+    yield path, (None if other == hashid else hashid)
+
+
+def sync(src: CASFS,
+         dst: CASFS,
+         workers: int = 1,
+         checkpoint: bool = False,
+         progress: Optional[Callable[[u.Progress], Any]] = None,
+         bytes_per_second: Optional[float] = None,
+         progress_interval: float = 1.0) -> SyncStats:
+  """Copy every object in `src` that `dst` doesn't have to `dst`.
+
+  Args:
+    src: Store to copy from.
+    dst: Store to copy to.
+    workers: Number of threads copying objects concurrently.
+    checkpoint: If True, persist a cursor in `dst` every so often so that an
+      interrupted sync resumes where it left off. The cursor is removed once the
+      sync completes.
+    progress: Optional callback that receives a :class:`casfs.util.Progress`
+      of the objects and bytes copied every `progress_interval` seconds, and
+      once more at the end.
+    bytes_per_second: Optional cap on the rate at which objects are copied.
+    progress_interval: Minimum number of seconds between progress reports.
+
+  Returns:
+    A :class:`SyncStats`.
+
+  Raises:
+    ValueError: If the stores address content by different algorithms.
+
+  """
+  # ids are copied as they are, so they have to mean the same in both.
+  if src.algorithm != dst.algorithm:
+    raise ValueError("Can't sync a {} store into a {} store.".format(
+        src.algorithm, dst.algorithm))
+
+  cursor = dst._read_meta(CURSOR) if checkpoint else None
+  tracker = u.ProgressTracker(progress, progress_interval)
+  limiter = u.RateLimiter(bytes_per_second)
+
+  def copy(item):
+    path, hashid = item
+    if hashid is None:
+      return path, None
+
+    nbytes = [0]
+
+    def metered(stream):
+      for data in stream:
+        limiter.consume(len(data))
+        nbytes[0] += len(data)
+        yield data
+
+    with closing(u.Stream(path, fs=src.fs)) as stream:
+      # the source path already names the object, so skip hashing it.
+      dst_path, is_duplicate = dst._copy(metered(stream), hashid)
+    dst._stored(u.HashAddress(hashid, dst_path, is_duplicate))
+    return path, None if is_duplicate else nbytes[0]
+
+  present, visited = 0, 0
+  for path, nbytes in u.bounded_map(copy, _missing(src, dst, cursor), workers):
+    visited += 1
+    if nbytes is None:
+      present += 1
+    else:
+      tracker.update(1, nbytes)
+
+    if checkpoint and visited % CURSOR_EVERY == 0:
+      dst._write_meta(CURSOR, path)
+
+  if checkpoint:
+    dst._remove_meta(CURSOR)
+
+  done = tracker.finish()
+  logging.info("Synced %d objects (%d bytes); %d already present.",
+               done.objects, done.bytes, present)
+  return SyncStats(done.objects, present, done.bytes, done.elapsed)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+  """Command-line entry point; syncs one store into another."""
+  parser = argparse.ArgumentParser(prog="python -m casfs.sync",
+                                   description=__doc__.splitlines()[0])
+  parser.add_argument("src", help="Path or pyfilesystem URI of the source.")
+  parser.add_argument("dst", help="Path or pyfilesystem URI of the target.")
+  # layouts and algorithm default to the ones recorded in each store's config.
+  for side in ("src", "dst"):
+    parser.add_argument("--{}-depth".format(side), type=int, default=None)
+    parser.add_argument("--{}-width".format(side), type=int, default=None)
+  parser.add_argument("--algorithm", default=None)
+  parser.add_argument("--workers", type=int, default=1)
+  parser.add_argument("--bytes-per-second", type=float, default=None)
+  parser.add_argument("--checkpoint", action="store_true")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO)
+  src = CASFS(args.src,
+              depth=args.src_depth,
+              width=args.src_width,
+              algorithm=args.algorithm)
+  dst = CASFS(args.dst,
+              depth=args.dst_depth,
+              width=args.dst_width,
+              algorithm=args.algorithm)
+
+  def log_progress(p):
+    logging.info("Copied %d objects, %d bytes (%.1f objects/s, %.0f B/s).",
+                 p.objects, p.bytes, p.objects_per_sec, p.bytes_per_sec)
+
+  sync(src,
+       dst,
+       workers=args.workers,
+       checkpoint=args.checkpoint,
+       progress=log_progress,
+       bytes_per_second=args.bytes_per_second)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""CASFS split across a fast hot tier and a slower cold tier.
+
+:class:`TieredCASFS` keeps every object in the cold tier, eg a bucket, and the
+recently or frequently used ones in a hot tier, eg local disk::
+
+  cas = TieredCASFS("/mnt/nvme/cas", cold="gs://bucket/cas",
+                    max_size=500 * 2**30, demote_after=7 * 86400)
+
+Puts land in the hot tier and are copied to the cold tier either before `put`
+returns (write-through) or on a background thread (write-back). Reads are
+served from the hot tier when possible; objects only in the cold tier are
+promoted on access. Objects are demoted by deleting their hot copy, once the hot
+tier outgrows `max_size` or they haven't been accessed for `demote_after`
+seconds. Objects are immutable, so a demoted object is always safe to drop: the
+demoter checks that the cold tier has it first.
+
+"""
+
+import logging
+import queue
+import threading
+import time
+from contextlib import closing
+from typing import Iterable, List, Optional, Text, Union
+
+import fs as pyfs
+
+import casfs.gc as g
+import casfs.util as u
+from casfs.base import CASFS, Key
+from casfs.cache import CacheCASFS
+
+
+class TieredCASFS(CacheCASFS):
+  """CASFS whose :attr:`fs` is the hot tier of a two-tier store.
+
+    Attributes:
+        cold: The cold tier, as a :class:`casfs.CASFS` or a root to build one
+            from with the same layout and algorithm as the hot tier.
+        max_size: Size in bytes of the hot tier above which objects are
+            demoted. Defaults to `None`, no limit.
+        write_back: If True, copy new objects to the cold tier on a background
+            thread, so that puts run at the speed of the hot tier; call
+            :meth:`flush` to wait for the copies. Otherwise, puts return once
+            both tiers have the object. Defaults to `False`.
+        demote_after: Optional number of seconds without access after which
+            objects are demoted, however much room the hot tier has left.
+
+  Remaining arguments are passed to :class:`casfs.cache.CacheCASFS`. Listings,
+  repair, verification and GC only cover the hot tier; use :attr:`cold` for the
+  other one. Pinned objects are never demoted.
+
+  """
+
+  def __init__(self,
+               root,
+               cold: Union[CASFS, pyfs.base.FS, str],
+               max_size: Optional[int] = None,
+               write_back: bool = False,
+               demote_after: Optional[float] = None,
+               **kwargs):
+    if not isinstance(cold, CASFS):
+      layout = {
+          k: kwargs[k] for k in ("depth", "width", "algorithm") if k in kwargs
+      }
+      cold = CASFS(cold, **layout)
+
+    self.cold = cold
+    self.write_back = write_back
+    self.demote_after = demote_after
+    if demote_after is not None:
+      self._evict_interval = max(demote_after / 4, 1.0)
+
+    self._pending = set()
+    self._pending_lock = threading.Lock()
+    self._queue = queue.Queue()
+    self._flusher = None
+
+    super(TieredCASFS, self).__init__(
+        root, max_size=float("inf") if max_size is None else max_size, **kwargs)
+
+    if write_back:
+      self._flusher = threading.Thread(target=self._flush_loop,
+                                       name="casfs-write-back",
+                                       daemon=True)
+      self._flusher.start()
+
+  def put(self, content) -> u.HashAddress:
+    address = super(TieredCASFS, self).put(content)
+    self._copy_to_cold([address.id])
+    return address
+
+  def put_many(self,
+               contents: Iterable,
+               batch_size: int = 256) -> List[u.HashAddress]:
+    addresses = super(TieredCASFS, self).put_many(contents, batch_size)
+    self._copy_to_cold(a.id for a in addresses)
+    return addresses
+
+  def get(self, k: Key) -> Optional[u.HashAddress]:
+    """Return the address of `k` in the hot tier, or failing that the cold one.
+    Doesn't promote."""
+    address = super(TieredCASFS, self).get(k)
+    if address is None:
+      address = self.cold.get(k)
+    return address
+
+  def open(self, k: Key):
+    """Open `k` from the hot tier, promoting it from the cold tier first if
+    need be.
+
+    Raises:
+      IOError: If neither tier has `k`.
+
+    """
+    try:
+      return super(TieredCASFS, self).open(k)
+    except IOError:
+      address = self.cold.get(k)
+      if address is None:
+        raise
+
+    hot = self.load(address.id, lambda: self.cold.open(address))
+    self.metrics.incr("promotions")
+    return super(TieredCASFS, self).open(hot)
+
+  def exists(self, k: Key) -> bool:
+    return super(TieredCASFS, self).exists(k) or self.cold.exists(k)
+
+  def delete(self, k: Key) -> None:
+    """Delete `k` from both tiers."""
+    self.cold.delete(k)
+    super(TieredCASFS, self).delete(k)
+
+  def delete_many(self,
+                  keys: Iterable[Key],
+                  workers: int = 1,
+                  prune: bool = True) -> int:
+    """Delete every key in `keys` from both tiers. Returns the number of objects
+    deleted from the hot tier."""
+    keys = list(keys)
+    self.cold.delete_many(keys, workers=workers, prune=prune)
+    return super(TieredCASFS, self).delete_many(keys,
+                                                workers=workers,
+                                                prune=prune)
+
+  def flush(self) -> None:
+    """Wait until every object put so far has reached the cold tier."""
+    if self._flusher is not None:
+      self._queue.join()
+
+  def evict(self) -> int:
+    """Demote objects until the hot tier is under its low watermark, then
+    demote every object not accessed within :attr:`demote_after`. Returns the
+    number of objects demoted."""
+    demoted = super(TieredCASFS, self).evict()
+
+    if self.demote_after is not None:
+      pinned = set()
+      g.mark(self, pinned)
+      cutoff = time.time() - self.demote_after
+      with self._lock:
+        stale = [i for i, e in self._entries.items() if e[1] < cutoff]
+      stale = [i for i in stale if i not in pinned and not self._is_pending(i)]
+
+      if stale:
+        n = self._evict_batch(stale)
+        self.metrics.incr("evictions", n)
+        demoted += n
+
+    return demoted
+
+  def close(self) -> None:
+    """Finish copying pending objects to the cold tier, then stop the
+    background threads."""
+    if self._flusher is not None:
+      self.flush()
+      self._queue.put(None)
+      self._flusher.join()
+      self._flusher = None
+    super(TieredCASFS, self).close()
+
+  def _victims(self, excess: float, pinned) -> List[Text]:
+    # objects still on their way to the cold tier have nowhere to go yet.
+    with self._pending_lock:
+      pending = set(self._pending)
+    return super(TieredCASFS, self)._victims(excess, pending | set(pinned))
+
+  def _evict_batch(self, batch: List[Text]) -> int:
+    # make sure the cold tier has everything before dropping the hot copies.
+    for _ in u.bounded_map(self._to_cold, batch):
+      pass
+    return super(TieredCASFS, self)._evict_batch(batch)
+
+  def _is_pending(self, hashid: Text) -> bool:
+    with self._pending_lock:
+      return hashid in self._pending
+
+  def _copy_to_cold(self, hashids: Iterable[Text]) -> None:
+    """Copy new objects to the cold tier now, or queue them for the flusher in
+    write-back mode."""
+    for hashid in hashids:
+      if self.write_back:
+        with self._pending_lock:
+          queued = hashid not in self._pending
+          self._pending.add(hashid)
+        if queued:
+          self._queue.put(hashid)
+      else:
+        self._to_cold(hashid)
+
+  def _to_cold(self, hashid: Text) -> None:
+    """Copy `hashid` from the hot tier to the cold tier, unless it's there
+    already or has since been deleted."""
+    if self.cold.exists(hashid):
+      return None
+
+    try:
+      f = self.fs.open(self._hashid_to_path(hashid), mode='rb')
+    except pyfs.errors.ResourceNotFound:
+      return None
+
+    with closing(f):
+      self.cold.put(f)
+    self.metrics.incr("cold_writes")
+
+  def _flush_loop(self) -> None:
+    while True:
+      hashid = self._queue.get()
+      try:
+        if hashid is None:
+          return
+        self._to_cold(hashid)
+        with self._pending_lock:
+          self._pending.discard(hashid)
+      except Exception:  # pragma: no cover
+        # leave it pending, and so hot, until the next restart.
+        logging.exception("Copying %s to the cold tier failed.", hashid)
+      finally:
+        self._queue.task_done()
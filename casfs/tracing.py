@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tracing hooks for the CASFS hot path.
+
+:class:`casfs.CASFS` opens a span around every public operation (``casfs.put``,
+``casfs.open``...) and around each phase inside it: hashing, resolving a key to
+a path, probing for an existing object, creating shard directories, writing,
+removing and pruning. Every span carries a ``backend`` attribute naming the
+type of the backing filesystem, and phases carry the object ``id`` and ``size``
+where they're known.
+
+A tracer is any object with a ``span(name, **attributes)`` method returning a
+context manager, whose value has a ``set_attribute(key, value)`` method. That's
+the shape of an OpenTelemetry span, so an OpenTelemetry tracer can be plugged
+in through :class:`OpenTelemetryTracer` without CASFS depending on it::
+
+  from opentelemetry import trace
+  cas = CASFS(root, tracer=OpenTelemetryTracer(trace.get_tracer("casfs")))
+
+:class:`CallbackTracer` hands finished :class:`Span` records to a callback
+instead. The default, :data:`NULL`, does nothing.
+
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Text
+
+
+class _NullSpan(object):
+  """Span that ignores everything; also its own context manager."""
+
+  def set_attribute(self, key: Text, value: Any) -> None:
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer(object):
+  """Tracer that records nothing."""
+
+  def span(self, name: Text, **attributes: Any) -> _NullSpan:
+    return _NULL_SPAN
+
+
+NULL = NullTracer()
+
+
+class Span(object):
+  """Record of a finished span, as handed to a :class:`CallbackTracer`.
+
+    Attributes:
+        name: Name of the span, eg ``"casfs.put"``.
+        attributes: Dict of attributes set on the span.
+        parent: The enclosing :class:`Span` on the same thread, if any.
+        start: Wall-clock time at which the span started.
+        duration: Number of seconds the span lasted.
+        error: The exception that escaped the span, if any.
+  """
+
+  def __init__(self, name: Text, attributes: Dict[Text, Any],
+               parent: Optional["Span"]):
+    self.name = name
+    self.attributes = attributes
+    self.parent = parent
+    self.start = time.time()
+    self.duration = None
+    self.error = None
+    self._t0 = time.perf_counter()
+
+  def set_attribute(self, key: Text, value: Any) -> None:
+    self.attributes[key] = value
+
+  def __repr__(self):
+    return "Span({!r}, {!r}, duration={!r})".format(self.name, self.attributes,
+                                                    self.duration)
+
+
+class _SpanContext(object):
+
+  def __init__(self, tracer: "CallbackTracer", name: Text,
+               attributes: Dict[Text, Any]):
+    self._tracer = tracer
+    self._name = name
+    self._attributes = attributes
+    self._span = None
+
+  def __enter__(self) -> Span:
+    stack = self._tracer._stack()
+    self._span = Span(self._name, self._attributes,
+                      stack[-1] if stack else None)
+    stack.append(self._span)
+    return self._span
+
+  def __exit__(self, exc_type, exc, tb):
+    span = self._span
+    span.duration = time.perf_counter() - span._t0
+    span.error = exc
+    self._tracer._stack().pop()
+    self._tracer.callback(span)
+    return False
+
+
+class CallbackTracer(object):
+  """Tracer that passes every finished :class:`Span` to `callback`, on the
+  thread that ran it. Spans nest per thread.
+
+  """
+
+  def __init__(self, callback: Callable[[Span], Any]):
+    self.callback = callback
+    self._local = threading.local()
+
+  def _stack(self):
+    stack = getattr(self._local, "stack", None)
+    if stack is None:
+      stack = self._local.stack = []
+    return stack
+
+  def span(self, name: Text, **attributes: Any) -> _SpanContext:
+    return _SpanContext(self, name, attributes)
+
+
+class OpenTelemetryTracer(object):
+  """Adapter that opens CASFS spans on an OpenTelemetry
+  ``opentelemetry.trace.Tracer``, so they reach whatever exporters that tracer
+  is configured with.
+
+  """
+
+  def __init__(self, tracer):
+    self.tracer = tracer
+
+  def span(self, name: Text, **attributes: Any):
+    return self.tracer.start_as_current_span(name, attributes=attributes)
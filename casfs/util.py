@@ -15,13 +15,29 @@
 # limitations under the License.
 """Utilities for sharding etc."""
 
-import hashlib
+import base64
+import binascii
 import logging
-from collections import namedtuple
-from typing import Any, List, Optional, Union
+import os
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Sequence,
+                    Tuple, Union)
 
 import fs as pyfs
 from fs.base import FS
+from fs.wrapfs import WrapFS
+
+import casfs.hashers as h
+
+try:
+  import fcntl
+except ImportError:  # pragma: no cover
+  fcntl = None
 
 
 def compact(items: List[Optional[Any]]) -> List[Any]:
@@ -42,12 +58,20 @@ def to_bytes(item: Union[str, bytes]) -> bytes:
   return ret
 
 
-def computehash(stream, algorithm: hashlib.algorithms_available) -> str:
-  """Compute hash of file using the supplied `algorithm`."""
-  hashobj = hashlib.new(algorithm)
+def computehash(stream, algorithm: str) -> str:
+  """Compute hash of file using the supplied `algorithm`, the name of a hasher
+  in :mod:`casfs.hashers`."""
+  return computehashes(stream, [algorithm])[0]
+
+
+def computehashes(stream, algorithms: Sequence[str]) -> List[str]:
+  """Compute the hash of file using each of `algorithms`, in a single pass."""
+  hashobjs = [h.new(algorithm) for algorithm in algorithms]
   for data in stream:
-    hashobj.update(to_bytes(data))
-  return hashobj.hexdigest()
+    data = to_bytes(data)
+    for hashobj in hashobjs:
+      hashobj.update(data)
+  return [hashobj.hexdigest() for hashobj in hashobjs]
 
 
 def shard(digest: str, depth: int, width: int) -> str:
@@ -87,6 +111,278 @@ def syspath(fs: FS, path: str) -> Optional[str]:
     return None
 
 
+# Names of the pyfilesystem classes that front object stores, where directories
+# are only prefixes of object names.
+OBJECT_STORES = ("GCSFS", "S3FS")
+
+
+def is_object_store(fs: FS) -> bool:
+  """Returns True if `fs`, or the filesystem it wraps, is backed by an object
+  store."""
+  while isinstance(fs, WrapFS):
+    fs = fs.delegate_fs()
+  return type(fs).__name__ in OBJECT_STORES
+
+
+# Hasher names of the checksums a GCS blob carries, and the attributes holding
+# them, base64 encoded.
+BLOB_CHECKSUMS = (("md5", "md5_hash"), ("crc32c", "crc32c"))
+
+
+def list_objects(
+    fs: FS,
+    exclude: Optional[str] = None) -> Optional[Iterable[Tuple[str, int]]]:
+  """Return generator of ``(path, size)`` for every file in `fs`, from a single
+  prefix listing of its bucket, or None if `fs` isn't a bucket that can be
+  listed that way. Paths are relative and in lexicographic order; those under
+  the top-level directory `exclude` are skipped.
+
+  """
+  blobs = _list_blobs(fs, exclude)
+  if blobs is None:
+    return None
+  return ((path, blob.size) for path, blob in blobs)
+
+
+def list_checksums(fs: FS,
+                   exclude: Optional[str] = None,
+                   prefix: Optional[str] = None
+                  ) -> Optional[Iterable[Tuple[str, Dict[str, str]]]]:
+  """Like :func:`list_objects`, but yields ``(path, checksums)``, where
+  `checksums` maps the names of the hashers in :data:`BLOB_CHECKSUMS` to the
+  hex digests the bucket reports for the file. No file is read. If supplied,
+  only the files under the directory `prefix` are listed.
+
+  """
+  blobs = _list_blobs(fs, exclude, prefix)
+  if blobs is None:
+    return None
+
+  def checksums(blob):
+    ret = {}
+    for name, attr in BLOB_CHECKSUMS:
+      value = getattr(blob, attr, None)
+      # composite objects have no MD5.
+      if value:
+        ret[name] = binascii.hexlify(base64.b64decode(value)).decode("ascii")
+    return ret
+
+  return ((path, checksums(blob)) for path, blob in blobs)
+
+
+def _list_blobs(fs: FS,
+                exclude: Optional[str] = None,
+                under: Optional[str] = None):
+  """Return generator of ``(path, blob)`` for every file in the bucket behind
+  `fs`, or only those under the directory `under`, or None; see
+  :func:`list_objects`."""
+  bucket = getattr(fs, "bucket", None)
+  if not hasattr(bucket, "list_blobs"):
+    return None
+
+  prefix = getattr(fs, "_prefix", "")
+  prefix = prefix + "/" if prefix else ""
+  skip = exclude + "/" if exclude else None
+  listed = prefix + under.strip("/") + "/" if under else prefix
+
+  def listing():
+    for blob in bucket.list_blobs(prefix=listed or None):
+      path = blob.name[len(prefix):]
+      # directory markers end with a slash.
+      if path and not path.endswith("/"):
+        if skip is None or not path.startswith(skip):
+          yield path, blob
+
+  return listing()
+
+
+def fsync_path(path: str) -> None:
+  """Flush the file or directory at the system path `path` to stable storage.
+  Syncing a directory makes the entries created or renamed in it durable.
+  Platforms that can't open directories, like Windows, skip them silently.
+
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except (IsADirectoryError, PermissionError):
+    if os.path.isdir(path):
+      return None
+    raise
+
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def bounded_map(f: Callable[[Any], Any],
+                items: Iterable[Any],
+                workers: int = 1) -> Iterable[Any]:
+  """Return generator that yields ``f(item)`` for each of `items`, in order,
+  computed on a pool of `workers` threads.
+
+  At most ``2 * workers`` calls are in flight at once, so `items` may be an
+  arbitrarily long lazy sequence. With a single worker everything runs on the
+  calling thread.
+
+  """
+  if workers <= 1:
+    for item in items:
+      yield f(item)
+    return
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = deque()
+    for item in items:
+      pending.append(pool.submit(f, item))
+      if len(pending) >= 2 * workers:
+        yield pending.popleft().result()
+
+    while pending:
+      yield pending.popleft().result()
+
+
+class RateLimiter(object):
+  """Token bucket that throttles callers to `rate` units per second.
+
+  A `rate` of `None` or `0` disables throttling entirely, so a limiter can be
+  threaded through hot loops unconditionally. Safe to share between threads.
+
+    Attributes:
+        rate: Units (usually bytes) allowed per second.
+        burst: Maximum number of units that can be consumed without waiting.
+            Defaults to one second's worth of `rate`.
+  """
+
+  def __init__(self,
+               rate: Optional[float] = None,
+               burst: Optional[float] = None):
+    self.rate = rate
+    self.burst = burst or rate
+    self._tokens = self.burst
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def consume(self, n: float) -> None:
+    """Block until `n` units are available, then take them."""
+    if not self.rate:
+      return None
+
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._last) * self.rate)
+      self._last = now
+      self._tokens -= n
+      deficit = -self._tokens
+
+    if deficit > 0:
+      time.sleep(deficit / self.rate)
+
+
+class StripedLock(object):
+  """Fixed set of locks, each guarding every key that hashes to it, so that
+  work on different keys rarely contends while work on the same key is
+  serialized.
+
+  If `lock_dir` is supplied, each stripe is also guarded by an exclusive
+  `flock` on a file in that (local) directory, which serializes processes on
+  the same host as well as threads. Where `fcntl` isn't available, only
+  threads are serialized.
+
+    Attributes:
+        stripes: Number of locks. `0` disables locking.
+        lock_dir: Optional system path of a directory for lock files.
+  """
+
+  def __init__(self, stripes: int = 0, lock_dir: Optional[str] = None):
+    self.stripes = stripes
+    self.lock_dir = lock_dir if fcntl is not None else None
+    self._locks = [threading.Lock() for _ in range(stripes)]
+
+    if self.lock_dir is not None:
+      os.makedirs(self.lock_dir, exist_ok=True)
+
+  @contextmanager
+  def hold(self, key: str):
+    """Context manager that holds the stripe for `key`."""
+    if not self.stripes:
+      yield
+      return
+
+    # crc32, unlike hash(), agrees between processes.
+    stripe = zlib.crc32(to_bytes(key)) % self.stripes
+    with self._locks[stripe]:
+      if self.lock_dir is None:
+        yield
+        return
+
+      fd = os.open(os.path.join(self.lock_dir, str(stripe)),
+                   os.O_CREAT | os.O_RDWR)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+      finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class Progress(namedtuple("Progress", ["objects", "bytes", "elapsed"])):
+  """Snapshot of a long-running pass over the store.
+
+    Attributes:
+        objects (int): Number of objects processed so far.
+        bytes (int): Number of bytes read so far.
+        elapsed (float): Seconds since the pass started.
+  """
+
+  @property
+  def objects_per_sec(self) -> float:
+    return self.objects / self.elapsed if self.elapsed else 0.0
+
+  @property
+  def bytes_per_sec(self) -> float:
+    return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+class ProgressTracker(object):
+  """Accumulates object and byte counts and reports a :class:`Progress` to
+  `callback` at most once every `interval` seconds.
+
+  """
+
+  def __init__(self,
+               callback: Optional[Callable[[Progress], Any]] = None,
+               interval: float = 1.0):
+    self._callback = callback
+    self._interval = interval
+    self._start = time.monotonic()
+    self._last = self._start
+    self.objects = 0
+    self.bytes = 0
+
+  def snapshot(self) -> Progress:
+    return Progress(self.objects, self.bytes, time.monotonic() - self._start)
+
+  def update(self, objects: int = 1, nbytes: int = 0) -> None:
+    """Record progress, and report it if `interval` has elapsed."""
+    self.objects += objects
+    self.bytes += nbytes
+
+    if self._callback is not None:
+      now = time.monotonic()
+      if now - self._last >= self._interval:
+        self._last = now
+        self._callback(self.snapshot())
+
+  def finish(self) -> Progress:
+    """Report and return the final snapshot."""
+    ret = self.snapshot()
+    if self._callback is not None:
+      self._callback(ret)
+    return ret
+
+
 # TODO add the hashing method here
 # TODO add a to and from string method
 class HashAddress(namedtuple("HashAddress", ["id", "relpath", "is_duplicate"])):
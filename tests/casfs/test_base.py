@@ -20,11 +20,16 @@ TODO - handle strings for 'put'
 
 """
 
+import base64
+import hashlib
+import os
 from contextlib import closing
 from io import StringIO
 
+import casfs.metrics as m
 import casfs.util as u
 from casfs import CASFS
+from casfs.latencyfs import LatencyFS
 from fs.copy import copy_fs
 from fs.memoryfs import MemoryFS
 from fs.opener.errors import UnsupportedProtocol
@@ -245,3 +250,494 @@ def test_stream(mem):
   # filesystem.
   with pytest.raises(ValueError):
     u.Stream("cake", fs=mem)
+
+
+def test_parallel_repair(memcas):
+  keys = [memcas.put(StringIO(str(i))) for i in range(20)]
+  newfs = CASFS(memcas.fs, width=7, depth=1)
+
+  reports = []
+  repaired = newfs.repair(workers=4, progress=reports.append)
+
+  # everything moved, and the final report covers every object.
+  assert len(repaired) == 20
+  assert reports[-1].objects == 20
+  assert reports[-1].bytes == sum(len(str(i)) for i in range(20))
+  assert all(
+      newfs.get(k.id).relpath == newfs._hashid_to_path(k.id) for k in keys)
+
+  # a second pass has nothing to do.
+  assert newfs.repair(workers=4) == []
+
+
+def test_resumable_repair(memcas, monkeypatch):
+  import casfs.base as b
+  monkeypatch.setattr(b, "_CHECKPOINT_EVERY", 1)
+
+  for i in range(10):
+    memcas.put(StringIO(str(i)))
+
+  newfs = CASFS(memcas.fs, width=7, depth=1)
+
+  def interrupt(progress):
+    if progress.objects == 4:
+      raise KeyboardInterrupt()
+
+  with pytest.raises(KeyboardInterrupt):
+    newfs.repair(checkpoint=True, progress=interrupt, progress_interval=0)
+
+  # the cursor survives the interruption; bookkeeping is never content.
+  assert newfs._read_meta(b._REPAIR_CHECKPOINT) is not None
+  assert newfs.count() == 10
+
+  # the second run skips the files before the cursor. (Files moved by the
+  # first run may land after the cursor and get checked again.)
+  reports = []
+  newfs.repair(checkpoint=True, progress=reports.append)
+  assert reports[-1].objects < 10
+  assert newfs._read_meta(b._REPAIR_CHECKPOINT) is None
+  assert list(newfs._corrupted()) == []
+
+
+def test_rate_limiter():
+  # a disabled limiter never blocks.
+  u.RateLimiter().consume(10**12)
+
+  limiter = u.RateLimiter(1000)
+  limiter.consume(1000)
+  assert limiter._tokens == 0
+
+
+def test_verify(memcas):
+  ak = memcas.put(StringIO('A'))
+  memcas.put(StringIO('B'))
+
+  with pytest.raises(ValueError):
+    memcas.verify(mode="random")
+
+  # the first quick pass has no fingerprints, so it reads everything...
+  reports = []
+  assert memcas.verify(progress=reports.append) == []
+  assert reports[-1] == (2, 2, reports[-1].elapsed)
+
+  # ...and the second reads nothing at all.
+  assert memcas.verify(progress=reports.append) == []
+  assert reports[-1].objects == 2 and reports[-1].bytes == 0
+
+  # full mode, or an expired fingerprint, forces a rehash.
+  memcas.verify(mode="full", progress=reports.append)
+  assert reports[-1].bytes == 2
+  memcas.verify(max_age=-1, progress=reports.append)
+  assert reports[-1].bytes == 2
+
+  # changing the content changes the stat data, so quick mode notices.
+  memcas.fs.writetext(ak.relpath, 'Corrupt!')
+  corrupted = memcas.verify()
+  assert [p for p, _ in corrupted] == [ak.relpath]
+
+  # verify doesn't fix anything; repair does.
+  memcas.repair()
+  assert memcas.verify() == []
+
+
+def test_delete_many(memcas, capsys):
+  keys = [memcas.put(StringIO(str(i))) for i in range(20)]
+
+  # ids, paths and addresses all work; missing keys are skipped.
+  doomed = [k.id for k in keys[:5]] + [k.relpath for k in keys[5:10]
+                                      ] + keys[10:15] + ['missing']
+  assert memcas.delete_many(doomed, workers=4) == 15
+  assert memcas.count() == 5
+  assert all(memcas.exists(k) for k in keys[15:])
+
+  # every emptied shard directory was pruned.
+  assert len(list(memcas.fs.walk.dirs(exclude_dirs=[".casfs"]))) == len(
+      {d for k in keys[15:] for d in (k.relpath[:2], k.relpath[:5])})
+
+  # nothing goes to stdout any more.
+  memcas.delete(keys[15])
+  assert capsys.readouterr().out == ""
+
+
+def test_prune_empty(memcas):
+  keys = [memcas.put(StringIO(str(i))) for i in range(10)]
+  assert memcas.delete_many(keys, prune=False) == 10
+  assert list(memcas.folders()) == []
+  assert len(list(memcas.fs.walk.dirs(exclude_dirs=[".casfs"]))) > 0
+
+  memcas.prune_empty()
+  assert list(memcas.fs.walk.dirs(exclude_dirs=[".casfs"])) == []
+
+
+def test_atomic_publish(memcas):
+  # a write that dies part way leaves nothing at the content address...
+  class Exploding(object):
+
+    def __iter__(self):
+      yield b'partial'
+      raise KeyboardInterrupt()
+
+  hashid = memcas._computehash(StringIO('partial and more'))
+  with pytest.raises(KeyboardInterrupt):
+    memcas._copy(Exploding(), hashid)
+
+  assert not memcas.exists(hashid)
+  assert memcas.count() == 0
+
+  # ...and no temp file either.
+  assert memcas.fs.listdir(".casfs/tmp") == []
+
+
+def test_stale_temp_cleanup(memcas):
+  memcas.put(StringIO('A'))
+  memcas.fs.writetext(".casfs/tmp/abandoned", "junk")
+
+  memcas._clean_temp()
+  assert memcas.fs.exists(".casfs/tmp/abandoned")
+
+  memcas._clean_temp(max_age=-1)
+  assert not memcas.fs.exists(".casfs/tmp/abandoned")
+
+
+def test_locked_concurrent_puts(tmp_path):
+  from concurrent.futures import ThreadPoolExecutor
+
+  cas = CASFS(str(tmp_path), locks=16)
+  assert cas._locks.lock_dir is not None
+
+  with ThreadPoolExecutor(max_workers=8) as pool:
+    keys = list(pool.map(lambda i: cas.put(StringIO(str(i % 4))), range(64)))
+
+  # every object was written exactly once.
+  assert sum(1 for k in keys if not k.is_duplicate) == 4
+  assert cas.count() == 4
+  assert os.listdir(str(tmp_path / ".casfs" / "tmp")) == []
+
+
+def test_durability(tmp_path, monkeypatch):
+  synced = []
+  monkeypatch.setattr(u, "fsync_path", synced.append)
+
+  with pytest.raises(ValueError):
+    CASFS(str(tmp_path), durability="paranoid")
+
+  CASFS(str(tmp_path / "none")).put(StringIO("a"))
+  assert synced == []
+
+  CASFS(str(tmp_path / "data"), durability="data").put(StringIO("a"))
+  assert len(synced) == 1
+  assert os.path.dirname(synced[0]).endswith(os.path.join(".casfs", "tmp"))
+
+  # full also syncs the new shard directories, up to the root of the store.
+  del synced[:]
+  cas = CASFS(str(tmp_path / "full"), durability="full")
+  ak = cas.put(StringIO("a"))
+  shard = os.path.dirname(ak.relpath)
+  assert synced[1:] == [
+      cas.fs.getsyspath(d) for d in (shard, os.path.dirname(shard), "/")
+  ]
+
+  # existing directories are synced alone.
+  del synced[:]
+  cas.put(StringIO("a"))
+  assert synced == []
+
+
+def test_put_many(tmp_path, monkeypatch):
+  synced = []
+  monkeypatch.setattr(u, "fsync_path", synced.append)
+  cas = CASFS(str(tmp_path), depth=1, width=1, durability="full")
+  old = cas.put(StringIO("old"))
+  del synced[:]
+
+  contents = [StringIO(x) for x in ("a", "b", "a", "old", "c")]
+  keys = cas.put_many(contents, batch_size=3)
+
+  assert [k.is_duplicate for k in keys] == [False, False, True, True, False]
+  assert keys[3] == old._replace(is_duplicate=True)
+  assert keys[0].id == keys[2].id
+  for k, x in zip(keys, ("a", "b", "a", "old", "c")):
+    with closing(cas.open(k)) as f:
+      assert f.read() == x.encode("utf8")
+
+  # two groups, each syncing its new temp files before any directory.
+  is_temp = [".casfs" in p for p in synced]
+  assert is_temp == [True, True, False, False, False, True, False, False]
+  assert os.listdir(str(tmp_path / ".casfs" / "tmp")) == []
+
+
+class _Blob(object):
+
+  def __init__(self, name, size, md5_hash=None):
+    self.name = name
+    self.size = size
+    self.md5_hash = md5_hash
+
+
+class _Bucket(object):
+  """Just enough of a GCS bucket to list a MemoryFS by prefix."""
+
+  def __init__(self, fs):
+    self.fs = fs
+    self.listings = 0
+
+  def list_blobs(self, prefix=None):
+    self.listings += 1
+    blobs = [
+        _Blob("root/" + p.lstrip("/"), self.fs.getsize(p),
+              base64.b64encode(hashlib.md5(self.fs.readbytes(p)).digest()))
+        for p in self.fs.walk.files()
+    ]
+    return sorted((b for b in blobs if b.name.startswith(prefix or "")),
+                  key=lambda b: b.name)
+
+
+class GCSFS(MemoryFS):
+  """MemoryFS posing as a bucket."""
+
+  def __init__(self):
+    super(GCSFS, self).__init__()
+    self.bucket = _Bucket(self)
+    self._prefix = "root"
+
+
+def test_flat(mem):
+  assert u.list_objects(mem) is None
+  assert not CASFS(mem).flat
+
+  bucket = GCSFS()
+  cas = CASFS(bucket, metrics=m.Metrics())
+  assert cas.flat
+
+  ak = cas.put(StringIO("a"))
+  bk = cas.put(StringIO("b"))
+
+  # MemoryFS is strict about parents, so only writes into new directories
+  # fall back to creating them.
+  flat = CASFS(GCSFS(), depth=1, width=1, metrics=m.Metrics())
+  for i in range(50):
+    flat.put(StringIO(str(i)))
+  assert flat.metrics.counter("backend_calls",
+                              call="makedirs") == len(list(flat.folders()))
+
+  # listings come from the bucket and skip bookkeeping files.
+  cas.pin("keep", [ak.id])
+  bucket.bucket.listings = 0
+  assert sorted(cas.files()) == sorted([ak.relpath, bk.relpath])
+  assert cas.count() == 2
+  assert cas.size() == 2
+  assert list(cas._sorted_files(after=min(ak.relpath, bk.relpath))) == [
+      max(ak.relpath, bk.relpath)
+  ]
+  assert bucket.bucket.listings == 4
+
+  # deletes leave "directories" alone.
+  cas.delete(ak)
+  assert bucket.isdir(os.path.dirname(ak.relpath))
+
+  # objects are uploaded straight to their key: a put is a probe and a write.
+  remote = LatencyFS(GCSFS())
+  cas = CASFS(remote, depth=1, width=1)
+  first = cas.put(StringIO("first"))
+  content = next(
+      str(i)
+      for i in range(1000)
+      if cas._computehash([str(i).encode()])[0] == first.id[0])
+  remote.reset()
+  cas.put(StringIO(content))
+  assert remote.calls == {"isfile": 1, "open": 1}
+  assert not remote.exists(".casfs/tmp")
+
+
+def test_dir_cache(mem):
+  cas = CASFS(mem, depth=1, width=1, dir_cache="persist", metrics=m.Metrics())
+  keys = [cas.put(StringIO(str(i))) for i in range(50)]
+  made = cas.metrics.counter("backend_calls", call="makedirs")
+  assert made == len(list(cas.folders())) < 50
+
+  # a fresh store picks up the persisted directories.
+  again = CASFS(mem, depth=1, width=1, dir_cache="persist", metrics=m.Metrics())
+  again.put(StringIO("new"))
+  assert again.metrics.counter("backend_calls", call="makedirs") == 0
+
+  # directories that vanish behind the cache's back are recreated.
+  mem.removetree(os.path.dirname(keys[0].relpath))
+  assert not again.put(StringIO("0")).is_duplicate
+  assert again.exists(keys[0])
+
+  # pruning forgets directories.
+  cas = CASFS(MemoryFS(), depth=1, width=1)
+  ak = cas.put(StringIO("a"))
+  cas.delete(ak)
+  assert cas._dirs == set()
+
+  # pruning and recreating a directory doesn't grow the persisted list, and a
+  # list with duplicates is compacted on load.
+  fresh = MemoryFS()
+  cas = CASFS(fresh, depth=1, width=1, dir_cache="persist")
+  for _ in range(20):
+    cas.delete(cas.put(StringIO("a")))
+  assert cas._read_meta("dirs").splitlines() == [os.path.dirname(ak.relpath)]
+  cas._write_meta("dirs", "a\nb\na\na\n")
+  cas = CASFS(fresh, depth=1, width=1, dir_cache="persist")
+  assert cas._read_meta("dirs") == "a\nb\n"
+
+
+def test_precreate(mem):
+  with pytest.raises(ValueError):
+    CASFS(MemoryFS(), depth=3, width=3).precreate()
+
+  cas = CASFS(mem, depth=2, width=1, precreate=True)
+  assert len(list(mem.walk.dirs(exclude_dirs=[".casfs"]))) == 16 + 16 * 16
+  assert CASFS(mem, depth=2, width=1).precreate() == 0
+
+  cas = CASFS(mem, depth=2, width=1, precreate=True, metrics=m.Metrics())
+  ak = cas.put(StringIO("a"))
+  cas.delete(ak)
+  assert cas.metrics.counter("backend_calls", call="makedirs") == 0
+  assert mem.isdir(os.path.dirname(ak.relpath))
+
+
+def test_reshard(mem, monkeypatch):
+  cas = CASFS(mem, metrics=m.Metrics())
+  keys = [cas.put(StringIO(str(i))) for i in range(40)]
+  hashed = cas.metrics.counter("bytes_hashed")
+
+  # interrupt the reshard partway through.
+  relocate = cas._relocate
+  moves = []
+
+  def flaky(path, address):
+    moves.append(path)
+    if len(moves) == 15:
+      raise IOError("interrupted")
+    relocate(path, address)
+
+  monkeypatch.setattr(cas, "_relocate", flaky)
+  with pytest.raises(IOError):
+    cas.reshard(1, 4)
+
+  # both layouts stay readable, here and in fresh stores.
+  fresh = CASFS(mem, depth=1, width=4)
+  for i, k in enumerate(keys):
+    with closing(fresh.open(k.id)) as f:
+      assert f.read() == str(i).encode("utf8")
+  new = fresh.put(StringIO("new"))
+  assert new.relpath.count("/") == 1
+
+  # until it's finished, a third layout is refused.
+  with pytest.raises(ValueError):
+    fresh.reshard(2, 1)
+  assert all(fresh.exists(k.id) for k in keys)
+
+  monkeypatch.setattr(cas, "_relocate", relocate)
+  assert fresh.reshard(1, 4, workers=4) == 40 - 14
+  assert fresh._old_layout is None
+  assert all(p.count("/") == 1 for p in fresh.files())
+  assert len(list(mem.walk.dirs(exclude_dirs=[".casfs"]))) == len(
+      list(fresh.folders()))
+  assert cas.metrics.counter("bytes_hashed") == hashed
+
+
+def test_config(mem):
+  ak = CASFS(mem, depth=1, width=3, algorithm="sha1").put(StringIO("a"))
+
+  # the layout and algorithm come back from the store's config.
+  cas = CASFS(mem)
+  assert (cas.depth, cas.width, cas.algorithm) == (1, 3, "sha1")
+  assert cas.get(ak.id) == ak
+
+  with pytest.raises(ValueError):
+    CASFS(mem, algorithm="md5")
+
+  # explicit arguments are only used by that store, which reads both layouts
+  # but refuses writes until it's repaired into the new one.
+  other = CASFS(mem, depth=2, width=2)
+  with closing(other.open(ak.id)) as f:
+    assert f.read() == b"a"
+  with pytest.raises(ValueError):
+    other.put(StringIO("b"))
+  assert (CASFS(mem).depth, CASFS(mem).width) == (1, 3)
+  assert CASFS(mem, depth=1, width=3)._old_layout is None
+  assert len(other.repair()) == 1
+  assert (CASFS(mem).depth, CASFS(mem).width) == (2, 2)
+  assert CASFS(mem)._old_layout is None
+  other.put(StringIO("b"))
+
+  mem.writetext(".casfs/config.json", '{"features": ["encrypted"]}')
+  with pytest.raises(ValueError):
+    CASFS(mem)
+
+
+def test_digests(mem):
+  cas = CASFS(mem, digests=("md5", "sha1"))
+  ak = cas.put(StringIO("a"))
+  bk, = cas.put_many([StringIO("b")])
+  assert cas.get_digests(ak) == {
+      "md5": hashlib.md5(b"a").hexdigest(),
+      "sha1": hashlib.sha1(b"a").hexdigest()
+  }
+  assert cas.get_digests(bk.id)["md5"] == hashlib.md5(b"b").hexdigest()
+  assert cas.get_digests("missing") is None
+
+  # the digests are recorded, so reading them doesn't touch the object.
+  with closing(mem.openbin(ak.relpath, "r+b")) as f:
+    f.write(b"x")
+  assert cas.get_digests(ak)["md5"] == hashlib.md5(b"a").hexdigest()
+
+  # new algorithms are filled in from one read, unless that's turned off.
+  more = CASFS(mem, digests=("md5", "sha512"))
+  assert CASFS(mem).digests == ("md5", "sha512")
+  assert "sha512" not in more.get_digests(bk, compute=False)
+  assert more.get_digests(bk)["sha512"] == hashlib.sha512(b"b").hexdigest()
+
+  more.delete(bk)
+  more.delete_many([ak])
+  assert not list(mem.walk.files(".casfs/digests"))
+
+
+def test_verify_checksums(mem, monkeypatch):
+  with pytest.raises(ValueError):
+    CASFS(mem).verify(mode="checksums")
+
+  bucket = GCSFS()
+  with pytest.raises(ValueError):
+    CASFS(bucket, digests=("sha1",)).verify(mode="checksums")
+  cas = CASFS(bucket, digests=("md5",), metrics=m.Metrics())
+  keys = [cas.put(StringIO(str(i))) for i in range(10)]
+  hashed = cas.metrics.counter("bytes_hashed")
+  assert cas.verify(mode="checksums") == []
+  assert cas.metrics.counter("bytes_hashed") == hashed
+
+  # only the object whose checksum changed is read.
+  bucket.writebytes(keys[3].relpath, b"corrupt")
+  corrupted = cas.verify(mode="checksums")
+  assert [p for p, _ in corrupted] == [keys[3].relpath]
+  assert cas.metrics.counter("bytes_hashed") == hashed + len(b"corrupt")
+
+  # objects without recorded digests are rehashed, and get them.
+  bucket.remove(keys[3].relpath)
+  bucket.remove(cas._meta_path(cas._digests_name(keys[5].id)))
+  assert cas.verify(mode="checksums") == []
+  assert cas.get_digests(keys[5], compute=False) == {
+      "md5": hashlib.md5(b"5").hexdigest()
+  }
+
+  # sidecars are read once; after that the per-prefix indexes stand in for
+  # them, until a sidecar changes.
+  loads = []
+  load_digests = cas._load_digests
+  monkeypatch.setattr(
+      cas, "_load_digests",
+      lambda hashid: loads.append(hashid) or load_digests(hashid))
+  assert cas.verify(mode="checksums") == []
+  assert loads == [keys[5].id]
+  del loads[:]
+  cas._save_digests(keys[7].id, {"md5": "0" * 32})
+  hashed = cas.metrics.counter("bytes_hashed")
+  assert cas.verify(mode="checksums") == []
+  assert loads == [keys[7].id]
+  assert cas.metrics.counter("bytes_hashed") == hashed + 1
+  # the sidecar verify just rewrote is read once more to index it.
+  assert cas.verify(mode="checksums") == cas.verify(mode="checksums") == []
+  assert loads == [keys[7].id] * 2
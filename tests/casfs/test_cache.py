@@ -0,0 +1,106 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the size-capped cache mode."""
+
+import time
+from io import BytesIO
+
+import casfs.metrics as m
+from casfs import CASFS
+from casfs.cache import CacheCASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def blob(c, size=100):
+  return BytesIO(c * size)
+
+
+def test_lru_eviction():
+  metrics = m.Metrics()
+  cache = CacheCASFS(MemoryFS(),
+                     max_size=350,
+                     low_water=0.5,
+                     background=False,
+                     metrics=metrics)
+  a, b, c = [cache.put(blob(x)) for x in (b'a', b'b', b'c')]
+
+  # touch A, so B is the least recently used.
+  time.sleep(0.01)
+  cache.open(a).close()
+
+  d = cache.put(blob(b'd'))
+  assert cache.current_size == 400
+  assert cache.evict() == 3
+  assert cache.current_size == 100
+  assert cache.exists(d)
+  assert not any(cache.exists(k) for k in (a, b, c))
+
+  assert metrics.counter("evictions") == 3
+  assert metrics.counter("cache_hits") == 1
+  with pytest.raises(IOError):
+    cache.open(a)
+  assert metrics.counter("cache_misses") == 1
+
+
+def test_put_many():
+  cache = CacheCASFS(MemoryFS(), max_size=100, background=False)
+  keys = cache.put_many([blob(bytes([i]), 50) for i in range(10)])
+  assert cache.current_size == cache.size() == 500
+
+  cache.evict()
+  assert cache.size() <= 100
+  assert cache.current_size == cache.size()
+  assert sum(cache.exists(k) for k in keys) == cache.size() // 50
+
+
+def test_lfu_and_pins():
+  cache = CacheCASFS(MemoryFS(), max_size=250, policy="lfu", background=False)
+  a, b, c = [cache.put(blob(x)) for x in (b'a', b'b', b'c')]
+  cache.get(b)
+  cache.get(c)
+  cache.pin("keep", [a])
+
+  # A is least frequently used but pinned, so B goes.
+  assert cache.evict() == 1
+  assert cache.exists(a) and not cache.exists(b) and cache.exists(c)
+
+  # deleting through any path keeps the accounting straight.
+  cache.delete(c)
+  assert cache.current_size == 100
+
+
+def test_existing_store_and_background_eviction():
+  store = CASFS(MemoryFS())
+  for x in (b'a', b'b', b'c'):
+    store.put(blob(x))
+
+  cache = CacheCASFS(store.fs, max_size=1000)
+  assert cache.current_size == 300
+
+  cache.max_size = 250
+  cache.put(blob(b'd'))
+  deadline = time.time() + 5
+  while cache.current_size > 225 and time.time() < deadline:
+    time.sleep(0.01)
+  cache.close()
+
+  assert cache.current_size <= 225
+  assert cache.count() == 2
+
+  with pytest.raises(ValueError):
+    CacheCASFS(MemoryFS(), max_size=1, policy="random")
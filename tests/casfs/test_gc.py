@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pins and mark-and-sweep garbage collection."""
+
+from datetime import datetime
+from io import StringIO
+
+import casfs.gc as g
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+@pytest.fixture
+def memcas():
+  return CASFS(MemoryFS())
+
+
+def test_pins(memcas):
+  ak = memcas.put(StringIO('A'))
+  memcas.pin("builds/1", [ak])
+  memcas.pin("builds/2", [ak.id])
+  assert sorted(memcas.pins()) == ["builds/1", "builds/2"]
+
+  memcas.unpin("builds/1")
+  memcas.unpin("builds/1")
+  assert list(memcas.pins()) == ["builds/2"]
+
+  # pins are bookkeeping, not content.
+  assert memcas.count() == 1
+
+  with pytest.raises(ValueError):
+    memcas.pin("../escape", [ak])
+
+
+def test_gc(memcas):
+  ak = memcas.put(StringIO('A'))
+  bk = memcas.put(StringIO('B'))
+  ck = memcas.put(StringIO('C'))
+
+  # a manifest refers to B; pinning the manifest keeps both alive.
+  manifest = memcas.put(StringIO(g.format_refs([bk.id])))
+  memcas.pin("release", [ak], manifests=[manifest])
+
+  # everything is too young to collect.
+  assert memcas.gc() == (3, 0, 0, 1)
+  assert memcas.count() == 4
+
+  stats = memcas.gc(grace_period=-1, dry_run=True)
+  assert stats.deleted == 1 and memcas.count() == 4
+
+  stats = memcas.gc(grace_period=-1, workers=4)
+  assert stats == (3, 1, 1, 0)
+  assert not memcas.exists(ck)
+  assert all(memcas.exists(k) for k in (ak, bk, manifest))
+
+  # dropping the pin frees everything.
+  memcas.unpin("release")
+  memcas.gc(grace_period=-1)
+  assert memcas.count() == 0
+  assert list(memcas.folders()) == []
+
+
+def test_gc_races(monkeypatch):
+  cas = CASFS(MemoryFS(), locks=4)
+  ak = cas.put(StringIO('A'))
+  bk = cas.put(StringIO('B'))
+  ck, = cas.put_many([StringIO('C')])
+  for k in (ak, bk, ck):
+    cas.fs.settimes(k.relpath, datetime(2000, 1, 1))
+
+  # once marking is over, A and C are put again and B is pinned.
+  unreachable = g._unreachable
+
+  def race(cas, marks):
+    assert cas.put(StringIO('A')).is_duplicate
+    cas.put_many([StringIO('C')])
+    cas.pin("late", [bk])
+    return unreachable(cas, marks)
+
+  monkeypatch.setattr(g, "_unreachable", race)
+  assert cas.gc(grace_period=1).deleted == 0
+  assert all(cas.exists(k) for k in (ak, bk, ck))
+  assert cas._reputs is None
+
+  # a put before the collection doesn't protect an old object.
+  monkeypatch.setattr(g, "_unreachable", unreachable)
+  cas.put(StringIO('A'))
+  cas.unpin("late")
+  assert cas.gc(grace_period=1).deleted == 3
+
+
+def test_gc_missing_manifest(memcas):
+  ak = memcas.put(StringIO('A'))
+  memcas.pin("broken", manifests=["0" * 64])
+
+  with pytest.raises(IOError):
+    memcas.gc(grace_period=-1)
+  assert memcas.exists(ak)
+
+
+def test_markset_buckets():
+  marks = g.MarkSet(buffer_size=2)
+  for i in ["aa1", "aa2", "ab1", "aa3"]:
+    marks.add(i)
+
+  assert marks.bucket("aa") == {"aa1", "aa2", "aa3"}
+  assert marks.bucket("ab") == {"ab1"}
+  assert marks.bucket("zz") == set()
+  marks.close()
+
+
+def test_gc_removes_digests():
+  cas = CASFS(MemoryFS(), digests=("md5",))
+  cas.put(StringIO('A'))
+  assert cas.gc(grace_period=-1).deleted == 1
+  assert not list(cas.fs.walk.files(".casfs/digests"))
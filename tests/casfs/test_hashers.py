@@ -0,0 +1,63 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the hasher registry."""
+
+import hashlib
+import zlib
+from io import StringIO
+
+import casfs.hashers as h
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+class Crc32(object):
+
+  def __init__(self):
+    self.crc = 0
+
+  def update(self, data):
+    self.crc = zlib.crc32(data, self.crc)
+
+  def hexdigest(self):
+    return "{:08x}".format(self.crc)
+
+
+def test_registry():
+  assert "sha256" in h.available()
+  assert h.get("sha256").digest_size == 32
+  hashobj = h.new("md5")
+  hashobj.update(b"a")
+  assert hashobj.hexdigest() == hashlib.md5(b"a").hexdigest()
+
+  with pytest.raises(ValueError):
+    h.get("nope")
+
+
+def test_custom_hasher():
+  h.register("test-crc32", Crc32, digest_size=4)
+  mem = MemoryFS()
+  cas = CASFS(mem, algorithm="test-crc32")
+  ak = cas.put(StringIO("a"))
+  assert ak.id == "{:08x}".format(zlib.crc32(b"a"))
+  assert CASFS(mem).algorithm == "test-crc32"
+  assert '"digest_size": 4' in mem.readtext(".casfs/config.json")
+
+  # stores hashed with an algorithm that isn't available don't open.
+  with pytest.raises(ValueError):
+    CASFS(mem, algorithm="nope")
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the latency-injecting filesystem wrapper."""
+
+import time
+from io import BytesIO, StringIO
+
+from casfs import CASFS
+from casfs.latencyfs import LatencyFS
+from fs.memoryfs import MemoryFS
+
+
+def test_round_trips():
+  remote = LatencyFS(MemoryFS())
+  cas = CASFS(remote)
+
+  # the very first put also creates the temp directory.
+  cas.put(StringIO('first'))
+  remote.reset()
+
+  # probe, create the shard directory, write to a temp file and move it.
+  ak = cas.put(StringIO('A'))
+  assert remote.calls == {'isfile': 1, 'makedirs': 1, 'open': 1, 'move': 1}
+
+  # a duplicate put only probes.
+  remote.reset()
+  cas.put(StringIO('A'))
+  assert remote.calls == {'isfile': 1}
+
+  # looking up by id misses on the path check first.
+  remote.reset()
+  assert cas.exists(ak.id)
+  assert remote.calls == {'isfile': 2}
+
+
+def test_digest_round_trips():
+  remote = LatencyFS(MemoryFS())
+  cas = CASFS(remote, digests=("md5",))
+  first = cas.put(StringIO('first'))
+
+  # another object under the same id prefix, in a different shard directory.
+  content = next(
+      str(i)
+      for i in range(10000)
+      if cas._computehash([str(i).encode()])[:2] == first.id[:2] and
+      cas._computehash([str(i).encode()])[2:4] != first.id[2:4])
+
+  # the digests cost one more write, and nothing else.
+  remote.reset()
+  cas.put(StringIO(content))
+  assert remote.calls == {'isfile': 1, 'makedirs': 1, 'open': 2, 'move': 1}
+
+
+def test_latency_and_jitter():
+  remote = LatencyFS(MemoryFS(),
+                     latency=0.01,
+                     latencies={'isfile': 0.0},
+                     jitter=0.01,
+                     seed=1)
+  start = time.monotonic()
+  remote.isfile('missing')
+  assert time.monotonic() - start < 0.01
+
+  start = time.monotonic()
+  remote.makedirs('a/b')
+  assert time.monotonic() - start >= 0.01
+
+
+def test_bandwidth():
+  remote = LatencyFS(MemoryFS(), bandwidth=10**5)
+  cas = CASFS(remote)
+
+  start = time.monotonic()
+  ak = cas.put(BytesIO(bytes(10**4)))
+  with cas.open(ak) as f:
+    assert len(f.read()) == 10**4
+
+  # 20KB through a 100KB/s pipe.
+  assert time.monotonic() - start >= 0.15
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the operation metrics registry."""
+
+from io import StringIO
+
+import casfs.metrics as m
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def test_metrics_disabled_by_default():
+  cas = CASFS(MemoryFS())
+  assert cas.metrics is m.NULL
+  assert not cas.metrics.enabled
+  cas.put(StringIO('A'))
+
+
+def test_put_open_exists_metrics():
+  metrics = m.Metrics()
+  cas = CASFS(MemoryFS(), metrics=metrics)
+
+  ak = cas.put(StringIO('content'))
+  cas.put(StringIO('content'))
+  cas.open(ak).close()
+  assert cas.exists(ak)
+
+  with pytest.raises(IOError):
+    cas.open('missing')
+
+  assert metrics.counter("puts") == 2
+  assert metrics.counter("duplicates") == 1
+  assert metrics.counter("bytes_hashed") == 14
+  assert metrics.counter("bytes_written") == 7
+  assert metrics.counter("backend_calls", call="makedirs") == 1
+  assert metrics.counter("backend_calls", call="open") == 2
+  assert metrics.counter("errors", op="open") == 1
+
+  snap = metrics.snapshot()
+  assert snap["duplicate_hit_rate"] == 0.5
+  assert snap["latency"]["put"]["count"] == 2
+  assert snap["latency"]["open"]["buckets"]["+Inf"] == 2
+  assert snap["latency"]["exists"]["count"] == 1
+
+
+def test_prometheus_format():
+  metrics = m.Metrics(buckets=(0.5, 1.0))
+  metrics.incr("backend_calls", call="isfile")
+  metrics.incr("backend_calls", 2, call="open")
+  metrics.observe("put", metrics.clock())
+
+  text = metrics.to_prometheus()
+  assert text.count("# TYPE casfs_backend_calls_total counter") == 1
+  assert 'casfs_backend_calls_total{call="open"} 2' in text
+  assert 'casfs_op_latency_seconds_bucket{op="put",le="0.5"} 1' in text
+  assert 'casfs_op_latency_seconds_bucket{op="put",le="+Inf"} 1' in text
+  assert 'casfs_op_latency_seconds_count{op="put"} 1' in text
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the partitioned store."""
+
+from io import BytesIO
+
+from casfs.partitioned import PartitionedCASFS, Ring
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def test_ring():
+  ids = ["{:064x}".format(i * 7919) for i in range(2000)]
+  before = Ring(["a", "b", "c"])
+  after = Ring(["a", "b", "c", "d"])
+
+  owners = [before.owner(i) for i in ids]
+  assert {o: owners.count(o) for o in "abc"}["a"] > 400
+
+  # only ids claimed by the new partition change hands.
+  moved = [i for i in ids if before.owner(i) != after.owner(i)]
+  assert all(after.owner(i) == "d" for i in moved)
+  assert 300 < len(moved) < 700
+
+  assert Ring([]).owner(ids[0]) is None
+
+
+def test_partitioned():
+  cas = PartitionedCASFS({"a": MemoryFS(), "b": MemoryFS()})
+  keys = [cas.put(BytesIO(b'%d' % i)) for i in range(100)]
+
+  assert cas.count() == len(cas) == 100
+  assert cas.size() == sum(len(b'%d' % i) for i in range(100))
+  assert set(cas.counts()) == {"a", "b"}
+  assert min(cas.counts().values()) > 20
+  assert sorted(p for _, p in cas.files()) == sorted(k.relpath for k in keys)
+
+  for i, k in enumerate(keys):
+    assert k.id in cas.partitions[cas.partition(k)]
+    with cas.open(k) as f:
+      assert f.read() == b'%d' % i
+
+  assert cas.put(BytesIO(b'0')).is_duplicate
+  cas.delete(keys[0])
+  assert keys[0] not in cas
+  with pytest.raises(IOError):
+    cas.open(keys[0])
+
+
+def test_rebalance():
+  cas = PartitionedCASFS({"a": MemoryFS(), "b": MemoryFS()})
+  keys = [cas.put(BytesIO(b'%d' % i)) for i in range(100)]
+
+  cas.add_partition("c", MemoryFS())
+  with pytest.raises(ValueError):
+    cas.add_partition("c", MemoryFS())
+  # a second change would strand objects put in between.
+  with pytest.raises(ValueError):
+    cas.add_partition("d", MemoryFS())
+  with pytest.raises(ValueError):
+    cas.remove_partition("a")
+
+  # everything stays readable before and after the move.
+  assert all(k in cas for k in keys)
+  moved = cas.rebalance(workers=4)
+  assert 0 < moved < 60
+  assert cas.counts()["c"] == moved
+  assert all(cas.get(k) is not None for k in keys)
+
+  removed = cas.remove_partition("a")
+  assert all(k in cas for k in keys)
+  cas.rebalance()
+  assert removed.count() == 0
+  assert cas.count() == 100
+  assert cas.rebalance() == 0
+
+
+def test_restart():
+  a, b, c = MemoryFS(), MemoryFS(), MemoryFS()
+  cas = PartitionedCASFS({"a": a, "b": b})
+  keys = [cas.put(BytesIO(b'%d' % i)) for i in range(100)]
+  cas.add_partition("c", c)
+
+  # reopened before the rebalance, reads still fall back to the old owners.
+  with pytest.raises(ValueError):
+    PartitionedCASFS({"a": a, "b": b})
+  cas = PartitionedCASFS({"a": a, "b": b, "c": c})
+  assert all(k in cas for k in keys)
+  assert cas.rebalance() > 0
+  assert PartitionedCASFS({"a": a, "b": b, "c": c})._previous is None
+
+  # so do reads after reopening with a partition left out, if it's draining.
+  cas = PartitionedCASFS({"b": b, "c": c}, draining={"a": a})
+  assert all(k in cas for k in keys)
+  cas = PartitionedCASFS({"b": b, "c": c}, draining={"a": a})
+  assert all(k in cas for k in keys)
+  cas.rebalance()
+  assert cas.count() == 100
+  assert PartitionedCASFS({"b": b, "c": c})._previous is None
+
+
+def test_rebalance_moves_digests():
+  cas = PartitionedCASFS({"a": MemoryFS(), "b": MemoryFS()}, digests=("md5",))
+  keys = [cas.put(BytesIO(b'%d' % i)) for i in range(50)]
+  cas.add_partition("c", MemoryFS())
+  cas.rebalance()
+
+  for name, part in cas.partitions.items():
+    sidecars = list(part.fs.walk.files(".casfs/digests"))
+    assert len(sidecars) == part.count()
+  assert all(cas.partitions[cas.partition(k)].get_digests(k, compute=False)
+             for k in keys)
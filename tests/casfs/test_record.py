@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for operation recording and replay."""
+
+from io import StringIO
+
+import casfs.record as r
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+@pytest.fixture
+def trace():
+  recorder = r.Recorder()
+  cas = CASFS(MemoryFS(), recorder=recorder)
+
+  ak = cas.put(StringIO('content'))
+  cas.open(ak).close()
+  assert cas.exists(ak.id)
+  with pytest.raises(IOError):
+    cas.open('missing')
+  cas.delete(ak)
+
+  return recorder, ak
+
+
+def test_record(trace):
+  recorder, ak = trace
+  ops = recorder.ops
+
+  assert [o.op for o in ops] == ["put", "open", "exists", "open", "delete"]
+  assert [o.key for o in ops] == [ak.id, ak.id, ak.id, "missing", ak.id]
+  assert ops[0].size == 7
+  assert [o.error for o in ops] == [False, False, False, True, False]
+  assert all(o.thread == 0 for o in ops)
+  assert ops == sorted(ops, key=lambda o: o.start)
+
+
+def test_save_load(trace, tmp_path):
+  recorder, _ = trace
+  path = tmp_path / "trace.jsonl"
+  with open(str(path), "w") as f:
+    recorder.save(f)
+  with open(str(path)) as f:
+    assert r.load(f) == recorder.ops
+
+
+@pytest.mark.parametrize("mode", ["open", "closed"])
+def test_replay(trace, mode):
+  recorder, ak = trace
+  target = CASFS(MemoryFS(), depth=1, width=4)
+
+  result = r.replay(recorder.ops, target, mode=mode, speed=10)
+  assert result.ops == 5
+  assert result.throughput > 0
+  assert result.latency["open"]["count"] == 2
+  assert result.latency["put"]["max"] >= result.latency["put"]["p50"]
+
+  # the replayed put was deleted again at the end.
+  assert target.count() == 0
+
+  with pytest.raises(ValueError):
+    r.replay(recorder.ops, target, mode="random")
+
+
+def test_replay_unknown_ids():
+  # reads of objects the trace never put are seeded before replaying.
+  ops = [r.Op("open", "abcdef", None, 0.0, 0.0, 0, False)]
+  target = CASFS(MemoryFS())
+  r.replay(ops, target)
+  assert target.count() == 1
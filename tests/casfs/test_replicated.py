@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the replicated store."""
+
+import threading
+import time
+from io import BytesIO
+
+import casfs.metrics as m
+import casfs.replicated as rep
+from casfs import CASFS
+from casfs.latencyfs import LatencyFS
+from casfs.replicated import ReplicatedCASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+class BrokenFS(MemoryFS):
+
+  def openbin(self, path, mode="r", *args, **kwargs):
+    if "w" in mode:
+      raise IOError("disk on fire")
+    return super(BrokenFS, self).openbin(path, mode, *args, **kwargs)
+
+
+class HungFS(MemoryFS):
+
+  def __init__(self):
+    super(HungFS, self).__init__()
+    self.release = threading.Event()
+
+  def isfile(self, path):
+    self.release.wait()
+    return super(HungFS, self).isfile(path)
+
+
+def test_hung_replica(monkeypatch):
+  monkeypatch.setattr(rep, "_MAX_OUTSTANDING", 8)
+  hung = HungFS()
+  cas = ReplicatedCASFS([hung, MemoryFS()], write_quorum=1, metrics=m.Metrics())
+  ak = cas.replicas[1].put(BytesIO(b'a'))
+
+  # the healthy replica keeps answering, and a hung one's backlog is bounded.
+  start = time.monotonic()
+  assert all(cas.exists(ak.id) for _ in range(50))
+  assert cas.put(BytesIO(b'b')).id in cas.replicas[1]
+  assert time.monotonic() - start < 5
+  assert cas.metrics.counter("replicas_saturated") > 0
+
+  hung.release.set()
+  cas.close()
+
+
+def test_quorum():
+  with pytest.raises(ValueError):
+    ReplicatedCASFS([MemoryFS()], write_quorum=2)
+
+  cas = ReplicatedCASFS([MemoryFS(), MemoryFS(), BrokenFS()])
+  assert cas.write_quorum == 2
+  ak = cas.put(BytesIO(b'a'))
+  assert not ak.is_duplicate
+  assert cas.put(BytesIO(b'a')).is_duplicate
+
+  cas.close()
+  assert [ak.id in r for r in cas.replicas] == [True, True, False]
+
+  cas = ReplicatedCASFS([MemoryFS(), BrokenFS(), BrokenFS()])
+  with pytest.raises(IOError):
+    cas.put(BytesIO(b'a'))
+  cas.close()
+
+
+def test_spool_to_disk(monkeypatch):
+  monkeypatch.setattr(rep, "_SPOOL_MEMORY", 4)
+  spool = rep._Spool(BytesIO(b'0123456789'), max_memory=4)
+  with spool.open() as f:
+    assert f.read() == b'0123456789'
+  spool.close()
+
+
+def test_reads():
+  slow = LatencyFS(MemoryFS(), latency=0.2)
+  fast = MemoryFS()
+  metrics = m.Metrics()
+  cas = ReplicatedCASFS([slow, fast], write_quorum=2, metrics=metrics)
+  ak = cas.put(BytesIO(b'a'))
+
+  with cas.open(ak.id) as f:
+    assert f.read() == b'a'
+  assert cas.get(ak.id) == ak._replace(is_duplicate=False)
+  assert ak.id in cas
+  assert "0" * 64 not in cas
+  with pytest.raises(IOError):
+    cas.open("0" * 64)
+
+  # hedging sends a second read only when the first replica is slow.
+  cas.hedge_after = 0.01
+  cas._latency = [0.0, 1.0]
+  with cas.open(ak.id) as f:
+    assert f.read() == b'a'
+  assert metrics.counter("hedged_reads") == 1
+
+  cas.delete(ak)
+  assert not any(ak.id in r for r in cas.replicas)
+  cas.close()
+
+
+def test_anti_entropy():
+  a, b, c = (CASFS(MemoryFS(), depth=1, width=1) for _ in range(3))
+  for i in range(20):
+    [a, b, c][i % 3].put(BytesIO(b'%d' % i))
+
+  cas = ReplicatedCASFS([a, b, c])
+  assert cas.anti_entropy(workers=4) == 40
+  assert a.count() == b.count() == c.count() == 20
+  assert cas.anti_entropy() == 0
+  cas.close()
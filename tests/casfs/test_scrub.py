@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the background scrubber."""
+
+import time
+from io import StringIO
+
+import casfs.scrub as s
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+@pytest.fixture
+def memcas():
+  return CASFS(MemoryFS())
+
+
+def test_scrub_quarantine(memcas):
+  ak = memcas.put(StringIO('A'))
+  bk = memcas.put(StringIO('B'))
+  memcas.fs.writetext(ak.relpath, 'rotten')
+
+  seen = []
+  scrubber = s.Scrubber(memcas,
+                        quarantine=True,
+                        on_corrupt=lambda p, a: seen.append(p))
+  corrupted = scrubber.run_once()
+
+  assert seen == [p for p, _ in corrupted] == [ak.relpath]
+  assert not memcas.exists(ak)
+  assert memcas.exists(bk)
+  assert memcas.count() == 1
+
+  # the rotten object is still around for inspection, but not in the store.
+  assert memcas.fs.readtext(".casfs/quarantine/" + ak.relpath) == 'rotten'
+
+  # a finished pass clears the cursor, and a clean store has nothing to report.
+  assert memcas._read_meta(s.CURSOR) is None
+  assert scrubber.run_once() == []
+
+
+def test_quarantine_removes_digests():
+  cas = CASFS(MemoryFS(), digests=("md5",))
+  ak = cas.put(StringIO('A'))
+  cas.fs.writetext(ak.relpath, 'rotten')
+  s.Scrubber(cas, quarantine=True).run_once()
+  assert not list(cas.fs.walk.files(".casfs/digests"))
+
+
+def test_scrub_resumes(memcas, monkeypatch):
+  monkeypatch.setattr(s, "CURSOR_EVERY", 1)
+  for i in range(10):
+    memcas.put(StringIO(str(i)))
+
+  reports = []
+  scrubber = s.Scrubber(memcas, progress=reports.append)
+
+  # stopping mid-pass persists the position.
+  scrubber._stop.set()
+  scrubber.run_once()
+  cursor = memcas._read_meta(s.CURSOR)
+  assert cursor == sorted(memcas.files())[0]
+
+  # ...and the next pass picks up right after it.
+  scrubber._stop.clear()
+  scrubber.run_once()
+  assert reports[-1].objects == 9
+
+
+def test_scrub_thread(memcas):
+  memcas.put(StringIO('A'))
+  scrubber = s.Scrubber(memcas, bytes_per_second=1024, period=60).start()
+  scrubber.stop(timeout=5)
+  assert scrubber._thread is None
+
+  # without a period, passes are still spaced out rather than run back to back.
+  passes = []
+  scrubber = s.Scrubber(memcas)
+  scrubber.run_once = lambda: passes.append(1)
+  scrubber.start()
+  time.sleep(0.2)
+  scrubber.stop(timeout=5)
+  assert passes == [1]
+
+
+def test_scrub_cli(tmp_path):
+  cas = CASFS(str(tmp_path))
+  cas.put(StringIO('A'))
+  s.main([str(tmp_path), "--once", "--bytes-per-second", "1000"])
+  assert cas._read_meta(s.CURSOR) is None
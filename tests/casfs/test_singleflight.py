@@ -0,0 +1,99 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for single-flight coalescing of puts and cache fills."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import casfs.metrics as m
+from casfs import CASFS
+from casfs.cache import CacheCASFS
+from casfs.latencyfs import LatencyFS
+from casfs.singleflight import SingleFlight
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def test_single_flight():
+  flights = SingleFlight()
+  calls = []
+  gate = threading.Event()
+
+  def slow():
+    calls.append(1)
+    gate.wait()
+    return "result"
+
+  with ThreadPoolExecutor(max_workers=4) as pool:
+    futures = [pool.submit(flights.do, "k", slow) for _ in range(4)]
+    while len(flights) == 0:
+      time.sleep(0.001)
+    time.sleep(0.05)
+    gate.set()
+    results = [f.result() for f in futures]
+
+  assert len(calls) == 1
+  assert sorted(shared for _, shared in results) == [False, True, True, True]
+  assert {r for r, _ in results} == {"result"}
+  assert len(flights) == 0
+
+  # errors are shared too, and don't stick around.
+  with pytest.raises(KeyError):
+    flights.do("k", lambda: {}["missing"])
+  assert flights.do("k", lambda: 1) == (1, False)
+
+
+def test_concurrent_puts_write_once():
+  remote = LatencyFS(MemoryFS(), latencies={"move": 0.05})
+  metrics = m.Metrics()
+  cas = CASFS(remote, metrics=metrics)
+
+  with ThreadPoolExecutor(max_workers=8) as pool:
+    keys = list(pool.map(lambda _: cas.put(BytesIO(b'same')), range(8)))
+
+  assert remote.calls["move"] == 1
+  assert sum(1 for k in keys if not k.is_duplicate) == 1
+  assert metrics.counter("duplicates") == 7
+  assert metrics.counter("shared_puts") >= 1
+
+
+def test_cache_fill():
+  origin = CASFS(MemoryFS())
+  ak = origin.put(BytesIO(b'artifact'))
+
+  cache = CacheCASFS(MemoryFS(), max_size=10**6, background=False)
+  fetches = []
+
+  def loader():
+    fetches.append(1)
+    time.sleep(0.05)
+    return origin.open(ak)
+
+  with ThreadPoolExecutor(max_workers=8) as pool:
+    addresses = list(pool.map(lambda _: cache.load(ak.id, loader), range(8)))
+
+  assert len(fetches) == 1
+  assert {a.id for a in addresses} == {ak.id}
+
+  # hits don't fetch at all.
+  assert cache.load(ak.id, loader).id == ak.id
+  assert len(fetches) == 1
+
+  with pytest.raises(ValueError):
+    cache.load("0" * 64, lambda: BytesIO(b'wrong'))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for store-to-store sync."""
+
+from io import BytesIO
+
+import casfs.metrics as m
+import casfs.sync as s
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def test_sync():
+  src = CASFS(MemoryFS())
+  dst = CASFS(MemoryFS(), depth=1, width=4, metrics=m.Metrics())
+  keys = [src.put(BytesIO(b'%d' % i)) for i in range(50)]
+  for i in range(0, 50, 5):
+    dst.put(BytesIO(b'%d' % i))
+
+  reports = []
+  stats = s.sync(src, dst, workers=4, progress=reports.append)
+  assert (stats.copied, stats.present) == (40, 10)
+  assert stats.bytes == sum(len(b'%d' % i) for i in range(50) if i % 5)
+  assert reports[-1].objects == 40
+
+  # objects land in the destination's layout, without being rehashed.
+  assert dst.metrics.counter("bytes_hashed") == sum(
+      len(b'%d' % i) for i in range(0, 50, 5))
+  for i, k in enumerate(keys):
+    address = dst.get(k.id)
+    assert address.relpath.count("/") == 1
+    with dst.open(address) as f:
+      assert f.read() == b'%d' % i
+
+  assert s.sync(src, dst).copied == 0
+
+  with pytest.raises(ValueError):
+    s.sync(src, CASFS(MemoryFS(), algorithm="md5"))
+
+
+def test_resumable_sync(monkeypatch):
+  monkeypatch.setattr(s, "CURSOR_EVERY", 1)
+  src = CASFS(MemoryFS())
+  dst = CASFS(MemoryFS(), depth=1, width=1)
+  for i in range(20):
+    src.put(BytesIO(b'%d' % i))
+
+  copy = dst._copy
+  calls = []
+
+  def flaky(stream, hashid):
+    calls.append(hashid)
+    if len(calls) == 8:
+      raise IOError("connection reset")
+    return copy(stream, hashid)
+
+  monkeypatch.setattr(dst, "_copy", flaky)
+  with pytest.raises(IOError):
+    s.sync(src, dst, checkpoint=True)
+  assert dst._read_meta(s.CURSOR) is not None
+
+  monkeypatch.setattr(dst, "_copy", copy)
+  stats = s.sync(src, dst, checkpoint=True)
+  assert stats.copied + stats.present == 13
+  assert dst.count() == 20
+  assert dst._read_meta(s.CURSOR) is None
+
+
+def test_main(tmp_path):
+  src = CASFS(str(tmp_path / "src"))
+  ak = src.put(BytesIO(b'a'))
+  s.main([str(tmp_path / "src"), str(tmp_path / "dst"), "--dst-depth", "1"])
+  assert CASFS(str(tmp_path / "dst"), depth=1).exists(ak.id)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the two-tier store."""
+
+from io import BytesIO
+
+import casfs.metrics as m
+from casfs import CASFS
+from casfs.tiered import TieredCASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def read(cas, k):
+  with cas.open(k) as f:
+    return f.read()
+
+
+def test_write_through():
+  cas = TieredCASFS(MemoryFS(), cold=MemoryFS(), background=False)
+  ak = cas.put(BytesIO(b'a'))
+  assert ak in CASFS(cas.fs)
+  assert ak.id in cas.cold
+
+  cas.delete(ak)
+  assert ak.id not in cas
+  assert ak.id not in cas.cold
+
+
+def test_write_back():
+  cas = TieredCASFS(MemoryFS(), cold=MemoryFS(), write_back=True)
+  keys = [cas.put(BytesIO(bytes([i]))) for i in range(20)]
+  cas.flush()
+  assert all(k.id in cas.cold for k in keys)
+  cas.close()
+
+
+def test_put_many():
+  cas = TieredCASFS(MemoryFS(), cold=MemoryFS(), background=False)
+  keys = cas.put_many([BytesIO(b'a'), BytesIO(b'b')])
+  assert [cas.cold.exists(k.id) for k in keys] == [True, True]
+  assert cas.current_size == 2
+
+  cas = TieredCASFS(MemoryFS(), cold=MemoryFS(), write_back=True)
+  keys = cas.put_many([BytesIO(bytes([i])) for i in range(20)])
+  cas.flush()
+  assert all(k.id in cas.cold for k in keys)
+  cas.close()
+
+
+def test_promote_and_demote():
+  cold = CASFS(MemoryFS())
+  cas = TieredCASFS(MemoryFS(),
+                    cold=cold,
+                    max_size=10,
+                    low_water=0.5,
+                    background=False,
+                    metrics=m.Metrics())
+  keys = [cas.put(BytesIO(b'%d' % i * 4)) for i in range(4)]
+
+  assert cas.evict() == 3
+  assert cas.current_size <= 5
+  assert cold.count() == 4
+
+  # reads still work, pulling the object back into the hot tier.
+  demoted = [k for k in keys if not cas.fs.exists(k.relpath)]
+  assert read(cas, demoted[0].id) == b'%d' % keys.index(demoted[0]) * 4
+  assert cas.fs.exists(demoted[0].relpath)
+  assert cas.metrics.counter("promotions") == 1
+
+  with pytest.raises(IOError):
+    cas.open("0" * 64)
+
+
+def test_demote_after():
+  hot = MemoryFS()
+  # written before tiering, so the cold tier has never seen it.
+  old = CASFS(hot).put(BytesIO(b'old'))
+
+  cas = TieredCASFS(hot, cold=MemoryFS(), demote_after=0, background=False)
+  pinned = cas.put(BytesIO(b'pinned'))
+  cas.pin("keep", [pinned.id])
+
+  assert cas.evict() == 1
+  assert not hot.exists(old.relpath)
+  assert hot.exists(pinned.relpath)
+  assert read(cas.cold, old.id) == b'old'
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the tracing hooks."""
+
+from contextlib import contextmanager
+from io import StringIO
+
+import casfs.tracing as t
+from casfs import CASFS
+from fs.memoryfs import MemoryFS
+
+import pytest
+
+
+def test_put_phases():
+  spans = []
+  cas = CASFS(MemoryFS(), tracer=t.CallbackTracer(spans.append))
+  ak = cas.put(StringIO('content'))
+
+  # children finish before their parents.
+  assert [s.name for s in spans] == [
+      "casfs.hash", "casfs.probe", "casfs.makedirs", "casfs.write",
+      "casfs.publish", "casfs.put"
+  ]
+  put = spans[-1]
+  assert all(s.parent is put for s in spans[:-1])
+  assert all(s.attributes["backend"] == "MemoryFS" for s in spans)
+
+  write = spans[3]
+  assert write.attributes["id"] == ak.id
+  assert write.attributes["size"] == 7
+  assert write.duration >= 0
+
+
+def test_open_delete_phases():
+  spans = []
+  cas = CASFS(MemoryFS())
+  ak = cas.put(StringIO('content'))
+  cas.tracer = t.CallbackTracer(spans.append)
+
+  cas.open(ak.id).close()
+  assert [s.name for s in spans
+         ] == ["casfs.resolve", "casfs.fs_open", "casfs.open"]
+  assert spans[0].attributes["path"] == ak.relpath
+
+  del spans[:]
+  cas.delete(ak)
+  assert [s.name for s in spans
+         ] == ["casfs.resolve", "casfs.remove", "casfs.prune", "casfs.delete"]
+
+  # errors are recorded on the spans they escape from.
+  del spans[:]
+  with pytest.raises(IOError):
+    cas.open(ak)
+  assert isinstance(spans[-1].error, IOError)
+
+
+def test_opentelemetry_adapter():
+  started = []
+
+  class FakeTracer(object):
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+      started.append((name, attributes))
+      yield t._NULL_SPAN
+
+  cas = CASFS(MemoryFS(), tracer=t.OpenTelemetryTracer(FakeTracer()))
+  cas.put(StringIO('content'))
+
+  assert started[0] == ("casfs.put", {"backend": "MemoryFS"})
+  assert len(started) == 6